@@ -0,0 +1,79 @@
+""" Compare benchmark results from two commits
+
+Run as:
+
+    python3 benchmarks/compare_benchmarks.py benchmarks/results/abc1234.json \
+        benchmarks/results/def5678.json
+
+For each benchmark, size and dtype in both files, prints the best times and
+the memory allocated by the benchmark (peak minus start), and the ratio
+new / old.
+"""
+
+import json
+import argparse
+
+
+def load_results(filename):
+    """ Return dict of (benchmark, size, dtype) -> result from JSON report
+    """
+    with open(filename, 'rt') as fobj:
+        report = json.load(fobj)
+    return dict(((r['benchmark'], r['size'], r['dtype']), r)
+                for r in report['results'])
+
+
+def benchmark_memory(result):
+    """ Return peak bytes allocated by benchmark, above those at its start
+    """
+    return result['peak_memory'] - result['start_memory']
+
+
+def compare(old, new):
+    """ Return rows comparing results `old` and `new`
+
+    Parameters
+    ----------
+    old : dict
+        Results from ``load_results``.
+    new : dict
+        Results from ``load_results``.
+
+    Returns
+    -------
+    rows : list
+        Tuples of (benchmark, size, dtype, old time, new time, time ratio, old
+        memory, new memory, memory ratio) for results in both `old` and
+        `new`. Memory is bytes allocated by the benchmark, see
+        ``benchmark_memory``.
+    """
+    rows = []
+    for key in sorted(set(old) & set(new)):
+        o, n = old[key], new[key]
+        o_memory, n_memory = benchmark_memory(o), benchmark_memory(n)
+        rows.append(key + (o['best'], n['best'], n['best'] / o['best'],
+                           o_memory, n_memory,
+                           n_memory / float(max(o_memory, 1))))
+    return rows
+
+
+def main():
+    # This function (main) called when this file run as a script.
+    parser = argparse.ArgumentParser(
+        description='Compare two benchmark result files')
+    parser.add_argument('old', help='JSON results for old commit')
+    parser.add_argument('new', help='JSON results for new commit')
+    args = parser.parse_args()
+    print('{0:20s} {1:18s} {2:8s} {3:>9s} {4:>9s} {5:>6s} {6:>9s} {7:>9s} '
+          '{8:>6s}'.format('benchmark', 'size', 'dtype', 'old s', 'new s',
+                           'ratio', 'old MB', 'new MB', 'ratio'))
+    for row in compare(load_results(args.old), load_results(args.new)):
+        print('{0:20s} {1:18s} {2:8s} {3:9.3f} {4:9.3f} {5:6.2f} {6:9.1f} '
+              '{7:9.1f} {8:6.2f}'.format(*(row[:6] + (row[6] / 2. ** 20,
+                                                      row[7] / 2. ** 20,
+                                                      row[8]))))
+
+
+if __name__ == '__main__':
+    # Python is running this file as a script, not importing it.
+    main()
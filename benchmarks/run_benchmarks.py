@@ -0,0 +1,236 @@
+""" Time QC metrics and the outlier pipeline on synthetic images
+
+Run as:
+
+    python3 benchmarks/run_benchmarks.py
+
+Each benchmark runs in its own Python process, so one benchmark is not
+affected by the memory use of the others. The peak memory of a benchmark is
+measured with ``tracemalloc`` over one extra call after the timed calls, so
+it counts the arrays the benchmark allocates, but not the pages of the
+memory-mapped image or the setup before timing. Results are written as JSON
+to ``benchmarks/results/<commit>.json``, to compare commits with
+``benchmarks/compare_benchmarks.py``.
+
+The default image size is small enough for a quick check; give realistic
+sizes with ``--sizes``, e.g.:
+
+    python3 benchmarks/run_benchmarks.py --sizes 64x64x64x200 128x128x128x1000
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+MY_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import synthetic
+import image_loader
+import calc_dvars
+import dvars_sliding
+import calc_centerofmass
+import outliers_mean_brain
+import fused_metrics
+import find_outliers
+
+DEFAULT_SIZES = ('64x64x64x200',)
+DEFAULT_DTYPES = ('int16', 'float32')
+DEFAULT_DATA_DIRECTORY = os.path.join(MY_DIRECTORY, 'data')
+DEFAULT_RESULTS_DIRECTORY = os.path.join(MY_DIRECTORY, 'results')
+
+
+def _z_template(data):
+    return outliers_mean_brain.mean_img(data, 2)[0]
+
+
+# Benchmark name -> (setup, run). ``setup(data)`` prepares arguments that are
+# not part of the timing; ``run(path, data, prepared)`` is timed.
+BENCHMARKS = {
+    'calc_image_dvars': (
+        None, lambda path, data, prepared:
+        calc_dvars.calc_image_dvars(None, data)),
+    'calc_image_dvars_float32': (
+        None, lambda path, data, prepared:
+        calc_dvars.calc_image_dvars(None, data, np.float32)),
+    'calc_sliding_dvars': (
+        None, lambda path, data, prepared:
+        dvars_sliding.calc_sliding_dvars(None, 1, data)),
+    'calc_image_COM': (
+        None, lambda path, data, prepared:
+        calc_centerofmass.calc_image_COM(None, data)),
+    'mean_img': (
+        None, lambda path, data, prepared:
+        outliers_mean_brain.mean_img(data, 2)),
+    'projection_on_mean': (
+        _z_template, lambda path, data, prepared:
+        outliers_mean_brain.projection_on_mean(data, prepared, 2)),
+    'fused_metrics': (
+        lambda data: {2: _z_template(data)}, lambda path, data, prepared:
+        fused_metrics.fused_metrics(data, prepared)),
+    'find_outliers': (
+        None, lambda path, data, prepared:
+        find_outliers.run_report(path)),
+}
+
+
+def run_one(name, path, repeat=3):
+    """ Time benchmark `name` on image `path` in this process
+
+    Parameters
+    ----------
+    name : str
+        Benchmark name, key of ``BENCHMARKS``.
+    path : str
+        Image filename.
+    repeat : int, optional
+        Number of times to run the benchmark.
+
+    Returns
+    -------
+    result : dict
+        With keys ``times`` (list of wall times in seconds), ``best`` (the
+        shortest time), ``start_memory`` (bytes allocated when the benchmark
+        starts) and ``peak_memory`` (peak bytes allocated while it runs),
+        from ``tracemalloc``.
+    """
+    setup, run = BENCHMARKS[name]
+    data = image_loader.image_data(image_loader.load_image(path))
+    prepared = None if setup is None else setup(data)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        run(path, data, prepared)
+        times.append(time.perf_counter() - start)
+    # Tracing slows allocations down, so measure memory in an untimed call
+    tracemalloc.start()
+    try:
+        start_memory = tracemalloc.get_traced_memory()[0]
+        run(path, data, prepared)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'times': times, 'best': min(times), 'start_memory': start_memory,
+            'peak_memory': peak_memory}
+
+
+def run_isolated(name, path, repeat=3):
+    """ Run benchmark `name` on `path` in a new Python process
+
+    See ``run_one`` for parameters and return value.
+    """
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--one', name, path,
+         '--repeat', str(repeat)])
+    return json.loads(output.decode('utf-8'))
+
+
+def commit_id():
+    """ Return short git commit of the repository, or 'unknown'
+    """
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=MY_DIRECTORY,
+            stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return output.decode('utf-8').strip()
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, dtypes=DEFAULT_DTYPES,
+                   names=None, repeat=3,
+                   data_directory=DEFAULT_DATA_DIRECTORY):
+    """ Run benchmarks on synthetic images of all `sizes` and `dtypes`
+
+    Parameters
+    ----------
+    sizes : sequence of str, optional
+        Image shapes, e.g. '64x64x64x200'.
+    dtypes : sequence of str, optional
+        Image data types.
+    names : None or sequence of str, optional
+        Benchmarks to run. None runs all of ``BENCHMARKS``.
+    repeat : int, optional
+        Number of times to run each benchmark.
+    data_directory : str, optional
+        Directory for synthetic images, which are reused if already there.
+
+    Returns
+    -------
+    report : dict
+        Commit, machine and library details, and ``results``, a list with a
+        dict for each benchmark, size and dtype (see ``run_one``).
+    """
+    if names is None:
+        names = sorted(BENCHMARKS)
+    results = []
+    for size in sizes:
+        for dtype in dtypes:
+            path = synthetic.synthetic_image(data_directory,
+                                             synthetic.parse_shape(size),
+                                             dtype)
+            for name in names:
+                result = {'benchmark': name, 'size': size, 'dtype': dtype}
+                result.update(run_isolated(name, path, repeat))
+                print('{0:20s} {1:18s} {2:8s} {3:8.3f}s {4:8.1f}MB'.format(
+                    name, size, dtype, result['best'],
+                    (result['peak_memory'] - result['start_memory']) /
+                    2. ** 20))
+                results.append(result)
+    return {'commit': commit_id(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'n_cpus': os.cpu_count(),
+            'results': results}
+
+
+def main():
+    # This function (main) called when this file run as a script.
+    parser = argparse.ArgumentParser(
+        description='Time QC metrics on synthetic images')
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES,
+                        help='Image shapes (default %(default)s)')
+    parser.add_argument('--dtypes', nargs='+', default=DEFAULT_DTYPES,
+                        help='Image data types (default %(default)s)')
+    parser.add_argument('--benchmarks', nargs='+', choices=sorted(BENCHMARKS),
+                        help='Benchmarks to run (default all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of each benchmark (default %(default)s)')
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIRECTORY,
+                        help='Directory for synthetic images')
+    parser.add_argument('--output',
+                        help='JSON file for results (default '
+                        'benchmarks/results/<commit>.json)')
+    parser.add_argument('--one', nargs=2, metavar=('BENCHMARK', 'IMAGE'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.one is not None:
+        # Worker process for run_isolated
+        print(json.dumps(run_one(args.one[0], args.one[1], args.repeat)))
+        return
+    report = run_benchmarks(args.sizes, args.dtypes, args.benchmarks,
+                            args.repeat, args.data_dir)
+    output = args.output
+    if output is None:
+        if not os.path.isdir(DEFAULT_RESULTS_DIRECTORY):
+            os.makedirs(DEFAULT_RESULTS_DIRECTORY)
+        output = os.path.join(DEFAULT_RESULTS_DIRECTORY,
+                              report['commit'] + '.json')
+    with open(output, 'wt') as fobj:
+        json.dump(report, fobj, indent=2)
+    print('Results written to', output)
+
+
+if __name__ == '__main__':
+    # Python is running this file as a script, not importing it.
+    main()
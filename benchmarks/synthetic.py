@@ -0,0 +1,178 @@
+""" Make synthetic 4D images with known outlier volumes, for benchmarks
+
+Each volume is a smooth "brain" (a 3D Gaussian blob) plus noise. A few
+volumes are spikes (some slices scaled up, like a scanner spike), and a few
+are displaced (the brain shifted, like head motion).
+
+The images are written one volume at a time, so images much bigger than
+memory (e.g. 128 x 128 x 128 x 1000 float32) can be made.
+
+Make an image with:
+
+    python3 benchmarks/synthetic.py 64x64x64x200 int16 bench_data
+"""
+
+import os
+import argparse
+
+import numpy as np
+import nibabel as nib
+
+# Number of spike and of motion volumes injected per image
+N_SPIKES = 3
+N_MOTION = 3
+
+
+def parse_shape(shape_str):
+    """ Return shape tuple from string like '64x64x64x200'
+    """
+    return tuple(int(n) for n in shape_str.split('x'))
+
+
+def image_name(shape, dtype, seed=0):
+    """ Filename for synthetic image, e.g. synth_64x64x64x200_int16_0.nii
+    """
+    return 'synth_{0}_{1}_{2}.nii'.format(
+        'x'.join(str(n) for n in shape), np.dtype(dtype).name, seed)
+
+
+def outlier_volumes(n_vols, seed=0):
+    """ Return spike and motion volume indices for image with `n_vols`
+
+    Parameters
+    ----------
+    n_vols : int
+        Number of volumes.
+    seed : int, optional
+        Random seed.
+
+    Returns
+    -------
+    spikes : list
+        Indices of volumes with spikes.
+    motion : list
+        Indices of displaced volumes.
+    """
+    rng = np.random.RandomState(seed)
+    n_outliers = min(N_SPIKES + N_MOTION, max(n_vols - 2, 0))
+    # Away from first and last volume, which some metrics cannot flag
+    outliers = np.sort(rng.choice(np.arange(1, n_vols - 1), n_outliers,
+                                  replace=False)).tolist()
+    return outliers[::2], outliers[1::2]
+
+
+def iter_synthetic_volumes(shape, dtype=np.int16, seed=0):
+    """ Yield volumes for synthetic 4D image of `shape`
+
+    Parameters
+    ----------
+    shape : tuple
+        4D image shape.
+    dtype : numpy dtype, optional
+        Data type of volumes.
+    seed : int, optional
+        Random seed.
+
+    Yields
+    ------
+    vol : 3D array
+        Next volume, in `dtype`.
+    """
+    rng = np.random.RandomState(seed)
+    spikes, motion = outlier_volumes(shape[3], seed)
+    centers = [n / 2. for n in shape[:3]]
+    widths = [n / 4. for n in shape[:3]]
+    grids = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    brain = 1000 * np.exp(-sum(((g - c) / w) ** 2 for g, c, w
+                                in zip(grids, centers, widths)))
+    brain = brain.astype(np.float32)
+    for t in range(shape[3]):
+        if t in motion:
+            vol = np.roll(brain, max(shape[0] // 10, 1), axis=0)
+        else:
+            vol = brain.copy()
+        vol += rng.normal(scale=10, size=shape[:3]).astype(np.float32)
+        if t in spikes:
+            # Bright band of slices
+            vol[..., shape[2] // 3:shape[2] // 2] *= 1.5
+        yield vol.astype(dtype)
+
+
+def make_image(path, shape, dtype=np.int16, seed=0):
+    """ Write synthetic 4D NIfTI1 image of `shape` and `dtype` to `path`
+
+    Parameters
+    ----------
+    path : str
+        Filename for ``.nii`` image.
+    shape : tuple
+        4D image shape.
+    dtype : numpy dtype, optional
+        Data type of image.
+    seed : int, optional
+        Random seed.
+    """
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_xyzt_units('mm', 'sec')
+    header.set_qform(np.eye(4), 1)
+    header.set_sform(np.eye(4), 1)
+    # Header, extension flag (no extensions), then data
+    header['vox_offset'] = 352
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fobj:
+        header.write_to(fobj)
+        fobj.write(b'\x00' * (352 - fobj.tell()))
+        for vol in iter_synthetic_volumes(shape, dtype, seed):
+            # NIfTI data are in Fortran (first axis fastest) order
+            fobj.write(vol.tobytes(order='F'))
+    os.replace(tmp_path, path)
+
+
+def synthetic_image(directory, shape, dtype=np.int16, seed=0):
+    """ Return path of synthetic image in `directory`, making it if needed
+
+    Parameters
+    ----------
+    directory : str
+        Directory for synthetic images; created if it does not exist.
+    shape : tuple
+        4D image shape.
+    dtype : numpy dtype, optional
+        Data type of image.
+    seed : int, optional
+        Random seed.
+
+    Returns
+    -------
+    path : str
+        Filename of image.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, image_name(shape, dtype, seed))
+    if not os.path.isfile(path):
+        make_image(path, shape, dtype, seed)
+    return path
+
+
+def main():
+    # This function (main) called when this file run as a script.
+    parser = argparse.ArgumentParser(
+        description='Make synthetic 4D image with outlier volumes')
+    parser.add_argument('shape', help='Image shape, e.g. 64x64x64x200')
+    parser.add_argument('dtype', help='Data type, e.g. int16 or float32')
+    parser.add_argument('directory', help='Directory for image')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed (default %(default)s)')
+    args = parser.parse_args()
+    shape = parse_shape(args.shape)
+    path = synthetic_image(args.directory, shape, args.dtype, args.seed)
+    spikes, motion = outlier_volumes(shape[3], args.seed)
+    print(path, 'spikes:', spikes, 'motion:', motion)
+
+
+if __name__ == '__main__':
+    # Python is running this file as a script, not importing it.
+    main()
@@ -10,16 +10,47 @@ to do: can use this as summary stat for each volume; do outlier detection over c
 """
 
 import numpy as np
-import nibabel as nib
-from scipy import ndimage
 import matplotlib.pyplot as plt
 import sys
 import seaborn as sns
 import dvars_sliding
+import image_loader
 
 
 
-def calc_image_COM(img):
+def calc_volumes_COM(data, dtype=np.float64):
+    """
+    returns center of mass xyz coordinates for all volumes in 4d array at once
+
+    The coordinates are weighted index sums over the voxel axes, computed from
+    the sums of each volume projected onto the x, y and z axes.
+
+    Parameters
+    ----------
+    data : 4D numpy array
+        data with last dimension length ``t``.
+
+    dtype : numpy dtype
+        precision used to accumulate the sums
+
+    Returns
+    -------
+    com : shape (t, 3) array with com coordinates (x,y,z) for each volume
+
+    """
+    # sum over z, then over y / x to get the projections onto x and y
+    sum_xy = data.sum(axis=2, dtype=dtype)
+    marginals = [sum_xy.sum(axis=1), sum_xy.sum(axis=0),
+                 data.sum(axis=(0, 1), dtype=dtype)]
+    total = marginals[0].sum(axis=0)
+
+    com = np.zeros((data.shape[-1], 3))
+    for i, marginal in enumerate(marginals):
+        com[:, i] = np.arange(marginal.shape[0]).dot(marginal) / total
+    return com
+
+
+def calc_image_COM(img, data=None, chunk_size=None, dtype=np.float64):
     """
     returns center of mass xyz coordinates for each volume in 4d data of img
 
@@ -29,19 +60,34 @@ def calc_image_COM(img):
         nibabel image object containing 4D file, with last dimension length
         ``t``.
 
+    data : None or 4D numpy array
+        will get (memory-mapped) data from img if data is None; otherwise uses
+        the already loaded array (img can then be None)
+
+    chunk_size : None or int
+        number of volumes to process at a time; None processes all volumes
+        at once. Smaller chunks limit the memory used for each step.
+
+    dtype : numpy dtype
+        precision used to accumulate the weighted sums
+
     Returns
     -------
-    com : list of 3-tuples with com coordinate (x,y,z), length number of volumes
+    com : shape (t, 3) array with com coordinates (x,y,z) for each volume
 
     """
-    data = img.get_data() #get 4d array from img
-
-    com = [] #init array for COM
-
-    #get COM for each volume
-    for v in range(data.shape[-1]):
-        temp_vol = data[...,v]
-        com.append(ndimage.measurements.center_of_mass(temp_vol))
+    if data is None:
+        data = image_loader.image_data(img) #get 4d array from img
+
+    n_vols = data.shape[-1]
+    if chunk_size is None:
+        chunk_size = max(n_vols, 1)
+
+    #get COM for each chunk of volumes
+    com = np.zeros((n_vols, 3))
+    for start in range(0, n_vols, chunk_size):
+        stop = min(start + chunk_size, n_vols)
+        com[start:stop] = calc_volumes_COM(data[..., start:stop], dtype)
     return com
 
 
@@ -75,35 +121,85 @@ def plot_com_dvars(com_dvars, coords, window, filename):
 
 
 
-def get_outlier_coords(com, window, filename, fig):
+def calc_com_dvars(com, window):
     """
-    get outlier volumes from com list
+    sliding window dvars over center of mass coordinates
 
     Parameters
     ----------
-    com : list of 3-tuples with com coordinate (x,y,z), length number of volumes
+    com : shape (t, 3) array (or list of 3-tuples) with com coordinate (x,y,z)
+        for each volume
 
     window: int, window size for sliding dvars
 
-    filename: str, .nii filename for plot title
-
-    fig: 1 or 0, 1=show plot & 0 = no plot
-
     Returns
     -------
-    outlier_vols : list outlier volume numbers (or None)
+    values : shape (t - window,) array; value i is for volume i + window
 
     """
-    temp = np.array([[i[0] for i in com], [i[1] for i in com],[i[2] for i in com]])
+    temp = np.asarray(com, dtype=float).T
     temp = np.reshape(temp,(3,1,1,temp.shape[1]))
-    values = dvars_sliding.calc_sliding_dvars(None, window, temp)
+    return dvars_sliding.calc_sliding_dvars(None, window, temp)
+
+
+def com_outlier_mask(values, p=3, sketch=None):
+    """
+    True where com dvars `values` are more than `p` * IQR outside quartiles
+
+    Parameters
+    ----------
+    values : array of com dvars values (from calc_com_dvars)
+
+    p: float, large values make outlier threshold higher
+
+    sketch: None or quantile_sketch.IQRSketch; if given, the values are
+        added to the sketch and the outlier thresholds use its (streaming)
+        quartile estimates instead of exact percentiles of the values
 
+    Returns
+    -------
+    outlier_idx : boolean array, same shape as values
+
+    """
+    if sketch is not None:
+        sketch.extend(values)
+        return sketch.outliers(values, p)
     q1, q3 = np.percentile(values, [25, 75])
-    p = 3 #large values make outlier threshold higher
     x = (q3-q1)*p
     outlier_high = values> q3 + x
     outlier_low = values< q1 - x
-    outlier_idx = np.logical_or(outlier_high, outlier_low)
+    return np.logical_or(outlier_high, outlier_low)
+
+
+def get_outlier_coords(com, window, filename, fig, sketch=None, p=3):
+    """
+    get outlier volumes from com list
+
+    Parameters
+    ----------
+    com : shape (t, 3) array (or list of 3-tuples) with com coordinate (x,y,z)
+        for each volume
+
+    window: int, window size for sliding dvars
+
+    filename: str, .nii filename for plot title
+
+    fig: 1 or 0, 1=show plot & 0 = no plot
+
+    sketch: None or quantile_sketch.IQRSketch; if given, the dvars values are
+        added to the sketch and the outlier thresholds use its (streaming)
+        quartile estimates instead of exact percentiles of the values
+
+    p: float, outliers are more than p * IQR outside the quartiles (large
+        values make outlier threshold higher)
+
+    Returns
+    -------
+    outlier_vols : list outlier volume numbers (or None)
+
+    """
+    values = calc_com_dvars(com, window)
+    outlier_idx = com_outlier_mask(values, p, sketch)
     if outlier_idx.sum() >0:
         outlier_coords = [[i,values[i]] for i in range(len(outlier_idx)) if outlier_idx[i]]
         outlier_coords = np.array(outlier_coords).T
@@ -123,7 +219,7 @@ def main():
     sys.path.append("scripts/")
 
     filename = sys.argv[1]
-    img = nib.load(filename, mmap=False)
+    img = image_loader.load_image(filename)
 
     #find center of mass coords for each vol
     data_com = calc_image_COM(img)
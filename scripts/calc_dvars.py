@@ -28,14 +28,39 @@ If you make that work, check that the tests pass by:
    py.test
 """
 
-import sys
+import argparse
 
 import numpy as np
 
-import nibabel as nib
+import image_loader
 
 
-def calc_image_dvars(img):
+def check_working_dtype(data_dtype, dtype):
+    """ Raise ValueError if `dtype` cannot hold differences of `data_dtype`
+
+    Parameters
+    ----------
+    data_dtype : numpy dtype
+        Data type of image data.
+    dtype : numpy dtype
+        Working precision for differences between volumes. Floating point
+        types can always be used. Integer types need integer data, and must be
+        wide enough to hold the difference of any two data values, e.g.
+        ``np.int32`` for ``np.int16`` data.
+    """
+    data_dtype, dtype = np.dtype(data_dtype), np.dtype(dtype)
+    if dtype.kind == 'f':
+        return
+    if data_dtype.kind not in 'iu':
+        raise ValueError('Integer working precision {0} needs integer data, '
+                         'not {1}'.format(dtype, data_dtype))
+    if (not np.can_cast(data_dtype, dtype) or
+        dtype.itemsize <= data_dtype.itemsize):
+        raise ValueError('Working precision {0} too narrow for differences '
+                         'of {1} data'.format(dtype, data_dtype))
+
+
+def calc_image_dvars(img, data=None, dtype=np.float64, chunk_size=32):
     """ Root mean squared difference between volumes in `img`.
 
     Parameters
@@ -43,6 +68,20 @@ def calc_image_dvars(img):
     img : image object
         nibabel image object containing 4D file, with last dimension length
         ``t``.
+    data : None or 4D array, optional
+        If not None, use this already loaded array instead of reading the data
+        from `img` (`img` can then be None).
+    dtype : numpy dtype, optional
+        Working precision for the differences between volumes. Volumes are
+        converted to this dtype a block at a time, so the whole image is never
+        held in this precision. The squared differences are always summed in
+        64-bit precision: ``np.float32`` halves the memory and memory traffic
+        of ``np.float64`` with float64 accumulation of the mean; an integer
+        type, for integer data, such as ``np.int32`` for ``np.int16`` data,
+        gives exact sums of squares (see ``check_working_dtype``).
+    chunk_size : None or int, optional
+        Number of differences to calculate per block of volumes. None
+        calculates all differences at once.
 
     Returns
     -------
@@ -50,25 +89,51 @@ def calc_image_dvars(img):
         1D array with root mean square difference values between each volume
         and the following volume
     """
-    data = img.get_data()
-    # For each voxel, calculate the differences between each volume and the one
-    # following;
-    diff = data[:,:,:,1:]-data[:,:,:,:-1]
-    # Square the differences;
-    diff_sq = diff**2
-    # Sum over voxels for each volume, and divide by the number of voxels;
-    dvars_sq = diff_sq.mean(axis=(0,1,2))
+    if data is None:
+        data = image_loader.image_data(img)
+    check_working_dtype(data.dtype, dtype)
+    exact = np.dtype(dtype).kind in 'iu'
+
+    def block_dvars_sq(block, first, n):
+        # For each voxel, calculate the differences between each volume and
+        # the one following;
+        diff = block[..., first + 1:first + n + 1] - block[..., first:first + n]
+        if exact:
+            # Square the differences and sum over voxels in int64, without
+            # making an int64 copy of the differences; divide by the number
+            # of voxels.
+            sum_sq = np.einsum('ijkt,ijkt->t', diff, diff, dtype=np.int64)
+            return sum_sq / float(np.prod(diff.shape[:3]))
+        # Square the differences;
+        diff **= 2
+        # Sum over voxels for each volume, and divide by the number of voxels;
+        return diff.mean(axis=(0, 1, 2), dtype=np.float64)
+
+    # Each difference needs the following volume too
+    dvars_sq = image_loader.map_time_blocks(
+        block_dvars_sq, data, max(data.shape[-1] - 1, 0), chunk_size,
+        after=1, dtype=dtype)
     # Return the square root of these values.
     dvars = dvars_sq**0.5
-    #raise RuntimeError('No code yet')
     return dvars
 
 
 def main():
-    # Get the first command line argument
-    filename = sys.argv[1]
-    img = nib.load(filename)
-    print(calc_image_dvars(img))
+    # Get the filename and working precision from the command line arguments
+    parser = argparse.ArgumentParser(
+        description='Print DVARS values for 4D image')
+    parser.add_argument('filename', help='4D image file')
+    parser.add_argument('--dtype', default='float64',
+                        help='Working precision: float64, float32, or, for '
+                        'integer images, an integer type such as int32 '
+                        '(default %(default)s)')
+    args = parser.parse_args()
+    img = image_loader.load_image(args.filename)
+    try:
+        dvars = calc_image_dvars(img, dtype=np.dtype(args.dtype))
+    except (TypeError, ValueError) as err:
+        parser.error(str(err))
+    print(dvars)
 
 
 if __name__ == '__main__':
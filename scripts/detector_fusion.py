@@ -0,0 +1,123 @@
+""" Combine outlier volumes from several detectors
+
+Each detector's outliers are turned into a boolean mask over volumes. Masks
+are widened (dilated) by a tolerance, so detectors that flag neighboring
+volumes still agree, and then combined by voting:
+
+* with an anchor detector (the default), a volume is an outlier if the anchor
+  flags it and at least `votes` of the other detectors flag it or a volume
+  within `tolerance` of it;
+* without an anchor, a volume is an outlier if some detector flags it and at
+  least `votes` detectors flag it or a volume within `tolerance` of it.
+
+The tolerance only decides whether detectors agree; volumes no detector
+flagged are never outliers of the combination.
+
+`votes` can be 'all' (AND), 'any' (OR) or a number (k of n).
+"""
+
+import numpy as np
+
+
+def outlier_mask(outliers, n_vols):
+    """ Boolean mask of length `n_vols`, True at indices `outliers`
+
+    Parameters
+    ----------
+    outliers : sequence of int
+        Outlier volume indices.
+    n_vols : int
+        Number of volumes.
+
+    Returns
+    -------
+    mask : boolean array shape (n_vols,)
+    """
+    mask = np.zeros(n_vols, dtype=bool)
+    mask[np.asarray(outliers, dtype=int)] = True
+    return mask
+
+
+def dilate_mask(mask, tolerance):
+    """ True where `mask` is True within `tolerance` volumes
+
+    Parameters
+    ----------
+    mask : boolean array
+        Mask over volumes.
+    tolerance : int
+        Number of volumes either side.
+
+    Returns
+    -------
+    dilated : boolean array, same shape as `mask`
+    """
+    dilated = mask.copy()
+    for shift in range(1, tolerance + 1):
+        dilated[shift:] |= mask[:-shift]
+        dilated[:-shift] |= mask[shift:]
+    return dilated
+
+
+def fuse_masks(masks, votes='all', tolerance=1, anchor=True):
+    """ Combine detector outlier masks by voting
+
+    Parameters
+    ----------
+    masks : sequence of boolean arrays
+        Outlier mask for each detector, all the same length.
+    votes : {'all', 'any'} or int, optional
+        Number of detectors (other than the anchor) that have to agree.
+    tolerance : int, optional
+        Detectors agree if their outliers are within this many volumes.
+    anchor : bool, optional
+        If True, the first mask is the anchor: only its outliers can be
+        outliers of the combination, and they are not dilated. Otherwise,
+        only volumes flagged by some detector can be outliers.
+
+    Returns
+    -------
+    fused : boolean array
+        Combined outlier mask.
+    """
+    masks = [np.asarray(mask, dtype=bool) for mask in masks]
+    voters = masks[1:] if anchor else masks
+    if votes == 'all':
+        votes = len(voters)
+    elif votes == 'any':
+        votes = 1 if voters else 0
+    n_votes = np.zeros(len(masks[0]), dtype=int)
+    for mask in voters:
+        n_votes += dilate_mask(mask, tolerance)
+    fused = n_votes >= votes
+    if anchor:
+        fused &= masks[0]
+    else:
+        fused &= np.any(masks, axis=0)
+    return fused
+
+
+def fuse_outliers(outlier_lists, votes='all', tolerance=1, anchor=True,
+                  n_vols=None):
+    """ Combine lists of outlier volume indices from several detectors
+
+    Parameters
+    ----------
+    outlier_lists : sequence of sequences of int
+        Outlier volume indices for each detector.
+    votes, tolerance, anchor
+        See ``fuse_masks``.
+    n_vols : None or int, optional
+        Number of volumes. If None, use enough volumes to cover all outliers.
+
+    Returns
+    -------
+    outliers : list
+        Combined outlier volume indices.
+    """
+    if n_vols is None:
+        n_vols = max([max(outliers) + 1 for outliers in outlier_lists
+                      if len(outliers)] + [0])
+    masks = [outlier_mask(outliers, n_vols) for outliers in outlier_lists]
+    return np.flatnonzero(fuse_masks(masks, votes, tolerance,
+                                     anchor)).tolist()
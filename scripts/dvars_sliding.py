@@ -9,13 +9,13 @@ Produces plot of dvars over volumes
 
 import sys
 import numpy as np
-import nibabel as nib
+import image_loader
 import matplotlib.pyplot as plt
 import seaborn as sns
 
 sns.set()
 
-def calc_sliding_dvars(img, win, data = None):
+def calc_sliding_dvars(img, win, data = None, chunk_size = None):
     """
     Root mean squared difference between volumes in `img` over a sliding
     window.
@@ -29,8 +29,12 @@ def calc_sliding_dvars(img, win, data = None):
     win : int
         Size of sliding window.
 
-    data = None : will extract data from img.get_data() if data==None; otherwise
-        can use func with numpy array (without img file)
+    data = None : will get (memory-mapped) data from img if data==None;
+        otherwise can use func with numpy array (without img file)
+
+    chunk_size = None : number of dvars values to calculate per block of
+        volumes (each block also reads the 2 * win volumes around it). None
+        calculates all values in one pass over the volumes.
 
     Output
     ------
@@ -40,23 +44,55 @@ def calc_sliding_dvars(img, win, data = None):
         first (win) and last (win) volumes are lost.
     """
     if data is None:
-        data = img.get_data()
+        data = image_loader.image_data(img)
+
+    if chunk_size is not None:
+        # Value i is for volume i + win, which needs volumes i to i + 2 * win
+        def block_dvars(block, first, n):
+            return calc_sliding_dvars(None, win, block)[first:first + n]
+        return image_loader.map_time_blocks(block_dvars, data,
+                                            max(data.shape[3] - win, 0),
+                                            chunk_size, after=2 * win)
 
     # For each voxel, calculate the differences between each volume and the
-    # average of the win volumes around it
-    diff = []
-    for i in range(data.shape[3]-win):
+    # average of the win volumes before it and the (up to) win volumes after
+    # it. Rather than re-averaging the neighbors for every volume, keep a
+    # running sum of the window and update it as the window slides: one volume
+    # enters and one leaves each side, so the cost does not depend on win.
+    n_vols = data.shape[3]
+    n_out = max(n_vols - win, 0)
+    dvars_sq = np.zeros(n_out)
+    if n_out == 0:
+        return dvars_sq
+
+    def volume(i):
+        return image_loader.as_working(data[..., i], np.float64)
+
+    # Window sum for the first volume (vol = win)
+    win_sum = np.zeros(data.shape[:3])
+    for i in range(0, win):
+        win_sum += volume(i)
+    for i in range(win + 1, min(2 * win + 1, n_vols)):
+        win_sum += volume(i)
+
+    current = volume(win)
+    for i in range(n_out):
         vol = i + win
+        # Volumes after the last ones are missing, so the future part of the
+        # window is shorter at the end of the run
+        n_win = win + min(win, n_vols - 1 - vol)
+        diff = current - win_sum / n_win
+        dvars_sq[i] = np.mean(diff ** 2)
+        if vol + 1 == n_vols:
+            break
+        # Slide window: vol moves into the past, vol + 1 becomes the current
+        # volume, vol - win leaves the past and vol + win + 1 enters the future
+        following = volume(vol + 1)
+        win_sum += current - following - volume(vol - win)
+        if vol + win + 1 < n_vols:
+            win_sum += volume(vol + win + 1)
+        current = following
 
-        # Find avg of volumes around current volume
-        win_vols = np.concatenate((data[..., vol-win:vol],
-            data[..., vol+1:vol+win+1]), axis=3)
-        win_avg = np.mean(win_vols, axis=3)
-
-        diff.append(data[..., vol] - win_avg)
-
-    diff_sq = np.array(diff)**2
-    dvars_sq = diff_sq.mean(axis=(1, 2, 3))
     dvars = dvars_sq**0.5
 
     return dvars
@@ -66,7 +102,7 @@ def main():
     # Get the first command line argument
     filename = sys.argv[1]
     win = sys.argv[2]
-    img = nib.load(filename)
+    img = image_loader.load_image(filename)
     dvars = calc_sliding_dvars(img, int(win))
     plt.plot(dvars)
 
@@ -3,63 +3,1018 @@
 Run as:
 
     python3 scripts/find_outliers.py data
+
+To process several images at the same time, give the number of worker
+processes with ``--jobs``:
+
+    python3 scripts/find_outliers.py data --jobs 8
+
+To keep the per-image metrics, so that re-running with different outlier
+thresholds (see ``--help``) does not have to read the images again:
+
+    python3 scripts/find_outliers.py data --cache metric_cache --com-iqr 2.5
+
+To save the mean brain template for each image, so that re-running does not
+need a pass over the image to make the template:
+
+    python3 scripts/find_outliers.py data --templates templates
+
+To find which stages of the processing take the time and memory:
+
+    python3 scripts/find_outliers.py data --profile trace.jsonl
 """
 import os
 import sys
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 sys.path.append("scripts/")
 
 import calc_centerofmass as com
+import calc_dvars
 import outliers_mean_brain as mb
-import nibabel as nib
+import image_loader
+import metric_cache
+import results_store
+import detector_fusion
+import fused_metrics
+import mean_template
+import stage_profile
+import run_scheduler
+import prescan
+from stage_profile import stage
 import numpy as np
 
-def find_outliers(data_directory):
-    """ Print filenames and outlier indices for images in `data_directory`.
+# Registry of outlier detectors, name -> Detector. See ``register_detector``.
+DETECTORS = {}
 
-    Print filenames and detected outlier indices to the terminal.
+# Detectors run by default. With the default fusion settings, outliers of the
+# first detector are reported when all the other detectors agree (within +/- 1
+# volume).
+DEFAULT_DETECTORS = ('mean', 'com')
+
+# How detector outliers are combined, see ``detector_fusion.fuse_masks``
+DEFAULT_FUSION = {
+    # number of detectors that have to agree: 'all', 'any' or a number
+    'votes': 'all',
+    # detectors agree if their outliers are within this many volumes
+    'tolerance': 1,
+    # only outliers of the first detector can be reported
+    'anchor': True,
+}
+
+# Thresholds for deciding outliers from the detector metrics
+DEFAULT_THRESHOLDS = {
+    # center of mass sliding DVARS, IQRs outside the quartiles
+    'com_iqr': 3,
+    # slice projection on mean brain, IQRs below the first quartile
+    'slice_iqr': 1.5,
+    # volume is bad if more than this fraction of its slices are outliers
+    'slice_fraction': 0.25,
+    # DVARS, IQRs above the third quartile
+    'dvars_iqr': 3,
+}
+
+# How the mean brain templates for projections are made, see
+# ``mean_template``
+DEFAULT_TEMPLATES = {
+    # directory to save templates in and reuse them from; None to not save
+    'directory': None,
+    # average every `stride`-th volume only
+    'stride': 1,
+    # average over all runs for the subject (needs a template directory)
+    'subject': False,
+}
+
+# Slice direction -> axis number
+AXES = {'x':0, 'y':1, 'z':2}
+
+Detector = namedtuple('Detector', ['metrics', 'outliers', 'params', 'columns',
+                                   'from_fused'])
+
+
+def register_detector(name, metrics, outliers, params=None, columns=None,
+                      from_fused=None):
+    """ Add detector to the registry of outlier detectors under `name`.
+
+    A detector has two steps: computing metrics from the image data, and
+    deciding outliers from the metrics using the outlier thresholds. Metrics
+    only depend on the data and `params`, so they can be cached and reused
+    with different thresholds.
 
     Parameters
     ----------
-    data_directory : str
-        Directory containing containing images.
+    name : str
+        Name used to select the detector.
+    metrics : callable
+        Called as ``metrics(data, n_threads, **params)`` where `data` is the 4D
+        array for the run and `n_threads` is None or the number of threads
+        the detector can use; returns dict of metric name -> array.
+    outliers : callable
+        Called as ``outliers(metrics, thresholds, n_threads, **params)`` where
+        `metrics` is the dict returned by `metrics` and `thresholds` is a dict
+        like ``DEFAULT_THRESHOLDS``; returns a list of outlier volume indices.
+    params : None or dict, optional
+        Parameters for the detector.
+    columns : None or callable, optional
+        Called as ``columns(metrics, thresholds, n_vols, n_threads,
+        **params)``; returns dict of column name -> array of one value per
+        volume, for the results store.
+    from_fused : None or callable, optional
+        Called as ``from_fused(fused, **params)`` where `fused` is the dict
+        returned by ``fused_metrics.fused_metrics``; returns the same metrics
+        as `metrics`. Detectors with `from_fused` share a single pass over the
+        data. If `params` has an ``ax`` entry (or ``axes``, a string of
+        several), the fused pass includes projections on the mean brain for
+        slices along that axis.
+    """
+    DETECTORS[name] = Detector(metrics, outliers,
+                               {} if params is None else params, columns,
+                               from_fused)
+
+
+def detector_axes(params):
+    """ Slice axis numbers for detector `params` with ``ax`` or ``axes``
+    """
+    return [AXES[ax] for ax in params.get('axes', params.get('ax', ''))]
+
+
+def volume_column(values, first_vol, n_vols):
+    """ Array of length `n_vols`, `values` from `first_vol`, NaN elsewhere
+    """
+    column = np.full(n_vols, np.nan)
+    column[first_vol:first_vol + len(values)] = values
+    return column
+
+
+def com_metrics(data, n_threads, window):
+    """ Sliding DVARS over center of mass coordinates
+    """
+    data_com = com.calc_image_COM(None, data)
+    return {'com_dvars': com.calc_com_dvars(data_com, window)}
+
+
+def com_from_fused(fused, window):
+    """ Sliding DVARS over center of mass coordinates, from fused metrics
+    """
+    return {'com_dvars': com.calc_com_dvars(fused['com'], window)}
+
+
+def com_outliers(metrics, thresholds, n_threads, window):
+    """ Volumes with center of mass DVARS outside the quartiles
+    """
+    mask = com.com_outlier_mask(metrics['com_dvars'], thresholds['com_iqr'])
+    # DVARS value i is for volume i + window
+    return [int(i) + window for i in np.flatnonzero(mask)]
+
+
+def com_columns(metrics, thresholds, n_vols, n_threads, window):
+    """ Center of mass DVARS for each volume
+    """
+    return {'com_dvars': volume_column(metrics['com_dvars'], window, n_vols)}
+
+
+def mean_metrics(data, n_threads, ax):
+    """ Projection of each slice on the thresholded mean brain
+    """
+    ax_number = AXES[ax]
+    mean_brain, threshold = mb.mean_img(data, ax_number, n_threads=n_threads)
+    return {'projections': mb.projection_on_mean(data, mean_brain, ax_number,
+                                                 n_threads=n_threads)}
+
+
+def mean_from_fused(fused, ax):
+    """ Projection of each slice on the mean brain, from fused metrics
+    """
+    return {'projections': fused['projections'][AXES[ax]]}
+
+
+def mean_outliers(metrics, thresholds, n_threads, ax):
+    """ Volumes with many slices projecting badly on the mean brain
+    """
+    return mb.find_bad_volumes(metrics['projections'],
+                               thresholds['slice_iqr'],
+                               thresholds['slice_fraction'], n_threads)
+
+
+def mean_columns(metrics, thresholds, n_vols, n_threads, ax):
+    """ Number of outlier slices in each volume
+    """
+    outliers, n_outliers = mb.find_outlier_volumes(metrics['projections'],
+                                                   thresholds['slice_iqr'],
+                                                   n_threads=n_threads)
+    return {'n_outlier_slices': n_outliers}
+
+
+def mean_axes_metrics(data, n_threads, axes):
+    """ Projection of slices along each of `axes` on the thresholded mean brain
+
+    The mean brain is computed once, and the projections for all axes are
+    made in one pass over the data.
+    """
+    mean_volume = mb.mean_volume(data, n_threads=n_threads)
+    mean_brains = dict((AXES[ax],
+                        mb.threshold_mean(mean_volume, AXES[ax], n_threads)[0])
+                       for ax in axes)
+    projections = mb.projections_on_means(data, mean_brains,
+                                          n_threads=n_threads)
+    return dict(('projections_' + ax, projections[AXES[ax]]) for ax in axes)
+
+
+def mean_axes_from_fused(fused, axes):
+    """ Projections of slices along each of `axes`, from fused metrics
+    """
+    return dict(('projections_' + ax, fused['projections'][AXES[ax]])
+                for ax in axes)
+
+
+def mean_axes_outliers(metrics, thresholds, n_threads, axes):
+    """ Volumes with many slices along any of `axes` projecting badly
+    """
+    outliers = set()
+    for ax in axes:
+        outliers.update(mb.find_bad_volumes(metrics['projections_' + ax],
+                                            thresholds['slice_iqr'],
+                                            thresholds['slice_fraction'],
+                                            n_threads))
+    return sorted(outliers)
+
+
+def mean_axes_columns(metrics, thresholds, n_vols, n_threads, axes):
+    """ Number of outlier slices in each volume, for each of `axes`
+    """
+    columns = {}
+    for ax in axes:
+        outliers, n_outliers = mb.find_outlier_volumes(
+            metrics['projections_' + ax], thresholds['slice_iqr'],
+            n_threads=n_threads)
+        columns['n_outlier_slices_' + ax] = n_outliers
+    return columns
+
+
+def dvars_metrics(data, n_threads):
+    """ DVARS between each volume and the next
+    """
+    return {'dvars': calc_dvars.calc_image_dvars(None, data)}
+
+
+def dvars_from_fused(fused):
+    """ DVARS between each volume and the next, from fused metrics
+    """
+    return {'dvars': fused['dvars']}
+
+
+def dvars_outliers(metrics, thresholds, n_threads):
+    """ Volumes with DVARS far above the third quartile
+    """
+    dvars = metrics['dvars']
+    q1, q3 = np.percentile(dvars, [25, 75])
+    high = q3 + thresholds['dvars_iqr'] * (q3 - q1)
+    # DVARS value i is the difference between volumes i and i + 1
+    return [int(i) + 1 for i in np.flatnonzero(dvars > high)]
+
+
+def dvars_columns(metrics, thresholds, n_vols, n_threads):
+    """ DVARS between each volume and the one before
+    """
+    return {'dvars': volume_column(metrics['dvars'], 1, n_vols)}
+
+
+register_detector('com', com_metrics, com_outliers, {'window': 1},
+                  com_columns, com_from_fused)
+register_detector('mean', mean_metrics, mean_outliers, {'ax': 'z'},
+                  mean_columns, mean_from_fused)
+register_detector('mean_xyz', mean_axes_metrics, mean_axes_outliers,
+                  {'axes': 'xyz'}, mean_axes_columns, mean_axes_from_fused)
+register_detector('dvars', dvars_metrics, dvars_outliers, None,
+                  dvars_columns, dvars_from_fused)
+
+
+def template_settings(templates=None):
+    """ Return ``DEFAULT_TEMPLATES`` updated with `templates`
+    """
+    settings = dict(DEFAULT_TEMPLATES)
+    settings.update({} if templates is None else templates)
+    return settings
+
+
+def metric_params(name, templates=None, source_hashes=None):
+    """ Parameters the metrics of detector `name` depend on, for cache keys
+
+    Parameters
+    ----------
+    name : str
+        Name of registered detector.
+    templates : None or dict, optional
+        Template settings to use instead of those in ``DEFAULT_TEMPLATES``.
+    source_hashes : None or sequence of str, optional
+        SHA1 hashes of the runs averaged into the subject template, with
+        subject templates.
 
     Returns
     -------
-    None
+    params : dict or None
+        Detector parameters, with the template settings that change the
+        template for detectors projecting on the mean brain (if not the
+        defaults). None if the metrics cannot be cached, because they
+        project on a subject template and `source_hashes` is None.
     """
-    data_names = [f for f in os.listdir(data_directory) if f[-4:]==".nii"]
+    params = dict(DETECTORS[name].params)
+    if detector_axes(params):
+        settings = template_settings(templates)
+        for key in ('stride', 'subject'):
+            if settings[key] != DEFAULT_TEMPLATES[key]:
+                params['template_' + key] = settings[key]
+        if settings['subject']:
+            # The template, and so the metrics, change with any of the runs
+            if source_hashes is None:
+                return None
+            params['template_sources'] = sorted(source_hashes)
+    return params
 
 
-    for filename in data_names:
-        # Use center of mass method
-        img = nib.load(data_directory+'/'+filename, mmap=False)
-        data_com = com.calc_image_COM(img)
-        outliers_com = com.get_outlier_coords(data_com, 1, filename, 0) #don't make plots
+def template_sources(path, templates=None):
+    """ Images the template for image `path` is made from, if not just `path`
 
-        # Use mean method
-        outliers_mean = mb.mean_brain(data_directory+'/'+filename, 'z')
+    Parameters
+    ----------
+    path : str
+        Image filename.
+    templates : None or dict, optional
+        Template settings to use instead of those in ``DEFAULT_TEMPLATES``.
+
+    Returns
+    -------
+    sources : None or list
+        Filenames of all runs of the subject with subject templates (see
+        ``mean_template.subject_runs``), otherwise None.
+    """
+    if not template_settings(templates)['subject']:
+        return None
+    return mean_template.subject_runs(path)
 
-        # Get outliers picked up by both methods
-        outliers = []
-        for i in outliers_mean:
-            if i in outliers_com or i+1 in outliers_com or i-1 in outliers_com:
-                outliers.append(i)
 
-        #print(filename+' outlier volumes: ')
-        #print(outliers)
+def get_template(path, data, templates=None, n_threads=None):
+    """ Unthresholded mean brain for image `path` with `templates` settings
+
+    Parameters
+    ----------
+    path : str
+        Image filename.
+    data : 4D array
+        Image data.
+    templates : None or dict, optional
+        Template settings to use instead of those in ``DEFAULT_TEMPLATES``.
+    n_threads : None or int, optional
+        Number of threads for computing the template.
+
+    Returns
+    -------
+    template : 3D array
+        Mean volume, see ``outliers_mean_brain.mean_volume``.
+    """
+    settings = template_settings(templates)
+    if settings['directory'] is None:
+        return mb.mean_volume(data, stride=settings['stride'],
+                              n_threads=n_threads)
+    if settings['subject']:
+        return mean_template.subject_template(path, data, settings['stride'],
+                                              settings['directory'], n_threads)
+    return mean_template.run_template(path, data, settings['stride'],
+                                      settings['directory'], n_threads)
+
+
+def run_metrics(path, detectors=DEFAULT_DETECTORS, cache=None,
+                file_hash=None, fused=True, templates=None, profiler=None,
+                n_threads=None, source_hashes=None):
+    """ Compute metrics for `detectors` on image `path`, loading it once
+
+    Parameters
+    ----------
+    path : str
+        Image filename.
+    detectors : sequence of str, optional
+        Names of registered detectors.
+    cache : None or metric_cache.MetricCache, optional
+        Cache of metrics. Metrics found in the cache are not recomputed, and
+        the image is only opened if some metrics are missing.
+    file_hash : None or str, optional
+        SHA1 of image file, used as cache key. No caching if None.
+    fused : bool, optional
+        If True, compute the metrics of all detectors that support it in a
+        single pass over the data (after a pass for the mean brain, if
+        needed), see ``fused_metrics``.
+    templates : None or dict, optional
+        Settings for the mean brain templates of fused detectors, to use
+        instead of those in ``DEFAULT_TEMPLATES``. With a template directory,
+        saved templates replace the pass for the mean brain.
+    profiler : None or stage_profile.StageProfiler, optional
+        If not None, record each stage with this profiler.
+    n_threads : None or int, optional
+        Number of threads for the per-slice work: averaging and thresholding
+        the mean brain template, and the projections on it.
+    source_hashes : None or sequence of str, optional
+        SHA1 hashes of all runs of the subject, for caching metrics that
+        project on subject templates (see ``metric_params``). If None, these
+        metrics are not cached.
+
+    Returns
+    -------
+    metrics : dict
+        Detector name -> dict of metric arrays for that detector.
+    """
+    metrics = {}
+    keys = {}
+    if cache is not None and file_hash is not None:
+        with stage(profiler, 'cache_get'):
+            for name in detectors:
+                params = metric_params(name, templates, source_hashes)
+                if params is None:
+                    continue
+                keys[name] = cache.key(file_hash, name, params)
+                metrics[name] = cache.get(keys[name])
+    missing = [name for name in detectors if metrics.get(name) is None]
+    if not missing:
+        return metrics
+
+    # Load image once, shared by all detectors
+    with stage(profiler, 'load'):
+        data = image_loader.image_data(image_loader.load_image(path))
+    to_fuse = [name for name in missing
+               if fused and DETECTORS[name].from_fused is not None]
+    if to_fuse:
+        axes = set(ax for name in to_fuse
+                   for ax in detector_axes(DETECTORS[name].params))
+        thresholded = {}
+        if axes:
+            # One mean volume, thresholded for each slice axis
+            with stage(profiler, 'template'):
+                mean_volume = get_template(path, data, templates, n_threads)
+            with stage(profiler, 'threshold'):
+                for ax in axes:
+                    thresholded[ax] = mb.threshold_mean(mean_volume, ax,
+                                                        n_threads)[0]
+        with stage(profiler, 'fused_metrics'):
+            fused_values = fused_metrics.fused_metrics(data, thresholded,
+                                                       n_threads=n_threads)
+    for name in missing:
+        detector = DETECTORS[name]
+        with stage(profiler, 'metrics:' + name):
+            if name in to_fuse:
+                metrics[name] = detector.from_fused(fused_values,
+                                                    **detector.params)
+            else:
+                metrics[name] = detector.metrics(data, n_threads,
+                                                 **detector.params)
+        if name in keys:
+            with stage(profiler, 'cache_put'):
+                cache.put(keys[name], metrics[name])
+    return metrics
+
+
+def combine_outliers(results, detectors=DEFAULT_DETECTORS, fusion=None,
+                     n_vols=None):
+    """ Combine outliers from `detectors` according to `fusion` settings
+
+    Parameters
+    ----------
+    results : dict
+        Detector name -> outlier volume indices.
+    detectors : sequence of str, optional
+        Names of detectors to combine; the first is the anchor, if the fusion
+        settings use one.
+    fusion : None or dict, optional
+        Settings to use instead of those in ``DEFAULT_FUSION``.
+    n_vols : None or int, optional
+        Number of volumes in run.
+
+    Returns
+    -------
+    outliers : list
+        Combined outlier volume indices.
+    """
+    settings = dict(DEFAULT_FUSION)
+    settings.update({} if fusion is None else fusion)
+    return detector_fusion.fuse_outliers(
+        [results[name] for name in detectors], settings['votes'],
+        settings['tolerance'], settings['anchor'], n_vols)
+
+
+def run_report(path, detectors=DEFAULT_DETECTORS, thresholds=None,
+               cache=None, file_hash=None, columns=False, fusion=None,
+               templates=None, profile=False, n_threads=None, n_vols=None,
+               source_hashes=None):
+    """ Return outliers found by `detectors` in image at `path`, and details
+
+    Parameters
+    ----------
+    path : str
+        Image filename.
+    detectors : sequence of str, optional
+        Names of registered detectors.
+    thresholds : None or dict, optional
+        Outlier thresholds to use instead of those in ``DEFAULT_THRESHOLDS``.
+    cache : None or metric_cache.MetricCache, optional
+        Cache of metrics, see ``run_metrics``.
+    file_hash : None or str, optional
+        SHA1 of image file, for cache.
+    columns : bool, optional
+        If True, add per-volume metrics and flags to the report.
+    fusion : None or dict, optional
+        Settings for combining detector outliers, to use instead of those in
+        ``DEFAULT_FUSION``.
+    templates : None or dict, optional
+        Settings for mean brain templates, to use instead of those in
+        ``DEFAULT_TEMPLATES``.
+    profile : bool, optional
+        If True, record time, bytes read and memory for each stage (see
+        ``stage_profile``).
+    n_threads : None or int, optional
+        Number of threads for per-slice work, see ``run_metrics``, and for
+        the per-slice quartiles when deciding outliers.
+    n_vols : None or int, optional
+        Number of volumes in run (e.g. from ``prescan.scan_header``). None
+        reads it from the image header.
+    source_hashes : None or sequence of str, optional
+        SHA1 hashes of all runs of the subject, for the cache with subject
+        templates, see ``run_metrics``.
+
+    Returns
+    -------
+    report : dict
+        With key ``outliers`` (list of outlier volume indices),
+        ``detector_outliers`` (dict of detector name -> outlier list), if
+        `columns` is True, ``columns`` (dict of column name -> array of one
+        value per volume), and, if `profile` is True, ``profile`` (list of
+        stage records).
+    """
+    profiler = (stage_profile.StageProfiler(os.path.basename(path))
+                if profile else None)
+    all_thresholds = dict(DEFAULT_THRESHOLDS)
+    all_thresholds.update({} if thresholds is None else thresholds)
+    if n_vols is None:
+        n_vols = image_loader.load_image(path).shape[-1]
+    metrics = run_metrics(path, detectors, cache, file_hash,
+                          templates=templates, profiler=profiler,
+                          n_threads=n_threads, source_hashes=source_hashes)
+    results = {}
+    for name in detectors:
+        detector = DETECTORS[name]
+        with stage(profiler, 'outliers:' + name):
+            results[name] = detector.outliers(metrics[name], all_thresholds,
+                                              n_threads, **detector.params)
+    with stage(profiler, 'fusion'):
+        report = {'outliers': combine_outliers(results, detectors, fusion,
+                                               n_vols),
+                  'detector_outliers': results}
+    if columns:
+        with stage(profiler, 'columns'):
+            report['columns'] = run_columns(metrics, results,
+                                            report['outliers'],
+                                            all_thresholds, n_vols,
+                                            detectors, n_threads)
+    if profile:
+        report['profile'] = profiler.records
+    return report
+
+
+def run_columns(metrics, results, outliers, thresholds, n_vols,
+                detectors=DEFAULT_DETECTORS, n_threads=None):
+    """ Per-volume metrics and outlier flags for one run
+
+    Parameters
+    ----------
+    metrics : dict
+        Detector name -> metrics, from ``run_metrics``.
+    results : dict
+        Detector name -> outlier volume indices.
+    outliers : sequence
+        Final outlier volume indices.
+    thresholds : dict
+        Outlier thresholds.
+    n_vols : int
+        Number of volumes in run.
+    detectors : sequence of str, optional
+        Names of registered detectors.
+    n_threads : None or int, optional
+        Number of threads for the detector columns.
+
+    Returns
+    -------
+    columns : dict
+        Column name -> array with one value per volume.
+    """
+    columns = {'volume': np.arange(n_vols)}
+    for name in detectors:
+        detector = DETECTORS[name]
+        if detector.columns is not None:
+            columns.update(detector.columns(metrics[name], thresholds, n_vols,
+                                            n_threads, **detector.params))
+        columns['flag_' + name] = np.zeros(n_vols, dtype=bool)
+        columns['flag_' + name][results[name]] = True
+    columns['outlier'] = np.zeros(n_vols, dtype=bool)
+    columns['outlier'][outliers] = True
+    return columns
+
+
+def find_run_outliers(path, detectors=DEFAULT_DETECTORS, thresholds=None,
+                      cache=None, file_hash=None, fusion=None,
+                      templates=None):
+    """ Return outliers found by `detectors` in image at `path`
+
+    See ``run_report`` for parameters.
+
+    Returns
+    -------
+    outliers : list
+        Outlier volume indices.
+    """
+    return run_report(path, detectors, thresholds, cache, file_hash,
+                      fusion=fusion, templates=templates)['outliers']
+
+
+def checkpoint_settings(detectors=DEFAULT_DETECTORS, thresholds=None,
+                        fusion=None, templates=None):
+    """ Settings that outlier reports depend on, to check checkpoints
+    """
+    all_thresholds = dict(DEFAULT_THRESHOLDS)
+    all_thresholds.update({} if thresholds is None else thresholds)
+    all_fusion = dict(DEFAULT_FUSION)
+    all_fusion.update({} if fusion is None else fusion)
+    return {'detectors': list(detectors), 'thresholds': all_thresholds,
+            'fusion': all_fusion, 'templates': template_settings(templates)}
+
+
+def iter_run_reports(data_directory, detectors=DEFAULT_DETECTORS, jobs=1,
+                     thresholds=None, cache=None, columns=False,
+                     fusion=None, templates=None, profile=False,
+                     checkpoint=None, max_memory=None, n_threads=None):
+    """ Yield filename and report (see ``run_report``) for images in directory
+
+    The headers of all images are checked first (see ``prescan``); images
+    that cannot be processed are reported without reading their data.
+
+    Images are yielded in filename order. With ``jobs > 1`` the images are
+    processed in a pool of `jobs` worker processes, and at most `jobs` images
+    are in flight at any time, so memory use stays at around `jobs` images.
+    The images are scheduled by subject, largest first, over `jobs` logical
+    workers that steal whole subjects from each other when idle (see
+    ``run_scheduler``).
+
+    Parameters
+    ----------
+    data_directory : str
+        Directory containing containing images.
+    detectors : sequence of str, optional
+        Names of registered detectors to run on each image.
+    jobs : int, optional
+        Number of worker processes. 1 means process images in this process.
+    thresholds : None or dict, optional
+        Outlier thresholds to use instead of those in ``DEFAULT_THRESHOLDS``.
+    cache : None or metric_cache.MetricCache, optional
+        Cache of metrics for each image, keyed by the image hash in
+        ``data_hashes.txt``. Images without a recorded hash are not cached.
+    columns : bool, optional
+        If True, reports include per-volume columns.
+    fusion : None or dict, optional
+        Settings for combining detector outliers, to use instead of those in
+        ``DEFAULT_FUSION``.
+    templates : None or dict, optional
+        Settings for mean brain templates, to use instead of those in
+        ``DEFAULT_TEMPLATES``.
+    profile : bool, optional
+        If True, reports include stage records (see ``run_report``), recorded
+        in the process that handled the image.
+    checkpoint : None or str, optional
+        If not None, checkpoint filename. Reports for images finished with the
+        same settings in an earlier sweep are read from the checkpoint instead
+        of processing the images again; these reports only have ``outliers``
+        and ``detector_outliers`` keys. Reports for newly finished images are
+        added to the checkpoint when the caller asks for the next report,
+        after it has handled this one.
+    max_memory : None or int, optional
+        With ``jobs > 1``, only start an image if the estimated working memory
+        (see ``prescan.working_bytes``) of the images in flight stays below
+        this many bytes. At least one image is always in flight.
+    n_threads : None or int, optional
+        Number of threads for per-slice work on each image. None shares the
+        CPUs between the `jobs` processes: ``cpu_count // jobs`` threads each.
+
+    Yields
+    ------
+    filename : str
+        Image filename within `data_directory`.
+    report : dict
+        Report for this image, see ``run_report``. For images that cannot be
+        processed, the report only has a ``problem`` key, with a message
+        saying what is wrong.
+    """
+    manifest = prescan.scan_directory(data_directory)
+    data_names = [os.path.basename(entry.path) for entry in manifest]
+    paths = [entry.path for entry in manifest]
+    hashes = ({} if cache is None else
+              metric_cache.read_data_hashes(data_directory))
+
+    if n_threads is None:
+        n_threads = max((os.cpu_count() or 1) // jobs, 1)
+
+    # With subject templates, reports also depend on the other runs of the
+    # subject
+    sources = [template_sources(path, templates) for path in paths]
+
+    def source_hashes(i):
+        if sources[i] is None:
+            return None
+        run_hashes = [hashes.get(os.path.basename(source))
+                      for source in sources[i]]
+        return None if None in run_hashes else run_hashes
+
+    def run_args(i):
+        return (paths[i], detectors, thresholds, cache,
+                hashes.get(data_names[i]), columns, fusion, templates,
+                profile, n_threads, manifest[i].shape[-1], source_hashes(i))
+
+    done_results = {} # image index -> report, waiting to be yielded
+    checkpoint_file = None
+    if checkpoint is not None:
+        settings = checkpoint_settings(detectors, thresholds, fusion,
+                                       templates)
+        done_results = run_scheduler.finished_reports(checkpoint, settings,
+                                                      paths, sources)
+        checkpoint_file = run_scheduler.open_checkpoint(checkpoint)
+    # Malformed images are rejected from their headers, even if their
+    # metrics are cached, as later stages need the header
+    for i, entry in enumerate(manifest):
+        if entry.problem is not None:
+            done_results[i] = {'problem': entry.problem}
+
+    new_runs = set() # images run in this sweep, not yet checkpointed
+
+    def finish(i, report):
+        new_runs.add(i)
+        done_results[i] = report
+
+    def handled(i, report):
+        # Only checkpoint an image once the caller has handled its report
+        # (for example, written it to the store), so that a resumed sweep
+        # never skips an image the caller did not see
+        if checkpoint_file is not None and i in new_runs:
+            run_scheduler.append_checkpoint(checkpoint_file, paths[i], report,
+                                            settings, sources[i])
+        new_runs.discard(i)
+
+    try:
+        if jobs == 1:
+            for i, filename in enumerate(data_names):
+                if i not in done_results:
+                    finish(i, run_report(*run_args(i)))
+                report = done_results.pop(i)
+                yield filename, report
+                handled(i, report)
+            return
+
+        to_run = [i for i in range(len(paths)) if i not in done_results]
+        sizes = dict((i, manifest[i].nbytes) for i in to_run)
+        batches = run_scheduler.subject_batches(
+            [paths[i] for i in to_run], [sizes[i] for i in to_run])
+        queues = run_scheduler.WorkQueues(jobs)
+        # Batches have indices into to_run
+        queues.assign([[to_run[j] for j in batch] for batch in batches],
+                      sizes)
+        with ProcessPoolExecutor(jobs) as pool:
+            pending = {} # logical worker -> (image index, future)
+            next_yield = 0
+            while next_yield < len(paths):
+                # Each idle logical worker takes its next image, if there is
+                # memory for it
+                for worker in range(jobs):
+                    if worker in pending:
+                        continue
+                    i = queues.peek(worker)
+                    if i is None:
+                        continue
+                    if max_memory is not None and pending:
+                        in_flight = sum(prescan.working_bytes(manifest[j])
+                                        for j, future in pending.values())
+                        if (in_flight + prescan.working_bytes(manifest[i]) >
+                            max_memory):
+                            break
+                    queues.pop(worker)
+                    pending[worker] = (i, pool.submit(run_report,
+                                                      *run_args(i)))
+                if pending:
+                    done, _ = wait([future for i, future in pending.values()],
+                                   return_when=FIRST_COMPLETED)
+                    for worker, (i, future) in list(pending.items()):
+                        if future in done:
+                            del pending[worker]
+                            finish(i, future.result())
+                # Yield in filename order, as soon as earlier images are done
+                while next_yield in done_results:
+                    report = done_results.pop(next_yield)
+                    yield data_names[next_yield], report
+                    handled(next_yield, report)
+                    next_yield += 1
+    finally:
+        if checkpoint_file is not None:
+            checkpoint_file.close()
+
+
+def iter_run_outliers(data_directory, detectors=DEFAULT_DETECTORS, jobs=1,
+                      thresholds=None, cache=None, fusion=None,
+                      templates=None):
+    """ Yield filename and outlier indices for images in `data_directory`
+
+    See ``iter_run_reports`` for parameters.
+
+    Images that cannot be processed (see ``prescan``) are skipped.
+
+    Yields
+    ------
+    filename : str
+        Image filename within `data_directory`.
+    outliers : list
+        Outlier volume indices for this image.
+    """
+    for filename, report in iter_run_reports(data_directory, detectors, jobs,
+                                             thresholds, cache, False, fusion,
+                                             templates):
+        if 'problem' not in report:
+            yield filename, report['outliers']
+
+
+def find_outliers(data_directory, detectors=DEFAULT_DETECTORS, jobs=1,
+                  thresholds=None, cache=None, store=None, fusion=None,
+                  templates=None, profile=None, checkpoint=None,
+                  max_memory=None, n_threads=None):
+    """ Print filenames and outlier indices for images in `data_directory`.
+
+    Print filenames and detected outlier indices to the terminal.
+
+    Parameters
+    ----------
+    data_directory : str
+        Directory containing containing images.
+    detectors : sequence of str, optional
+        Names of registered detectors to run on each image.
+    jobs : int, optional
+        Number of worker processes to use.
+    thresholds : None or dict, optional
+        Outlier thresholds to use instead of those in ``DEFAULT_THRESHOLDS``.
+    cache : None or metric_cache.MetricCache, optional
+        Cache of metrics for each image.
+    store : None or str, optional
+        If not None, directory of results store (see ``results_store``) to
+        write per-volume metrics and flags for each image.
+    fusion : None or dict, optional
+        Settings for combining detector outliers, to use instead of those in
+        ``DEFAULT_FUSION``.
+    templates : None or dict, optional
+        Settings for mean brain templates, to use instead of those in
+        ``DEFAULT_TEMPLATES``.
+    profile : None or str, optional
+        If not None, filename to write stage records for each image to, as
+        JSON lines (see ``stage_profile``). A summary table of the stages is
+        printed to stderr.
+    checkpoint : None or str, optional
+        If not None, checkpoint filename, to resume an interrupted sweep (see
+        ``iter_run_reports``). Images already finished are not written to the
+        results store again.
+    max_memory : None or int, optional
+        Limit in bytes on estimated working memory of images in flight, see
+        ``iter_run_reports``.
+    n_threads : None or int, optional
+        Number of threads per image, see ``iter_run_reports``.
+
+    Returns
+    -------
+    None
+    """
+    records = []
+    for filename, report in iter_run_reports(data_directory, detectors, jobs,
+                                             thresholds, cache,
+                                             store is not None, fusion,
+                                             templates, profile is not None,
+                                             checkpoint, max_memory,
+                                             n_threads):
+        if 'problem' in report:
+            print('Skipping {0}: {1}'.format(filename, report['problem']),
+                  file=sys.stderr)
+            continue
+        outliers = report['outliers']
+        # Images from the checkpoint have no columns; they are in the store
+        # from the earlier sweep
+        if store is not None and 'columns' in report:
+            results_store.write_run(store, filename, report['columns'],
+                                    outliers)
+        if profile is not None:
+            records += report.get('profile', [])
         print(filename, ', '.join([str(i) for i in outliers]))
+    if profile is not None:
+        with open(profile, 'wt') as fobj:
+            stage_profile.write_records(fobj, records)
+        print(stage_profile.format_summary(records), file=sys.stderr)
 
 
 def main():
     # This function (main) called when this file run as a script.
     #
     # Get the data directory from the command line arguments
-    if len(sys.argv) < 2:
-        raise RuntimeError("Please give data directory on "
-                           "command line")
-    data_directory = sys.argv[1]
-    # Call function to validate data in data directory
-    find_outliers(data_directory)
+    parser = argparse.ArgumentParser(
+        description='Print outlier volumes for images in data directory')
+    parser.add_argument('data_directory',
+                        help='Directory containing images')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of images to process in parallel')
+    parser.add_argument('--cache',
+                        help='Directory for cache of per-image metrics')
+    parser.add_argument('--store',
+                        help='Directory to store per-volume metrics and flags')
+    parser.add_argument('--cache-size', type=float, default=1024,
+                        help='Maximum size of metric cache in MB')
+    for name, value in sorted(DEFAULT_THRESHOLDS.items()):
+        parser.add_argument('--' + name.replace('_', '-'), type=float,
+                            default=value,
+                            help='Outlier threshold (default %(default)s)')
+    parser.add_argument('--detectors', default=','.join(DEFAULT_DETECTORS),
+                        help='Comma separated detectors to combine; one or '
+                        'more of ' + ', '.join(sorted(DETECTORS)) +
+                        ' (default %(default)s)')
+    parser.add_argument('--votes', default=DEFAULT_FUSION['votes'],
+                        help="Number of detectors that have to agree: 'all', "
+                        "'any' or a number (default %(default)s)")
+    parser.add_argument('--tolerance', type=int,
+                        default=DEFAULT_FUSION['tolerance'],
+                        help='Detectors agree if their outliers are within '
+                        'this many volumes (default %(default)s)')
+    parser.add_argument('--no-anchor', action='store_true',
+                        help='Vote over all detectors, rather than confirming '
+                        'outliers of the first detector')
+    parser.add_argument('--templates',
+                        help='Directory to save mean brain templates in and '
+                        'reuse them from; can be the data directory')
+    parser.add_argument('--template-stride', type=int,
+                        default=DEFAULT_TEMPLATES['stride'],
+                        help='Make mean brain templates from every '
+                        'TEMPLATE_STRIDE-th volume (default %(default)s)')
+    parser.add_argument('--subject-templates', action='store_true',
+                        help='Use mean brain templates over all runs of each '
+                        'subject; needs --templates')
+    parser.add_argument('--profile', metavar='TRACE',
+                        help='Write time, bytes read and peak memory for '
+                        'each stage of each image to TRACE (JSON lines), and '
+                        'print a summary')
+    parser.add_argument('--checkpoint',
+                        help='File recording finished images, to resume an '
+                        'interrupted run where it stopped')
+    parser.add_argument('--max-memory', type=float,
+                        help='With --jobs, only start images while the '
+                        'estimated working memory of images in progress is '
+                        'below this many MB')
+    parser.add_argument('--threads', type=int,
+                        help='Number of threads for each image (default: '
+                        'number of CPUs divided by --jobs)')
+    args = parser.parse_args()
+    detectors = tuple(args.detectors.split(','))
+    for name in detectors:
+        if name not in DETECTORS:
+            parser.error('Unknown detector ' + name)
+    votes = args.votes
+    if votes not in ('all', 'any'):
+        try:
+            votes = int(votes)
+        except ValueError:
+            parser.error("--votes should be 'all', 'any' or a number")
+        n_voters = len(detectors) - (0 if args.no_anchor else 1)
+        if not 1 <= votes <= n_voters:
+            parser.error('--votes should be from 1 to {0}, the number of '
+                         'voting detectors'.format(n_voters))
+    fusion = {'votes': votes, 'tolerance': args.tolerance,
+              'anchor': not args.no_anchor}
+    if args.template_stride < 1:
+        parser.error('--template-stride should be 1 or more')
+    if args.subject_templates and args.templates is None:
+        parser.error('--subject-templates needs --templates')
+    templates = {'directory': args.templates,
+                 'stride': args.template_stride,
+                 'subject': args.subject_templates}
+    max_memory = None
+    if args.max_memory is not None:
+        max_memory = int(args.max_memory * 2 ** 20)
+    if args.threads is not None and args.threads < 1:
+        parser.error('--threads should be 1 or more')
+    if args.jobs < 1:
+        parser.error('--jobs should be 1 or more')
+    thresholds = dict((name, getattr(args, name))
+                      for name in DEFAULT_THRESHOLDS)
+    cache = None
+    if args.cache is not None:
+        cache = metric_cache.MetricCache(args.cache,
+                                         int(args.cache_size * 2 ** 20))
+    # Call function to find outliers in data directory
+    find_outliers(args.data_directory, detectors, args.jobs, thresholds,
+                  cache, args.store, fusion, templates, args.profile,
+                  args.checkpoint, max_memory, args.threads)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,104 @@
+""" Compute all per-volume QC metrics in one pass over the data
+
+DVARS, center of mass and projections on the mean brain each need every
+voxel of every volume. Computing them separately reads the whole image once
+per metric; here each block of volumes is read once and all the metrics are
+computed from it while it is in memory (and in cache).
+
+For example::
+
+    mean_brain, thresh = outliers_mean_brain.mean_img(data, 2)
+    metrics = fused_metrics(data, {2: mean_brain})
+    metrics['com'], metrics['dvars'], metrics['projections'][2]
+"""
+
+import numpy as np
+
+import image_loader
+import outliers_mean_brain as mb
+
+
+def fused_metrics(data, templates=None, chunk_size=4, dtype=np.float64,
+                  n_threads=None):
+    """ Volume sums, center of mass, DVARS and projections in one pass
+
+    Parameters
+    ----------
+    data : 4D array
+        Image data, with time as the last axis.
+    templates : None or dict, optional
+        Slice axis (0, 1 or 2) -> 3D template (thresholded mean brain) to
+        project the slices along that axis on.
+    chunk_size : int, optional
+        Number of volumes per block. Small blocks stay in cache while all the
+        metrics are computed from them.
+    dtype : numpy dtype, optional
+        Working precision.
+    n_threads : None or int, optional
+        Number of threads for the projections, each projecting a group of
+        slices (see ``outliers_mean_brain.map_slice_groups``). One pool of
+        threads is used for all blocks, with fewer threads if there is not
+        enough work in a block (see ``outliers_mean_brain.work_threads``).
+
+    Returns
+    -------
+    metrics : dict
+        With keys:
+
+        * ``volume_sum``: shape (t,) array, sum of each volume;
+        * ``com``: shape (t, 3) array, center of mass of each volume;
+        * ``dvars``: shape (t - 1,) array, RMS difference between each volume
+          and the next;
+        * ``projections``: dict of slice axis -> shape (t, # slices) array of
+          projections of each slice on the template for that axis.
+    """
+    if templates is None:
+        templates = {}
+    n_vols = data.shape[-1]
+    grids = [np.arange(n) for n in data.shape[:3]]
+    volume_sum = np.zeros(n_vols)
+    weighted = np.zeros((n_vols, 3))
+    dvars_sq = np.zeros(max(n_vols - 1, 0))
+    projections = dict((ax, np.zeros((n_vols, data.shape[ax])))
+                       for ax in templates)
+    subscripts = dict((ax, 'ijkt,ijk->t' + 'ijk'[ax]) for ax in templates)
+    # One pool of threads for the projections of all blocks, each thread
+    # with enough work
+    block_vols = n_vols if chunk_size is None else min(chunk_size, n_vols)
+    n_threads = mb.work_threads(
+        n_threads, max([data.shape[ax] for ax in templates] + [1]),
+        int(np.prod(data.shape[:3])) * block_vols)
+    previous = None
+    with mb.slice_pool(n_threads) as pool:
+        for start, stop, block in image_loader.iter_time_chunks(
+                data, chunk_size, dtype):
+            # Sums over the voxel axes, weighted by voxel index for COM
+            sum_xy = block.sum(axis=2)
+            sum_z = block.sum(axis=(0, 1))
+            volume_sum[start:stop] = sum_z.sum(axis=0)
+            weighted[start:stop, 0] = grids[0].dot(sum_xy.sum(axis=1))
+            weighted[start:stop, 1] = grids[1].dot(sum_xy.sum(axis=0))
+            weighted[start:stop, 2] = grids[2].dot(sum_z)
+            # Squared differences with previous volume, including the last
+            # volume of the previous block
+            if previous is not None:
+                diff = block[..., 0] - previous
+                dvars_sq[start - 1] = np.mean(diff ** 2)
+            if stop - start > 1:
+                diff = block[..., 1:] - block[..., :-1]
+                diff **= 2
+                dvars_sq[start:stop - 1] = diff.mean(axis=(0, 1, 2))
+            previous = block[..., -1].copy()
+            # Per-slice dot products with the templates
+            for ax, template in templates.items():
+                def group_projections(group):
+                    return np.einsum(subscripts[ax],
+                                     mb.take_slices(block, group, ax),
+                                     mb.take_slices(template, group, ax))
+                projections[ax][start:stop] = np.concatenate(
+                    mb.map_slice_groups(group_projections, data.shape[ax],
+                                        n_threads, pool=pool), axis=1)
+    return {'volume_sum': volume_sum,
+            'com': weighted / volume_sum[:, None],
+            'dvars': np.sqrt(dvars_sq),
+            'projections': projections}
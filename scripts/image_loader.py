@@ -0,0 +1,192 @@
+""" Shared functions to open images and access their data
+
+Images are opened memory-mapped, and the data are returned in the dtype stored
+in the file (e.g. int16), so nothing is read from disk or converted until a
+metric asks for it. Each metric converts the volumes / chunks it works on to
+the precision it needs, with ``as_working``.
+
+For example::
+
+    img = load_image('data/group00_sub01_run1.nii')
+    data = image_data(img)
+    for start, stop, chunk in iter_time_chunks(data, 20, np.float32):
+        ...
+
+Metrics that reduce each volume (or each volume and its neighbors) to a
+value use ``map_time_blocks``, which walks the time axis in overlapping
+blocks so memory use is bounded by the block size.
+"""
+
+import numpy as np
+import nibabel as nib
+
+
+def load_image(filename):
+    """ Open image `filename` with memory-mapped data
+
+    Parameters
+    ----------
+    filename : str
+        Image filename, e.g. ``.nii`` file.
+
+    Returns
+    -------
+    img : image object
+        nibabel image object. Nothing but the header has been read yet.
+    """
+    return nib.load(filename, mmap=True)
+
+
+def image_data(img):
+    """ Data for `img` in the dtype stored in the file
+
+    Parameters
+    ----------
+    img : image object
+        nibabel image object.
+
+    Returns
+    -------
+    data : array
+        Image data. For unscaled images (the usual case for scanner data) this
+        is a memory map onto the file, in the on-disk dtype. Images with
+        scaling factors are read and scaled, giving a floating point array.
+    """
+    return np.asanyarray(img.dataobj)
+
+
+def as_working(arr, dtype=None):
+    """ Return `arr` as array of `dtype`, only copying if needed
+
+    Parameters
+    ----------
+    arr : array
+        Input array, e.g. a volume or a chunk of a memory-mapped image.
+    dtype : None or numpy dtype, optional
+        Working precision. None keeps the dtype of `arr`.
+
+    Returns
+    -------
+    working : array
+        `arr` in `dtype`.
+    """
+    return np.asarray(arr, dtype=dtype)
+
+
+def iter_volumes(data, dtype=None):
+    """ Yield each volume of 4D `data` in turn, as `dtype`
+
+    Parameters
+    ----------
+    data : 4D array
+        Image data, with time as the last axis.
+    dtype : None or numpy dtype, optional
+        Working precision. None keeps the dtype of `data`.
+
+    Yields
+    ------
+    vol : 3D array
+        Volume of `data`.
+    """
+    for t in range(data.shape[-1]):
+        yield as_working(data[..., t], dtype)
+
+
+def iter_slices(data, ax, dtype=None):
+    """ Yield each slice of `data` along axis `ax`, as `dtype`
+
+    Parameters
+    ----------
+    data : array
+        3D or 4D image data.
+    ax : int | 0 | 1 | 2
+        Axis along which the slices are defined.
+    dtype : None or numpy dtype, optional
+        Working precision. None keeps the dtype of `data`.
+
+    Yields
+    ------
+    slice : array
+        Slice of `data`, with one fewer dimension than `data`.
+    """
+    for s in range(data.shape[ax]):
+        yield as_working(np.take(data, s, axis=ax), dtype)
+
+
+def iter_time_chunks(data, chunk_size, dtype=None):
+    """ Yield blocks of `chunk_size` consecutive volumes from 4D `data`
+
+    Parameters
+    ----------
+    data : 4D array
+        Image data, with time as the last axis.
+    chunk_size : None or int
+        Number of volumes in each chunk. None gives all volumes in one chunk.
+    dtype : None or numpy dtype, optional
+        Working precision. None keeps the dtype of `data`, so the chunks are
+        views onto `data`.
+
+    Yields
+    ------
+    start : int
+        Index of first volume in chunk.
+    stop : int
+        One past index of last volume in chunk.
+    chunk : 4D array
+        ``data[..., start:stop]`` as `dtype`.
+    """
+    n_vols = data.shape[-1]
+    if chunk_size is None:
+        chunk_size = max(n_vols, 1)
+    for start in range(0, n_vols, chunk_size):
+        stop = min(start + chunk_size, n_vols)
+        yield start, stop, as_working(data[..., start:stop], dtype)
+
+
+def map_time_blocks(func, data, n_out, chunk_size=None, before=0, after=0,
+                    dtype=None):
+    """ Compute per-volume outputs of `func` over blocks of volumes in `data`
+
+    The outputs ``0 .. n_out - 1`` are split into blocks of `chunk_size`.
+    Output ``i`` may depend on volumes ``i - before`` to ``i + after``, so
+    each block of data overlaps the next by ``before + after`` volumes. Only
+    one block of data (in `dtype`) is in memory at a time, so peak memory
+    depends on `chunk_size`, not on the size of the image.
+
+    Parameters
+    ----------
+    func : callable
+        Called as ``func(block, first, n)``, where `block` is
+        ``data[..., lo:hi]`` in `dtype`; returns the `n` outputs starting at
+        output index ``lo + first``.
+    data : 4D array
+        Image data, with time as the last axis.
+    n_out : int
+        Number of outputs.
+    chunk_size : None or int, optional
+        Number of outputs per block. None computes all outputs in one block.
+    before : int, optional
+        Number of volumes before output index needed for each output.
+    after : int, optional
+        Number of volumes after output index needed for each output.
+    dtype : None or numpy dtype, optional
+        Working precision of the blocks. None keeps the dtype of `data`.
+
+    Returns
+    -------
+    outputs : array
+        Outputs of `func` for all blocks, concatenated along the first axis.
+    """
+    n_vols = data.shape[-1]
+    if chunk_size is None:
+        chunk_size = max(n_out, 1)
+    outputs = []
+    for start in range(0, n_out, chunk_size):
+        stop = min(start + chunk_size, n_out)
+        lo = max(start - before, 0)
+        hi = min(stop + after, n_vols)
+        block = as_working(data[..., lo:hi], dtype)
+        outputs.append(func(block, start - lo, stop - start))
+    if not outputs:
+        return np.zeros((0,))
+    return np.concatenate(outputs)
@@ -0,0 +1,288 @@
+""" Saved mean brain templates for runs and subjects
+
+The projections on the mean brain need the mean over all volumes before the
+first projection can be computed, so computing the mean takes a full pass over
+the data of its own. The (unthresholded) mean volume only depends on the
+image, not on the slice axis or the outlier thresholds, so it is saved as a
+``.npz`` file and reused for projections along any axis, for visualization and
+when re-processing the run; the per-slice thresholds are recomputed from it,
+which is cheap.
+
+Templates are saved next to the run (or in a template directory) as
+``<run>_mean.npz``. A template from every `stride`-th volume only, for a quick
+first pass, is ``<run>_mean_stride<stride>.npz``. A subject template averages
+the templates of all runs for the subject, and is saved as
+``<group>_<subject>_mean.npz``.
+
+Each saved template records the path, size and modification time of the
+images it was made from, and is only used for exactly these images. So runs
+with the same names in different data directories can share a template
+directory without using each other's templates, and templates are made again
+when their images change.
+
+Build the templates for all runs in a directory with:
+
+    python3 scripts/mean_template.py data
+"""
+
+import os
+import glob
+import json
+import argparse
+import tempfile
+
+import numpy as np
+
+import image_loader
+import outliers_mean_brain as mb
+import prescan
+import results_store
+
+
+def _template_path(name, stride=1, directory=None):
+    suffix = '_mean' if stride == 1 else '_mean_stride{0}'.format(stride)
+    return os.path.join(directory, name + suffix + '.npz')
+
+
+def run_name(filename):
+    """ Return filename without directory or image extension
+    """
+    name = os.path.basename(filename)
+    for ext in ('.nii.gz', '.nii'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def template_filename(filename, stride=1, directory=None):
+    """ Filename of saved template for image `filename`
+
+    Parameters
+    ----------
+    filename : str
+        Image filename.
+    stride : int, optional
+        Template from every `stride`-th volume.
+    directory : None or str, optional
+        Directory for template. None means the directory of the image.
+
+    Returns
+    -------
+    template_fname : str
+        Filename of template ``.npz`` file.
+    """
+    if directory is None:
+        directory = os.path.dirname(filename)
+    return _template_path(run_name(filename), stride, directory)
+
+
+def subject_runs(filename):
+    """ Image filenames for all runs of the subject of image `filename`
+
+    Runs are other images in the same directory with the same group and
+    subject (see ``results_store.parse_run_name``). Runs whose headers show
+    they cannot be processed (see ``prescan``) are left out.
+
+    Parameters
+    ----------
+    filename : str
+        Image filename.
+
+    Returns
+    -------
+    filenames : list
+        Sorted image filenames, including `filename`. Just `filename` if it
+        does not follow the naming scheme.
+    """
+    group, subject, run = results_store.parse_run_name(filename)
+    if not subject:
+        return [filename]
+    directory = os.path.dirname(filename)
+    pattern = os.path.join(directory, '{0}_{1}_run*.nii'.format(group,
+                                                                subject))
+    runs = [fname for fname in glob.glob(pattern)
+            if prescan.scan_header(fname).problem is None]
+    return sorted(set(runs) | set([filename]))
+
+
+def source_identity(sources):
+    """ Return string identifying image files `sources` and their contents
+
+    Parameters
+    ----------
+    sources : sequence of str
+        Image filenames.
+
+    Returns
+    -------
+    identity : str
+        JSON list of real path, size and modification time (ns) for each
+        file, in the order of `sources`.
+    """
+    identity = []
+    for source in sources:
+        stat = os.stat(source)
+        identity.append([os.path.realpath(source), stat.st_size,
+                         stat.st_mtime_ns])
+    return json.dumps(identity)
+
+
+def save_template(template_fname, template, sources=()):
+    """ Save `template` made from images `sources` to `template_fname`
+
+    Any existing file is replaced.
+
+    Parameters
+    ----------
+    template_fname : str
+        Filename of template ``.npz`` file.
+    template : 3D array
+        Unthresholded mean volume.
+    sources : sequence of str, optional
+        Filenames of images the template was computed from.
+    """
+    directory = os.path.dirname(template_fname) or '.'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_fname = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fobj:
+        np.savez(fobj, template=template,
+                 sources=np.array(source_identity(sources)))
+    os.replace(tmp_fname, template_fname)
+
+
+def load_template(template_fname, sources=()):
+    """ Load template, or return None if missing or not made from `sources`
+
+    Parameters
+    ----------
+    template_fname : str
+        Filename of template ``.npz`` file.
+    sources : sequence of str, optional
+        Filenames of images the template should have been computed from.
+        The template is not used if it was saved for other files, or if any
+        of these files changed since.
+
+    Returns
+    -------
+    template : None or 3D array
+        Unthresholded mean volume.
+    """
+    try:
+        with np.load(template_fname) as npz:
+            if str(npz['sources']) != source_identity(sources):
+                return None
+            return npz['template']
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def run_template(filename, data=None, stride=1, directory=None,
+                 n_threads=None):
+    """ Mean volume for image `filename`, from saved template if possible
+
+    If there is no saved template, compute the mean and save it.
+
+    Parameters
+    ----------
+    filename : str
+        Image filename.
+    data : None or 4D array, optional
+        Image data, if already loaded.
+    stride : int, optional
+        Average every `stride`-th volume only.
+    directory : None or str, optional
+        Directory for templates. None means the directory of the image.
+    n_threads : None or int, optional
+        Number of threads for computing the mean, see
+        ``outliers_mean_brain.mean_volume``.
+
+    Returns
+    -------
+    template : 3D array
+        Unthresholded mean volume.
+    """
+    template_fname = template_filename(filename, stride, directory)
+    template = load_template(template_fname, [filename])
+    if template is None:
+        if data is None:
+            data = image_loader.image_data(image_loader.load_image(filename))
+        template = mb.mean_volume(data, stride=stride, n_threads=n_threads)
+        save_template(template_fname, template, [filename])
+    return template
+
+
+def subject_template(filename, data=None, stride=1, directory=None,
+                     n_threads=None):
+    """ Mean volume over all runs for the subject of image `filename`
+
+    Averages the run templates (see ``run_template``) of all runs for the
+    subject, weighting each run by its number of volumes.
+
+    Parameters
+    ----------
+    filename : str
+        Image filename for one run of the subject.
+    data : None or 4D array, optional
+        Image data for `filename`, if already loaded.
+    stride, directory, n_threads
+        See ``run_template``.
+
+    Returns
+    -------
+    template : 3D array
+        Unthresholded mean volume.
+    """
+    filenames = subject_runs(filename)
+    if directory is None:
+        directory = os.path.dirname(filename)
+    group, subject, run = results_store.parse_run_name(filename)
+    if not subject:
+        return run_template(filename, data, stride, directory, n_threads)
+    template_fname = _template_path(group + '_' + subject, stride, directory)
+    template = load_template(template_fname, filenames)
+    if template is not None:
+        return template
+    total = 0
+    n_total = 0
+    for fname in filenames:
+        run_data = data if fname == filename else None
+        n_vols = len(range(0, image_loader.load_image(fname).shape[-1],
+                           stride))
+        total = total + n_vols * run_template(fname, run_data, stride,
+                                              directory, n_threads)
+        n_total += n_vols
+    template = total / n_total
+    save_template(template_fname, template, filenames)
+    return template
+
+
+def main():
+    # This function (main) called when this file run as a script.
+    parser = argparse.ArgumentParser(
+        description='Save mean brain templates for images in data directory')
+    parser.add_argument('data_directory',
+                        help='Directory containing images')
+    parser.add_argument('--template-dir',
+                        help='Directory for templates (default is the data '
+                        'directory)')
+    parser.add_argument('--stride', type=int, default=1,
+                        help='Use every STRIDE-th volume '
+                        '(default %(default)s)')
+    parser.add_argument('--subject', action='store_true',
+                        help='Also save templates over all runs of each '
+                        'subject')
+    args = parser.parse_args()
+    if args.stride < 1:
+        parser.error('--stride should be 1 or more')
+    for fname in sorted(glob.glob(os.path.join(args.data_directory,
+                                               '*.nii'))):
+        if args.subject:
+            subject_template(fname, None, args.stride, args.template_dir)
+        else:
+            run_template(fname, None, args.stride, args.template_dir)
+
+
+if __name__ == '__main__':
+    # Python is running this file as a script, not importing it.
+    main()
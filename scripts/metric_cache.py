@@ -0,0 +1,133 @@
+""" Cache of per-run QC metrics, keyed by file contents and method parameters
+
+The metrics for a run (center of mass DVARS series, projections on the mean
+brain, ...) only depend on the contents of the image and the parameters of the
+method computing them, not on the outlier thresholds. Storing them means that
+re-running the outlier detection with new thresholds only needs the small
+cached arrays, not the image data.
+
+Entries are ``.npz`` files in the cache directory, named by a SHA1 of the
+image SHA1 (from ``data_hashes.txt``), the metric name and its parameters.
+When the cache grows beyond its size limit, the least recently used entries
+are removed.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+# Default maximum total size of cache files in bytes
+DEFAULT_MAX_BYTES = 2 ** 30
+
+
+def read_data_hashes(data_directory):
+    """ Return dict of filename -> SHA1 from ``data_hashes.txt`` in directory
+
+    Parameters
+    ----------
+    data_directory : str
+        Directory that may contain ``data_hashes.txt`` file.
+
+    Returns
+    -------
+    hashes : dict
+        Filename -> SHA1 hash string. Empty if there is no hash file.
+    """
+    hash_fname = os.path.join(data_directory, 'data_hashes.txt')
+    if not os.path.isfile(hash_fname):
+        return {}
+    with open(hash_fname, 'rt') as fobj:
+        split_lines = [line.split() for line in fobj if line.strip()]
+    return dict((filename, fhash) for fhash, filename in split_lines)
+
+
+class MetricCache(object):
+    """ Directory of cached metric arrays with LRU eviction by total size
+
+    Parameters
+    ----------
+    directory : str
+        Directory for cache files; created if it does not exist.
+    max_bytes : int, optional
+        Maximum total size of cache files.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, file_hash, name, params):
+        """ Return cache key for metric `name` with `params` on file
+
+        Parameters
+        ----------
+        file_hash : str
+            SHA1 of the image file.
+        name : str
+            Name of metric (detector).
+        params : dict
+            Parameters of the method computing the metric.
+
+        Returns
+        -------
+        key : str
+            Hexadecimal key string.
+        """
+        description = json.dumps([file_hash, name, params], sort_keys=True)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """ Return dict of cached arrays for `key`, or None if not cached
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                metrics = dict((name, npz[name]) for name in npz.files)
+            # Mark as recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return metrics
+
+    def put(self, key, metrics):
+        """ Store dict of arrays `metrics` under `key`, evict old entries
+        """
+        fd, tmp_fname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fobj:
+                np.savez(fobj, **metrics)
+            os.replace(tmp_fname, self._path(key))
+        except (IOError, OSError):
+            os.unlink(tmp_fname)
+            return
+        self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until under size limit
+        """
+        entries = []
+        for fname in os.listdir(self.directory):
+            if not fname.endswith('.npz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, fname))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        total = sum(size for mtime, size, fname in entries)
+        for mtime, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, fname))
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,220 @@
+""" Score volumes for outliers as they arrive, during acquisition
+
+Run on a directory that the scanner writes 3D volume files into:
+
+    python3 scripts/online_qc.py incoming_dir
+
+or replay a 4D image one volume at a time:
+
+    python3 scripts/online_qc.py data/group00_sub01_run1.nii
+
+Each volume updates the DVARS, center of mass and running mean brain
+statistics with work proportional to the size of one volume, and prints
+provisional outlier flags of form:
+
+    <volume_index> <detector>
+
+Flags are provisional because the outlier thresholds come from the volumes
+seen so far. The quartiles for the thresholds are streaming estimates, so
+the cost per volume does not grow with the length of the run. The center of
+mass flags come ``window`` volumes late, because the sliding window needs the
+volumes after the one being scored.
+"""
+
+import os
+import sys
+import glob
+import time
+
+import numpy as np
+
+import calc_centerofmass as com
+import image_loader
+import outliers_mean_brain as mb
+from quantile_sketch import IQRSketch
+
+
+class OnlineQC(object):
+    """ Incremental outlier detection for volumes arriving one at a time
+
+    Parameters
+    ----------
+    window : int, optional
+        Size of sliding window for DVARS over center of mass coordinates.
+    ax : str, optional
+        Slice direction ('x', 'y' or 'z') for projection on the mean brain.
+    warmup : int, optional
+        Number of values a series needs before its volumes can be flagged.
+    com_iqr_scale : float, optional
+        Center of mass outliers are more than this many IQRs outside the
+        quartiles of the sliding DVARS values.
+    dvars_iqr_scale : float, optional
+        DVARS outliers are more than this many IQRs above the third quartile.
+    slice_iqr_scale : float, optional
+        Slices are outliers if their projection on the mean brain is more than
+        this many IQRs below the first quartile for that slice.
+    """
+
+    def __init__(self, window=1, ax='z', warmup=10, com_iqr_scale=3,
+                 dvars_iqr_scale=3, slice_iqr_scale=1.5):
+        self.window = window
+        self.ax = {'x': 0, 'y': 1, 'z': 2}[ax]
+        self.warmup = warmup
+        self.com_iqr_scale = com_iqr_scale
+        self.dvars_iqr_scale = dvars_iqr_scale
+        self.slice_iqr_scale = slice_iqr_scale
+        self.n_vols = 0
+        self.previous = None
+        self.volume_sum = None
+        # Metric series; dvars[i] is for volumes i, i + 1; com_dvars[i] is
+        # for volume i + window
+        self.dvars = []
+        self.com = []
+        self.com_dvars = []
+        self.projections = []
+        self.flags = []
+        # Quartile estimates for each series
+        self.dvars_sketch = IQRSketch()
+        self.com_sketch = IQRSketch()
+        self.slice_sketch = IQRSketch()
+
+    def add_volume(self, vol):
+        """ Update statistics with next volume `vol`, return new flags
+
+        Parameters
+        ----------
+        vol : 3D array
+            Next volume of the run.
+
+        Returns
+        -------
+        new_flags : list
+            List of ``(volume_index, detector)`` tuples for volumes newly
+            flagged as outliers, where detector is one of 'dvars', 'com' or
+            'mean'.
+        """
+        vol = image_loader.as_working(vol, np.float64)
+        t = self.n_vols
+        self.n_vols += 1
+        new_flags = []
+
+        # DVARS between this volume and the last one
+        if self.previous is not None:
+            self.dvars.append(np.sqrt(np.mean((vol - self.previous) ** 2)))
+            self.dvars_sketch.update(self.dvars[-1])
+            if (len(self.dvars) >= self.warmup and self.dvars_sketch.outliers(
+                    self.dvars[-1], self.dvars_iqr_scale, side='high')):
+                new_flags.append((t, 'dvars'))
+        self.previous = vol
+
+        # Center of mass, and sliding DVARS for the volume at the center of
+        # the latest complete window
+        self.com.append(com.calc_volumes_COM(vol[..., None])[0])
+        center = t - self.window
+        if center >= self.window:
+            coords = np.array(self.com[center - self.window:])
+            win_avg = np.delete(coords, self.window, axis=0).mean(axis=0)
+            self.com_dvars.append(
+                np.sqrt(np.mean((coords[self.window] - win_avg) ** 2)))
+            self.com_sketch.update(self.com_dvars[-1])
+            if (len(self.com_dvars) >= self.warmup and self.com_sketch.outliers(
+                    self.com_dvars[-1], self.com_iqr_scale)):
+                new_flags.append((center, 'com'))
+
+        # Projection on running mean brain, thresholded per slice
+        if self.volume_sum is None:
+            self.volume_sum = np.zeros(vol.shape)
+        self.volume_sum += vol
+        slices = np.moveaxis(self.volume_sum / self.n_vols, self.ax, 0)
+        thresh = mb.otsu_thresholds(slices)
+        template = np.where(slices < thresh[:, None, None], 0, slices)
+        projection = np.einsum('sij,sij->s', np.moveaxis(vol, self.ax, 0),
+                               template)
+        self.projections.append(projection)
+        self.slice_sketch.update(projection)
+        if len(self.projections) >= self.warmup:
+            n_bad = np.count_nonzero(self.slice_sketch.outliers(
+                projection, self.slice_iqr_scale, side='low'))
+            if n_bad > np.round(len(projection) / 4):
+                new_flags.append((t, 'mean'))
+
+        self.flags.extend(new_flags)
+        return new_flags
+
+
+def iter_image_volumes(filename):
+    """ Yield volumes of 4D image `filename` one by one, as if arriving
+    """
+    data = image_loader.image_data(image_loader.load_image(filename))
+    for vol in image_loader.iter_volumes(data):
+        yield vol
+
+
+def iter_directory_volumes(directory, pattern='*.nii', poll_interval=0.1,
+                           timeout=10):
+    """ Yield 3D volumes from files appearing in `directory`, in name order
+
+    A file is read once its size has stayed the same for one poll, so files
+    still being written are not read.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to watch.
+    pattern : str, optional
+        Glob pattern for volume files.
+    poll_interval : float, optional
+        Seconds between checks for new files.
+    timeout : float, optional
+        Stop when no new volume has arrived for this many seconds.
+
+    Yields
+    ------
+    vol : 3D array
+        Data for next volume file.
+    """
+    done = set()
+    sizes = {}
+    last_arrival = time.time()
+    while time.time() - last_arrival < timeout:
+        for fname in sorted(glob.glob(os.path.join(directory, pattern))):
+            if fname in done:
+                continue
+            size = os.path.getsize(fname)
+            if sizes.get(fname) != size:
+                # New or still growing; look again next poll
+                sizes[fname] = size
+                break
+            done.add(fname)
+            last_arrival = time.time()
+            img = image_loader.load_image(fname)
+            yield np.asarray(image_loader.image_data(img))
+        else:
+            time.sleep(poll_interval)
+            continue
+        time.sleep(poll_interval)
+
+
+def main():
+    # Get the directory or 4D image from the command line arguments
+    if len(sys.argv) < 2:
+        raise RuntimeError("Please give directory or image on "
+                           "command line")
+    source = sys.argv[1]
+    if os.path.isdir(source):
+        volumes = iter_directory_volumes(source)
+    else:
+        volumes = iter_image_volumes(source)
+    qc = OnlineQC()
+    max_latency = 0
+    for vol in volumes:
+        start = time.time()
+        for vol_index, detector in qc.add_volume(vol):
+            print(vol_index, detector)
+        max_latency = max(max_latency, time.time() - start)
+    print('Scored {} volumes; maximum time per volume {:.3f}s'.format(
+        qc.n_vols, max_latency))
+
+
+if __name__ == '__main__':
+    main()
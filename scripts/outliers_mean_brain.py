@@ -1,10 +1,270 @@
 import sys
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import nibabel as nib
+import image_loader
 import matplotlib.pyplot as plt
-from skimage import filters
 
-def mean_img(data, ax):
+# Fewest array elements worth giving a thread of its own; for less work per
+# thread, starting the threads costs more than they save
+MIN_THREAD_ELEMENTS = 2 ** 18
+
+def slice_groups(n_slices, n_groups):
+    """
+    Split slices ``0 .. n_slices - 1`` into up to `n_groups` contiguous groups.
+
+    Input
+    -----
+    n_slices : int
+        Number of slices.
+
+    n_groups : int
+        Number of groups wanted.
+
+    Output
+    ------
+    groups : list
+        ``slice`` objects, one per group, in order.
+    """
+    n_groups = max(min(n_groups, n_slices), 1)
+    edges = np.linspace(0, n_slices, n_groups + 1).astype(int)
+    return [slice(start, stop) for start, stop in zip(edges[:-1], edges[1:])]
+
+def work_threads(n_threads, n_slices, n_elements=None):
+    """
+    Return number of threads worth using for work on `n_slices` slices.
+
+    Input
+    -----
+    n_threads : None or int
+        Number of threads wanted. None means 1.
+
+    n_slices : int
+        Number of slices; each thread needs at least one.
+
+    n_elements : None or int
+        Number of array elements in the work; each thread needs at least
+        ``MIN_THREAD_ELEMENTS``. None for no limit.
+
+    Output
+    ------
+    n_threads : int
+        Number of threads, 1 or more.
+    """
+    if n_threads is None:
+        return 1
+    n_threads = min(n_threads, n_slices)
+    if n_elements is not None:
+        n_threads = min(n_threads, n_elements // MIN_THREAD_ELEMENTS)
+    return max(n_threads, 1)
+
+@contextmanager
+def slice_pool(n_threads):
+    """
+    Context manager giving a pool of `n_threads` threads, or None for 1.
+
+    Create the pool once, and pass it to ``map_slice_groups`` for each block
+    of volumes, rather than starting new threads for every block.
+    """
+    if n_threads is None or n_threads <= 1:
+        yield None
+        return
+    with ThreadPoolExecutor(n_threads) as pool:
+        yield pool
+
+def map_slice_groups(func, n_slices, n_threads=None, n_elements=None,
+                     pool=None):
+    """
+    Call `func` on groups of slices, in a pool of threads.
+
+    The work for each slice is independent, and NumPy releases the GIL in the
+    reductions and dot products, so threads can work on different slices at
+    the same time. The number of threads is limited by the number of slices
+    and the amount of work (see ``work_threads``).
+
+    Input
+    -----
+    func : callable
+        Called as ``func(group)``, where `group` is a ``slice`` of slice
+        indices.
+
+    n_slices : int
+        Number of slices.
+
+    n_threads : None or int
+        Number of threads. None or 1 calls `func` once, for all slices, in
+        this thread.
+
+    n_elements : None or int
+        Number of array elements in the work for all slices.
+
+    pool : None or concurrent.futures.ThreadPoolExecutor
+        Pool of at least `n_threads` threads to use (see ``slice_pool``).
+        None starts a pool for this call.
+
+    Output
+    ------
+    results : list
+        Return values of `func` for each group, in slice order.
+    """
+    n_threads = work_threads(n_threads, n_slices, n_elements)
+    if n_threads == 1:
+        return [func(slice(0, n_slices))]
+    groups = slice_groups(n_slices, n_threads)
+    if pool is None:
+        with ThreadPoolExecutor(len(groups)) as pool:
+            return list(pool.map(func, groups))
+    return list(pool.map(func, groups))
+
+def take_slices(arr, group, ax):
+    """
+    Return view of `arr` with slices `group` along axis `ax`.
+    """
+    index = [slice(None)] * arr.ndim
+    index[ax] = group
+    return arr[tuple(index)]
+
+def otsu_thresholds(slices, nbins=256):
+    """
+    Return Otsu threshold for each slice, computed for all slices at once.
+
+    Gives the same thresholds as calling ``skimage.filters.threshold_otsu`` on
+    each slice, but builds the histograms and finds the thresholds for all
+    slices together, without a Python loop over slices.
+
+    Input
+    -----
+    slices : numpy array (# slices, ...)
+        Images to threshold, one per entry along the first axis.
+
+    nbins : int
+        Number of histogram bins.
+
+    Output
+    ------
+    thresh : numpy array (# slices,)
+        Threshold for each slice. Slices with a single value get that value as
+        threshold.
+    """
+    n_slices = slices.shape[0]
+    values = slices.reshape((n_slices, -1))
+    first = values.min(axis=1)
+    last = values.max(axis=1)
+    constant = first == last
+    # Histogram range as for np.histogram when all values are the same
+    first = np.where(constant, first - 0.5, first)
+    last = np.where(constant, last + 0.5, last)
+
+    # Bin each value as np.histogram does: compute bin from position in
+    # range, then correct for rounding against the bin edges. Only values
+    # very close to a bin edge can need correcting.
+    edges = np.linspace(first, last, nbins + 1, axis=1)
+    width = (last - first)[:, None]
+    position = (values - first[:, None]) / width * nbins
+    indices = position.astype(np.intp)
+    indices[indices == nbins] -= 1
+    rows, cols = np.nonzero(np.abs(position - np.rint(position)) < 1e-6)
+    near = values[rows, cols]
+    near_indices = indices[rows, cols]
+    near_indices[near < edges[rows, near_indices]] -= 1
+    increment = ((near >= edges[rows, near_indices + 1]) &
+                 (near_indices != nbins - 1))
+    near_indices[increment] += 1
+    indices[rows, cols] = near_indices
+    offsets = (np.arange(n_slices) * nbins)[:, None]
+    counts = np.bincount((indices + offsets).ravel(),
+                         minlength=n_slices * nbins).reshape((n_slices, nbins))
+    bin_centers = (edges[:, :-1] + edges[:, 1:]) / 2.
+
+    # Otsu: maximize between class variance over all possible thresholds
+    weight1 = np.cumsum(counts, axis=1)
+    weight2 = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1]
+    weighted = counts * bin_centers
+    # Constant slices give 0 / 0; their thresholds are set below
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean1 = np.cumsum(weighted, axis=1) / weight1
+        mean2 = (np.cumsum(weighted[:, ::-1], axis=1) /
+                 weight2[:, ::-1])[:, ::-1]
+    variance12 = (weight1[:, :-1] * weight2[:, 1:] *
+                  (mean1[:, :-1] - mean2[:, 1:]) ** 2)
+    idx = np.argmax(variance12, axis=1)
+    thresh = bin_centers[np.arange(n_slices), idx]
+
+    return np.where(constant, values[:, 0], thresh)
+
+def mean_volume(data, dtype=np.float64, stride=1, n_threads=None):
+    """
+    Return mean brain volume over time, before thresholding.
+
+    The mean does not depend on the slice axis, so it can be computed once
+    (and saved, see ``mean_template``) and thresholded for each axis with
+    ``threshold_mean``.
+
+    Input
+    -----
+    data : 4D numpy array
+        Data from scan.
+
+    dtype : numpy dtype
+        Precision used to accumulate the mean; the data are converted to this
+        dtype as they are summed, not all at once.
+
+    stride : int
+        Average every `stride` volumes only (volumes 0, stride, 2 * stride,
+        ...), for a quick estimate of the mean that reads fewer volumes.
+
+    n_threads : None or int
+        Number of threads, each averaging a group of z slices.
+
+    Output
+    ------
+    mean_volume : 3D numpy array
+        Mean brain volume over time.
+    """
+    def group_mean(group):
+        return data[:, :, group, ::stride].mean(axis=3, dtype=dtype)
+
+    n_elements = data[..., ::stride].size
+    return np.concatenate(map_slice_groups(group_mean, data.shape[2],
+                                           n_threads, n_elements), axis=2)
+
+def threshold_mean(mean_volume, ax, n_threads=None):
+    """
+    Return copy of mean volume with each slice thresholded (Otsu).
+
+    Input
+    -----
+    mean_volume : 3D numpy array
+        Mean brain volume over time, from ``mean_volume``.
+
+    ax : int | 0 | 1 | 2
+        Axis along which the slices are defined. Values 0, 1, 2 correspond to
+        the x, y, and z axes respectively.
+
+    n_threads : None or int
+        Number of threads, each thresholding a group of slices.
+
+    Output
+    ------
+    mean_img : 3D numpy array
+        Thresholded mean brain volume.
+
+    thresh : numpy array (1, # slices)
+        Threshold for each slice.
+    """
+    mean_img = np.array(mean_volume)
+
+    # View of the mean with slices along the first axis; thresholding the view
+    # thresholds mean_img
+    slices = np.moveaxis(mean_img, ax, 0)
+    thresh = np.concatenate(map_slice_groups(
+        lambda group: otsu_thresholds(slices[group]), slices.shape[0],
+        n_threads, slices.size)).reshape((1, -1))
+    slices[slices < thresh[0, :, None, None]] = 0
+
+    return mean_img, thresh
+
+def mean_img(data, ax, dtype=np.float64, stride=1, n_threads=None):
     """
     Return mean brain volume over time. Each slice is thresholded (Otsu) to
     remove noise. The thresholds for each slice are also returned (currently
@@ -19,6 +279,16 @@ def mean_img(data, ax):
         Axis along which the slices are defined. Values 0, 1, 2 correspond to
         the x, y, and z axes respectively.
 
+    dtype : numpy dtype
+        Precision used to accumulate the mean; the data are converted to this
+        dtype as they are summed, not all at once.
+
+    stride : int
+        Average every `stride` volumes only, see ``mean_volume``.
+
+    n_threads : None or int
+        Number of threads for averaging and thresholding groups of slices.
+
     Output
     ------
     mean_img : 3D numpy array
@@ -27,25 +297,11 @@ def mean_img(data, ax):
     thresh : numpy array (1, # slices)
         Threshold for each slice.
     """
-    # Average volume over time
-    mean_img = data.mean(axis=3)
-
-    thresh = np.zeros((1, data.shape[ax]))
-    for s in range(data.shape[ax]):
-        if ax == 0:
-            img = mean_img[s, :, :]
-        elif ax == 1:
-            img = mean_img[:, s, :]
-        else:
-            img = mean_img[..., s]
-
-        thresh[0, s] = filters.threshold_otsu(img)
-        img[img < thresh[0, s]] = 0
-
-    return mean_img, thresh
+    return threshold_mean(mean_volume(data, dtype, stride, n_threads), ax,
+                          n_threads)
 
 
-def projection_on_mean(data, mean_brain, ax):
+def projection_on_mean(data, mean_brain, ax, chunk_size=None, n_threads=None):
     """
     Return projection of each slice (in each volume) to the mean slice (from the
     thresholded mean brain volume).
@@ -62,31 +318,112 @@ def projection_on_mean(data, mean_brain, ax):
         Axis along which the slices are defined. Values 0, 1, 2 correspond to
         the x, y, and z axes respectively.
 
+    chunk_size : None or int
+        Number of volumes to project at a time. None projects all volumes at
+        once; smaller chunks only read part of the data (e.g. from a memory
+        mapped image) at a time.
+
+    n_threads : None or int
+        Number of threads, each projecting a group of slices.
+
     Output
     ------
     projections : numpy array (# volumes, # slices)
         Projection/dot product of each slice in each volume on the corresponding
         slice in the mean_brain.
     """
-
-    # Reshape data and mean
     n_slices = data.shape[ax]
-    n_pixels = int(np.prod(data.shape[0:3]) / n_slices)
-    n_voxels = data.shape[3]
-    data = data.reshape((n_pixels, n_slices, n_voxels))
-    mean_brain = mean_brain.reshape((n_pixels, n_slices))
+    n_vols = data.shape[3]
+
+    # Sum the product with the mean brain over the two axes within each slice,
+    # for all volumes at once, e.g. 'ijkt,ijk->tk' for z slices. This works
+    # directly on the data, without reshaping or copying it.
+    vox_axes = 'ijk'
+    subscripts = 'ijkt,ijk->t' + vox_axes[ax]
+
+    # One pool of threads for all blocks, each thread with enough work
+    block_vols = n_vols if chunk_size is None else min(chunk_size, n_vols)
+    n_threads = work_threads(n_threads, n_slices,
+                             mean_brain.size * block_vols)
+
+    def block_projections(block, first, n):
+        block = block[..., first:first + n]
+
+        def group_projections(group):
+            return np.einsum(subscripts, take_slices(block, group, ax),
+                             take_slices(mean_brain, group, ax))
+
+        return np.concatenate(map_slice_groups(group_projections, n_slices,
+                                               n_threads, pool=pool), axis=1)
 
     # Project
-    projections = np.zeros((n_voxels, n_slices))
-    for v in range(n_voxels):
-        proj = np.sum(data[..., v] * mean_brain, axis=0)
-        projections[v, :] = proj
+    with slice_pool(n_threads) as pool:
+        projections = image_loader.map_time_blocks(block_projections, data,
+                                                   n_vols, chunk_size)
+
+    return projections.reshape((n_vols, n_slices))
+
+def projections_on_means(data, mean_brains, chunk_size=None, n_threads=None):
+    """
+    Return projections of the slices along several axes, in one pass over the
+    data.
+
+    Input
+    -----
+    data : 4D numpy array
+        Data from scan.
+
+    mean_brains : dict
+        Axis (0, 1 or 2) -> thresholded mean brain volume for slices along
+        that axis (see ``threshold_mean``).
+
+    chunk_size : None or int
+        Number of volumes to project at a time, see ``projection_on_mean``.
+
+    n_threads : None or int
+        Number of threads, each projecting a group of slices.
 
-    return projections
+    Output
+    ------
+    projections : dict
+        Axis -> numpy array (# volumes, # slices along axis) of projections,
+        as from ``projection_on_mean``.
+    """
+    n_vols = data.shape[3]
+    axes = sorted(mean_brains)
+    n_slices = [data.shape[ax] for ax in axes]
+
+    # One pool of threads for all blocks and axes
+    block_vols = n_vols if chunk_size is None else min(chunk_size, n_vols)
+    n_threads = work_threads(n_threads, max(n_slices),
+                             np.prod(data.shape[:3]) * block_vols)
+
+    # Each block of volumes is read once, and projected for all axes
+    def block_projections(block, first, n):
+        block = block[..., first:first + n]
+
+        def axis_projections(ax):
+            def group_projections(group):
+                return np.einsum('ijkt,ijk->t' + 'ijk'[ax],
+                                 take_slices(block, group, ax),
+                                 take_slices(mean_brains[ax], group, ax))
+            return np.concatenate(map_slice_groups(
+                group_projections, data.shape[ax], n_threads, pool=pool),
+                                  axis=1)
 
-def find_outlier_volumes(projections):
+        return np.concatenate([axis_projections(ax) for ax in axes], axis=1)
+
+    with slice_pool(n_threads) as pool:
+        all_projections = image_loader.map_time_blocks(
+            block_projections, data, n_vols, chunk_size)
+    all_projections = all_projections.reshape((n_vols, sum(n_slices)))
+    split = np.split(all_projections, np.cumsum(n_slices)[:-1], axis=1)
+    return dict(zip(axes, split))
+
+def find_outlier_volumes(projections, iqr_scale=1.5, sketch=None,
+                         n_threads=None):
     """
-    Count the number of outlier slices (using 1.5 * IQR) in each volume.
+    Find outlier slices (using 1.5 * IQR) and count them in each volume.
 
     Input
     -----
@@ -94,48 +431,178 @@ def find_outlier_volumes(projections):
         Projection/dot product of each slice in each volume on the corresponding
         slice in the mean_brain.
 
+    iqr_scale : float
+        Slices with projections more than iqr_scale * IQR below the first
+        quartile (over volumes) for that slice are outliers.
+
+    sketch : None or quantile_sketch.IQRSketch
+        If given, the projections are added to the sketch (one series per
+        slice), and the quartiles are its streaming estimates rather than
+        exact percentiles of the projections.
+
+    n_threads : None or int
+        Number of threads, each finding the quartiles for a group of slices.
+        Not used with `sketch`.
+
     Output
     ------
-    outliers : numpy array (# volumes, # slices)
-        Binary array. Entry (i, j) = 1 if slice j in volume i is an outlier,
-        and (i, j) = 0 otherwise.
+    outliers : boolean numpy array (# volumes, # slices)
+        Entry (i, j) is True if slice j in volume i is an outlier.
+
+    n_outliers : numpy array (# volumes,)
+        Number of outlier slices in each volume.
     """
-    outliers = np.zeros(projections.shape)
+    if sketch is None:
+        # Quartiles for all slices in each group at once
+        def group_outliers(group):
+            group_projections = projections[:, group]
+            q75, q25 = np.percentile(group_projections, [75, 25], axis=0)
+            iqr = q75 - q25
+            return group_projections < (q25 - iqr_scale * iqr)
+        outliers = np.concatenate(map_slice_groups(
+            group_outliers, projections.shape[1], n_threads,
+            projections.size), axis=1)
+    else:
+        sketch.extend(projections)
+        outliers = sketch.outliers(projections, iqr_scale, side='low')
 
-    for s in range(projections.shape[1]):
-        proj = projections[:, s]
-        q75, q25 = np.percentile(proj, [75, 25])
-        iqr = q75 - q25
-        outliers[:, s] = (proj < (q25 - 1.5 * iqr)).astype(int)
+    return outliers, np.count_nonzero(outliers, axis=1)
 
-    return outliers
+def find_bad_volumes(projections, iqr_scale=1.5, slice_fraction=0.25,
+                     n_threads=None):
+    """
+    Find volumes with more than `slice_fraction` of slices marked as outliers.
 
-def mean_brain(filename, ax):
+    Input
+    -----
+    projections : numpy array (# volumes, # slices)
+        Projection/dot product of each slice in each volume on the corresponding
+        slice in the mean_brain.
+
+    iqr_scale : float
+        IQR multiple for outlier slices, see ``find_outlier_volumes``.
+
+    slice_fraction : float
+        Volume is bad if more than this fraction of its slices are outliers.
+
+    n_threads : None or int
+        Number of threads, see ``find_outlier_volumes``.
+
+    Output
+    ------
+    bad_volumes : list
+        Indices of bad volumes.
     """
-    Find the outlier brain volumes in the scan.
+    outliers, bad_slices = find_outlier_volumes(projections, iqr_scale,
+                                                n_threads=n_threads)
+    thresh = np.round(projections.shape[1] * slice_fraction)
+    return np.flatnonzero(bad_slices > thresh).tolist()
+
+def mean_brain_data(data, ax, template=None):
+    """
+    Find the outlier brain volumes in already loaded scan data.
 
     Input
     -----
-    filename : string
-        Filename where data is contained, probably .nii file.
+    data : 4D numpy array
+        Data from scan.
 
     ax : string | 'x' | 'y' | 'z'
         Direction over which to slice. For example, if ax is 'x', then each
         slice is a slice in the y-z plane.
-    """
-    # Load scan
-    img = nib.load(filename)
-    data = img.get_data()
 
+    template : None or 3D numpy array
+        Unthresholded mean volume (e.g. saved by ``mean_template``). None
+        computes the mean from `data`.
+
+    Output
+    ------
+    bad_volumes : list
+        Indices of volumes with more than 1/4 of their slices marked as
+        outliers.
+    """
     # Find how many bad slices are in each volume
     ax_dict = {'x':0, 'y':1, 'z':2}
-    mean_brain, threshold = mean_img(data, ax_dict[ax])
+    if template is None:
+        template = mean_volume(data)
+    mean_brain, threshold = threshold_mean(template, ax_dict[ax])
     p = projection_on_mean(data, mean_brain, ax_dict[ax])
-    bad_slices = np.sum(find_outlier_volumes(p), axis=1)
 
     # Return list of bad volumes
     # Volume is bad if more than 1/4 of its slices are outliers
-    thresh = np.round(data.shape[ax_dict[ax]] / 4)
-    bad_volumes = [vol for vol, num in enumerate(bad_slices) if num > thresh ]
+    return find_bad_volumes(p, 1.5, 0.25)
+
+def mean_brain_axes_data(data, axes='xyz', iqr_scale=1.5, template=None,
+                         chunk_size=None, n_threads=None):
+    """
+    Count outlier slices in each volume, for slices along several axes.
+
+    Uses one mean brain volume, thresholded for each axis, and one pass over
+    the data for the projections on all axes, so artifacts aligned with the
+    x or y slices are found at little more cost than for z slices only.
+
+    Input
+    -----
+    data : 4D numpy array
+        Data from scan.
+
+    axes : string
+        Slice directions, from 'x', 'y', 'z'.
+
+    iqr_scale : float
+        IQR multiple for outlier slices, see ``find_outlier_volumes``.
 
-    return bad_volumes
+    template : None or 3D numpy array
+        Unthresholded mean volume. None computes the mean from `data`.
+
+    chunk_size : None or int
+        Number of volumes to project at a time.
+
+    n_threads : None or int
+        Number of threads for the mean, thresholds, projections and
+        quartiles.
+
+    Output
+    ------
+    n_outliers : numpy array (# axes, # volumes)
+        Number of outlier slices in each volume, for each axis in `axes`.
+    """
+    ax_dict = {'x':0, 'y':1, 'z':2}
+    if template is None:
+        template = mean_volume(data, n_threads=n_threads)
+    mean_brains = dict((ax_dict[ax],
+                        threshold_mean(template, ax_dict[ax], n_threads)[0])
+                       for ax in axes)
+    projections = projections_on_means(data, mean_brains, chunk_size,
+                                       n_threads)
+    return np.array([find_outlier_volumes(projections[ax_dict[ax]], iqr_scale,
+                                          n_threads=n_threads)[1]
+                     for ax in axes])
+
+def mean_brain(filename, ax):
+    """
+    Find the outlier brain volumes in the scan.
+
+    Input
+    -----
+    filename : string
+        Filename where data is contained, probably .nii file.
+
+    ax : string | 'x' | 'y' | 'z'
+        Direction over which to slice. For example, if ax is 'x', then each
+        slice is a slice in the y-z plane. Several directions (e.g. 'xyz')
+        give the outlier volumes for slices along any of these directions,
+        from one load of the scan.
+    """
+    # Load scan
+    img = image_loader.load_image(filename)
+    data = image_loader.image_data(img)
+
+    if len(ax) == 1:
+        return mean_brain_data(data, ax)
+    # Volume is bad if more than 1/4 of its slices along any axis are outliers
+    n_outliers = mean_brain_axes_data(data, ax)
+    ax_dict = {'x':0, 'y':1, 'z':2}
+    n_slices = np.array([data.shape[ax_dict[a]] for a in ax])
+    bad = n_outliers > np.round(n_slices * 0.25)[:, None]
+    return np.flatnonzero(bad.any(axis=0)).tolist()
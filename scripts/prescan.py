@@ -0,0 +1,151 @@
+""" Read image headers only, to check and plan before reading any data
+
+A pre-scan reads just the header of each image (a few hundred bytes), and
+makes a manifest giving the shape, data type, voxel sizes, size in bytes and
+offset of the data in the file. Images that cannot be processed (not 4D, too
+few volumes, data type that is not numeric, file shorter than the header says)
+are found before reading any data, and the sizes are used to schedule the
+images and plan memory use.
+
+Show the manifest for a directory with:
+
+    python3 scripts/prescan.py data
+"""
+
+import os
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+import image_loader
+
+# Fewest volumes for the outlier metrics (differences between volumes,
+# quartiles over volumes) to make sense
+MIN_VOLUMES = 3
+
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'shape', 'dtype',
+                                             'zooms', 'nbytes', 'offset',
+                                             'problem'])
+
+
+def scan_header(path):
+    """ Return manifest entry for image `path`, from its header
+
+    Parameters
+    ----------
+    path : str
+        Image filename.
+
+    Returns
+    -------
+    entry : ManifestEntry
+        Entry for image. ``problem`` is None if the image looks usable,
+        otherwise a message saying what is wrong; fields that could not be
+        read are None.
+    """
+    try:
+        img = image_loader.load_image(path)
+    except Exception as err:
+        return ManifestEntry(path, None, None, None, None, None,
+                             'Cannot read header: {0}'.format(err))
+    header = img.header
+    shape = tuple(int(n) for n in header.get_data_shape())
+    dtype = header.get_data_dtype()
+    zooms = tuple(float(z) for z in header.get_zooms())
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    offset = int(getattr(img.dataobj, 'offset', 0))
+    problem = None
+    if len(shape) != 4:
+        problem = 'Expecting 4D image, got {0}D'.format(len(shape))
+    elif shape[3] < MIN_VOLUMES:
+        problem = 'Expecting at least {0} volumes, got {1}'.format(
+            MIN_VOLUMES, shape[3])
+    elif dtype.kind not in 'iuf':
+        problem = 'Expecting integer or float data, got {0}'.format(dtype)
+    elif (not path.endswith('.gz') and
+          os.path.getsize(path) < offset + nbytes):
+        # Compressed images can only be checked by reading their data
+        problem = 'File truncated: {0} data bytes expected'.format(nbytes)
+    return ManifestEntry(path, shape, dtype, zooms, nbytes, offset, problem)
+
+
+def scan_directory(data_directory, extension='.nii'):
+    """ Return manifest of images with `extension` in `data_directory`
+
+    Parameters
+    ----------
+    data_directory : str
+        Directory containing images.
+    extension : str, optional
+        Extension of image filenames.
+
+    Returns
+    -------
+    manifest : list
+        ``ManifestEntry`` for each image, in filename order.
+    """
+    names = sorted(f for f in os.listdir(data_directory)
+                   if f.endswith(extension))
+    return [scan_header(os.path.join(data_directory, name)) for name in names]
+
+
+def working_bytes(entry, chunk_size=4, itemsize=8):
+    """ Estimate memory to compute the QC metrics for image `entry`
+
+    The fused metrics (see ``fused_metrics``) work on blocks of `chunk_size`
+    volumes, converted to `itemsize` bytes per voxel, with a few copies of a
+    block and a few template volumes in memory at once.
+
+    Parameters
+    ----------
+    entry : ManifestEntry
+        Image entry.
+    chunk_size : int, optional
+        Number of volumes per block.
+    itemsize : int, optional
+        Bytes per voxel of working precision.
+
+    Returns
+    -------
+    n_bytes : int
+        Estimated working memory in bytes.
+    """
+    volume_bytes = int(np.prod(entry.shape[:3])) * itemsize
+    return volume_bytes * (3 * chunk_size + 4)
+
+
+def format_entry(entry):
+    """ Return one line description of manifest `entry`
+    """
+    name = os.path.basename(entry.path)
+    if entry.shape is None:
+        return '{0} {1}'.format(name, entry.problem)
+    line = '{0} {1} {2} {3} {4:.1f}MB'.format(
+        name, 'x'.join(str(n) for n in entry.shape), entry.dtype,
+        'x'.join('{0:g}'.format(z) for z in entry.zooms),
+        entry.nbytes / 2. ** 20)
+    if entry.problem is not None:
+        line += ' ' + entry.problem
+    return line
+
+
+def main():
+    # This function (main) called when this file run as a script.
+    parser = argparse.ArgumentParser(
+        description='Show header information for images in data directory')
+    parser.add_argument('data_directory',
+                        help='Directory containing images')
+    args = parser.parse_args()
+    manifest = scan_directory(args.data_directory)
+    for entry in manifest:
+        print(format_entry(entry))
+    total = sum(entry.nbytes for entry in manifest if entry.nbytes)
+    print('{0} images, {1:.1f}MB, {2} with problems'.format(
+        len(manifest), total / 2. ** 20,
+        sum(entry.problem is not None for entry in manifest)))
+
+
+if __name__ == '__main__':
+    # Python is running this file as a script, not importing it.
+    main()
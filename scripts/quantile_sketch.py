@@ -0,0 +1,172 @@
+""" Streaming quantile estimates for IQR outlier thresholds
+
+The P-squared algorithm (Jain and Chlamtac 1985) keeps five markers per
+quantile, and updates them with each new value, so quartiles can be estimated
+from a series as it arrives, in constant memory, without keeping or sorting
+the series.
+
+For example, to find outliers in projections of each slice (an array of shape
+(# volumes, # slices)):
+
+    sketch = IQRSketch()
+    for row in projections:
+        sketch.update(row)
+    outliers = sketch.outliers(projections, 1.5, side='low')
+"""
+
+import numpy as np
+
+
+class P2Quantile(object):
+    """ P-squared estimate of quantile `p` for one or more series of values
+
+    Parameters
+    ----------
+    p : float
+        Quantile to estimate, between 0 and 1, e.g. 0.25 for first quartile.
+
+    Each call to ``update`` adds one value to each series, so several series
+    of the same length (e.g. one per slice) are estimated together.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self._first = [] # values before there are enough for the markers
+        self.heights = None
+        self.positions = None
+        self.desired = np.array([0, 2 * p, 4 * p, 2 + 2 * p, 4])
+        self.increments = np.array([0, p / 2, p, (1 + p) / 2, 1])
+
+    def update(self, x):
+        """ Add value(s) `x`, one for each series
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        self.count += 1
+        if self.heights is None:
+            self._first.append(x)
+            if self.count == 5:
+                self.heights = np.sort(np.array(self._first), axis=0)
+                self.positions = np.tile(np.arange(5.)[:, None],
+                                         (1, x.shape[0]))
+                self._first = []
+            return
+        q = self.heights
+        n = self.positions
+        # Find cell k with q[k] <= x < q[k + 1], extending the extremes
+        q[0] = np.minimum(q[0], x)
+        q[4] = np.maximum(q[4], x)
+        k = np.sum(x >= q[1:4], axis=0)
+        n += np.arange(5)[:, None] > k
+        self.desired += self.increments
+        # Adjust the middle markers towards their desired positions
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            move_up = (d >= 1) & (n[i + 1] - n[i] > 1)
+            move_down = (d <= -1) & (n[i - 1] - n[i] < -1)
+            step = np.where(move_up, 1., np.where(move_down, -1., 0.))
+            moving = step != 0
+            if not np.any(moving):
+                continue
+            with np.errstate(divide='ignore', invalid='ignore'):
+                parabolic = q[i] + step / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) /
+                    (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) /
+                    (n[i] - n[i - 1]))
+                neighbor = np.where(step > 0, q[i + 1], q[i - 1])
+                n_neighbor = np.where(step > 0, n[i + 1], n[i - 1])
+                linear = q[i] + step * (neighbor - q[i]) / (n_neighbor - n[i])
+            use_parabolic = (q[i - 1] < parabolic) & (parabolic < q[i + 1])
+            new = np.where(use_parabolic, parabolic, linear)
+            q[i] = np.where(moving, new, q[i])
+            n[i] += step
+
+    def value(self):
+        """ Current estimate of quantile for each series
+
+        Returns
+        -------
+        estimate : array
+            Quantile estimate, one per series. Exact (as ``np.percentile``)
+            while fewer than five values have been seen.
+        """
+        if self.count == 0:
+            raise ValueError('No values seen yet')
+        if self.heights is None:
+            return np.percentile(np.array(self._first), self.p * 100, axis=0)
+        return self.heights[2].copy()
+
+
+class IQRSketch(object):
+    """ Streaming first and third quartiles, for k * IQR outlier tests
+
+    Each call to ``update`` adds one value to each of one or more series.
+    """
+
+    def __init__(self):
+        self.q1 = P2Quantile(0.25)
+        self.q3 = P2Quantile(0.75)
+
+    @property
+    def count(self):
+        return self.q1.count
+
+    def update(self, x):
+        """ Add value(s) `x`, one for each series
+        """
+        self.q1.update(x)
+        self.q3.update(x)
+
+    def extend(self, values):
+        """ Add rows of `values`, in order, one row at a time
+        """
+        for row in np.asarray(values):
+            self.update(row)
+
+    def bounds(self, iqr_scale):
+        """ Return values `iqr_scale` * IQR below Q1 and above Q3
+
+        Parameters
+        ----------
+        iqr_scale : float
+            Multiple of the interquartile range.
+
+        Returns
+        -------
+        low : array
+            Q1 - iqr_scale * IQR, one per series.
+        high : array
+            Q3 + iqr_scale * IQR, one per series.
+        """
+        q1 = self.q1.value()
+        q3 = self.q3.value()
+        iqr = q3 - q1
+        return q1 - iqr_scale * iqr, q3 + iqr_scale * iqr
+
+    def outliers(self, values, iqr_scale, side='both'):
+        """ Return True where `values` are more than `iqr_scale` IQRs out
+
+        Parameters
+        ----------
+        values : array
+            Values to test, with last axis matching the number of series.
+        iqr_scale : float
+            Multiple of the interquartile range.
+        side : {'both', 'low', 'high'}, optional
+            Test for values below Q1, above Q3, or both.
+
+        Returns
+        -------
+        outliers : boolean array
+            Same shape as `values`.
+        """
+        low, high = self.bounds(iqr_scale)
+        values = np.asarray(values)
+        if len(low) == 1:
+            low, high = low[0], high[0]
+        if side == 'low':
+            return values < low
+        if side == 'high':
+            return values > high
+        return (values < low) | (values > high)
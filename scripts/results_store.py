@@ -0,0 +1,139 @@
+""" Store of per-volume QC metrics and outlier flags for many runs
+
+A store is a directory with one ``.npz`` shard per run, holding a column
+(array of length # volumes) for each metric and flag, and an ``index.tsv``
+file with one line per run, giving the group, subject and run (parsed from
+the filename), the number of volumes and the outlier volumes. New runs are
+appended to the index; if a run is stored again, the later line wins.
+
+Query runs for a subject without loading the other shards with::
+
+    columns = load_runs('qc_store', subject='sub01')
+"""
+
+import os
+import re
+import tempfile
+
+import numpy as np
+
+INDEX_FNAME = 'index.tsv'
+INDEX_FIELDS = ('filename', 'group', 'subject', 'run', 'n_vols', 'outliers',
+                'shard')
+
+RUN_NAME_RE = re.compile(r'(group\d+)_(sub\d+)_run(\d+)')
+
+
+def parse_run_name(filename):
+    """ Return group, subject and run from filename like group00_sub01_run1
+
+    Parameters
+    ----------
+    filename : str
+        Image filename, with or without directory and extension.
+
+    Returns
+    -------
+    group : str
+        e.g. 'group00', or '' if filename does not follow the naming scheme.
+    subject : str
+        e.g. 'sub01', or '' if filename does not follow the naming scheme.
+    run : str
+        e.g. '1', or '' if filename does not follow the naming scheme.
+    """
+    match = RUN_NAME_RE.search(os.path.basename(filename))
+    if match is None:
+        return '', '', ''
+    return match.groups()
+
+
+def write_run(store_directory, filename, columns, outliers):
+    """ Write shard for run `filename` and append it to the store index
+
+    Parameters
+    ----------
+    store_directory : str
+        Store directory; created if it does not exist.
+    filename : str
+        Image filename for the run.
+    columns : dict
+        Column name -> array with one value per volume.
+    outliers : sequence
+        Final outlier volume indices for the run.
+    """
+    if not os.path.isdir(store_directory):
+        os.makedirs(store_directory)
+    shard = os.path.splitext(os.path.basename(filename))[0] + '.npz'
+    fd, tmp_fname = tempfile.mkstemp(dir=store_directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fobj:
+        np.savez(fobj, **columns)
+    os.replace(tmp_fname, os.path.join(store_directory, shard))
+    n_vols = len(columns['volume']) if 'volume' in columns else 0
+    fields = ((os.path.basename(filename),) + tuple(parse_run_name(filename)) +
+              (str(n_vols), ','.join(str(i) for i in outliers), shard))
+    index_fname = os.path.join(store_directory, INDEX_FNAME)
+    new_index = not os.path.isfile(index_fname)
+    with open(index_fname, 'at') as fobj:
+        if new_index:
+            fobj.write('\t'.join(INDEX_FIELDS) + '\n')
+        fobj.write('\t'.join(fields) + '\n')
+
+
+def read_index(store_directory):
+    """ Return list of index entries (dicts) for runs in store
+
+    Parameters
+    ----------
+    store_directory : str
+        Store directory.
+
+    Returns
+    -------
+    entries : list
+        One dict per run with keys from ``INDEX_FIELDS``, in the order runs
+        were first stored. ``n_vols`` is an int and ``outliers`` a list of
+        ints.
+    """
+    entries = {}
+    with open(os.path.join(store_directory, INDEX_FNAME), 'rt') as fobj:
+        header = fobj.readline().rstrip('\n').split('\t')
+        for line in fobj:
+            entry = dict(zip(header, line.rstrip('\n').split('\t')))
+            entry['n_vols'] = int(entry['n_vols'])
+            entry['outliers'] = [int(i) for i in entry['outliers'].split(',')
+                                 if i]
+            entries[entry['filename']] = entry
+    return list(entries.values())
+
+
+def load_runs(store_directory, group=None, subject=None, run=None):
+    """ Load columns for runs matching `group`, `subject` and `run`
+
+    Only the shards of matching runs are read.
+
+    Parameters
+    ----------
+    store_directory : str
+        Store directory.
+    group : None or str, optional
+        Group to select, e.g. 'group00'. None for all groups.
+    subject : None or str, optional
+        Subject to select, e.g. 'sub01'. None for all subjects.
+    run : None or str or int, optional
+        Run to select, e.g. 1. None for all runs.
+
+    Returns
+    -------
+    runs : dict
+        Filename -> dict of column name -> array.
+    """
+    runs = {}
+    for entry in read_index(store_directory):
+        if ((group is not None and entry['group'] != group) or
+            (subject is not None and entry['subject'] != subject) or
+            (run is not None and entry['run'] != str(run))):
+            continue
+        with np.load(os.path.join(store_directory, entry['shard'])) as npz:
+            runs[entry['filename']] = dict((name, npz[name])
+                                           for name in npz.files)
+    return runs
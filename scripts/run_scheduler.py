@@ -0,0 +1,287 @@
+""" Schedule runs over workers, by subject and largest first, and checkpoint
+
+Runs are named like ``group00_sub01_run1.nii``. The runs for a subject are
+kept together as a batch, and go to the same logical worker in order. A
+logical worker has one run in progress at a time, so work shared by the runs
+of a subject (such as a subject mean brain template, see ``mean_template``)
+is done once by the first run and reused by the rest.
+
+Batches are handed out largest first (by the image sizes declared in the
+headers, see ``prescan``), each to the worker with least work so far, so big
+subjects start early and do not hold up the end of the sweep. Each worker
+takes runs from the front of its own queue; a worker with an empty queue
+steals a whole batch that has not been started from the back of the queue
+with most work left. Batches are never split between workers, so the runs of
+a subject are never processed at the same time.
+
+A checkpoint file records the report for each finished run as a JSON line,
+with the settings used, so an interrupted sweep can restart where it
+stopped. Runs whose image changed since they were checkpointed are run again.
+"""
+
+import os
+import json
+from collections import deque
+
+import results_store
+
+
+def subject_batches(paths, sizes):
+    """ Group runs by subject, largest first
+
+    Parameters
+    ----------
+    paths : sequence of str
+        Image filenames.
+    sizes : sequence of int
+        Size of each image (e.g. ``nbytes`` from ``prescan.scan_header``).
+
+    Returns
+    -------
+    batches : list
+        One list of indices into `paths` per subject (group and subject from
+        ``results_store.parse_run_name``), largest run first. Batches are in
+        order of decreasing total size. Images not following the naming
+        scheme each get their own batch.
+    """
+    batches = {}
+    for i, path in enumerate(paths):
+        group, subject, run = results_store.parse_run_name(path)
+        key = (group, subject) if subject else ('', path)
+        batches.setdefault(key, []).append(i)
+    batches = [sorted(batch, key=lambda i: (-sizes[i], i))
+               for batch in batches.values()]
+    return sorted(batches,
+                  key=lambda batch: (-sum(sizes[i] for i in batch), batch[0]))
+
+
+class WorkQueues(object):
+    """ Per-worker queues of task batches, with stealing from the busiest queue
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of logical workers.
+    """
+
+    def __init__(self, n_workers):
+        # Each queue holds batches (lists of tasks); the first batch of a
+        # queue has been started if its worker has popped a task from it
+        self.queues = [deque() for w in range(n_workers)]
+        self.started = [False] * n_workers
+        self.sizes = {}
+
+    def tasks(self, worker):
+        """ Tasks waiting in queue of `worker`, in order
+        """
+        return [i for batch in self.queues[worker] for i in batch]
+
+    def work_left(self, worker):
+        """ Total size of tasks waiting in queue of `worker`
+        """
+        return sum(self.sizes[i] for i in self.tasks(worker))
+
+    def _can_steal(self, worker):
+        # Last batch of queue can be stolen if it has not been started
+        queue = self.queues[worker]
+        return len(queue) > 1 or (len(queue) == 1 and
+                                  not self.started[worker])
+
+    def assign(self, batches, sizes):
+        """ Add `batches` of tasks, each batch to the least loaded worker
+
+        Parameters
+        ----------
+        batches : sequence of sequences of int
+            Batches of task indices, e.g. from ``subject_batches``. Tasks in a
+            batch go to the same worker, in order.
+        sizes : sequence of int
+            Size of each task.
+        """
+        for batch in batches:
+            for i in batch:
+                self.sizes[i] = sizes[i]
+            worker = min(range(len(self.queues)), key=self.work_left)
+            self.queues[worker].append(list(batch))
+
+    def _next(self, worker, remove):
+        queue = self.queues[worker]
+        if not queue:
+            victims = [w for w in range(len(self.queues))
+                       if self._can_steal(w)]
+            if not victims:
+                return None
+            victim = max(victims, key=self.work_left)
+            batch = self.queues[victim][-1]
+            if not remove:
+                return batch[0]
+            queue.append(self.queues[victim].pop())
+            self.started[worker] = False
+        batch = queue[0]
+        task = batch[0]
+        if remove:
+            del batch[0]
+            self.started[worker] = True
+            if not batch:
+                queue.popleft()
+                self.started[worker] = False
+        return task
+
+    def peek(self, worker):
+        """ Return task `worker` would get from ``pop``, without removing it
+        """
+        return self._next(worker, False)
+
+    def pop(self, worker):
+        """ Return next task for `worker`, or None if there are no tasks left
+
+        Takes from the front of the worker's queue, or, if that is empty,
+        steals the last batch not yet started from the queue with most work
+        left. Returns None if there is no task the worker can take.
+        """
+        return self._next(worker, True)
+
+
+def file_state(path):
+    """ Return (size, mtime) of file `path`, to check it has not changed
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def run_state(path, sources=None):
+    """ Return state of image `path`, to check the run has not changed
+
+    Parameters
+    ----------
+    path : str
+        Image filename.
+    sources : None or sequence of str, optional
+        Other image files the report for `path` depends on, such as the runs
+        averaged into a subject template. Their names and states are part of
+        the run state, so adding, removing or changing any of them changes
+        it.
+
+    Returns
+    -------
+    state : list
+        ``file_state(path)`` if `sources` is None.
+    """
+    state = file_state(path)
+    if sources is None:
+        return state
+    return [state, [[os.path.basename(source)] + file_state(source)
+                    for source in sources]]
+
+
+def read_checkpoint(checkpoint, settings):
+    """ Return reports for runs finished with `settings` from `checkpoint`
+
+    Parameters
+    ----------
+    checkpoint : str
+        Checkpoint filename. Missing file means no runs are finished.
+    settings : dict
+        Settings for the sweep; runs checkpointed with other settings are
+        not used.
+
+    Returns
+    -------
+    reports : dict
+        Image path -> (file state, report) for finished runs.
+    """
+    reports = {}
+    if not os.path.isfile(checkpoint):
+        return reports
+    with open(checkpoint, 'rt') as fobj:
+        for line in fobj:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Partly written last line, from an interrupted sweep
+                continue
+            if entry['settings'] == settings:
+                reports[entry['path']] = (entry['state'], entry['report'])
+    return reports
+
+
+def finished_reports(checkpoint, settings, paths, sources=None):
+    """ Return reports in `checkpoint` for `paths` that have not changed
+
+    Parameters
+    ----------
+    checkpoint : str
+        Checkpoint filename.
+    settings : dict
+        Settings for the sweep.
+    paths : sequence of str
+        Image filenames.
+    sources : None or sequence, optional
+        For each image, None or the other image files its report depends on
+        (see ``run_state``).
+
+    Returns
+    -------
+    reports : dict
+        Index into `paths` -> report, for finished runs.
+    """
+    entries = read_checkpoint(checkpoint, settings)
+    if sources is None:
+        sources = [None] * len(paths)
+    reports = {}
+    for i, path in enumerate(paths):
+        if (path in entries and
+            entries[path][0] == run_state(path, sources[i])):
+            reports[i] = entries[path][1]
+    return reports
+
+
+def open_checkpoint(checkpoint):
+    """ Open `checkpoint` for appending, dropping any partly written last line
+
+    An interrupted sweep can leave a partial last line; appending after it
+    would also spoil the first new entry.
+
+    Parameters
+    ----------
+    checkpoint : str
+        Checkpoint filename. Created if missing.
+
+    Returns
+    -------
+    fobj : file object
+        Checkpoint file, open for appending.
+    """
+    if os.path.isfile(checkpoint):
+        with open(checkpoint, 'rb+') as fobj:
+            contents = fobj.read()
+            if contents and not contents.endswith(b'\n'):
+                fobj.truncate(contents.rfind(b'\n') + 1)
+    return open(checkpoint, 'at')
+
+
+def append_checkpoint(fobj, path, report, settings, sources=None):
+    """ Append `report` for run `path` to open checkpoint file `fobj`
+
+    Parameters
+    ----------
+    fobj : file object
+        Checkpoint file, open for appending.
+    path : str
+        Image filename.
+    report : dict
+        Report for run; only ``outliers`` and ``detector_outliers`` are
+        saved.
+    settings : dict
+        Settings for the sweep.
+    sources : None or sequence of str, optional
+        Other image files the report depends on, see ``run_state``.
+    """
+    entry = {'path': path, 'state': run_state(path, sources),
+             'settings': settings,
+             'report': {'outliers': report['outliers'],
+                        'detector_outliers': report['detector_outliers']}}
+    fobj.write(json.dumps(entry, sort_keys=True) + '\n')
+    # Make sure entry survives a crash or reboot
+    fobj.flush()
+    os.fsync(fobj.fileno())
@@ -0,0 +1,204 @@
+""" Record time, bytes read and memory for each stage of processing a run
+
+Wrap each stage in ``stage``:
+
+    profiler = StageProfiler('group00_sub01_run1.nii')
+    with stage(profiler, 'load'):
+        ...
+    profiler.records
+
+Each record gives the wall and CPU time of the stage, the bytes read from
+storage during the stage (from ``/proc/self/io``; None where that is not
+available), the resident set size at the start of the stage and the peak
+resident set size during the stage. Images are memory-mapped, so their data
+are read in the stages that first use them, not when they are opened.
+
+On Linux the peak is reset at the start of each stage (through
+``/proc/self/clear_refs``), so it is the peak of that stage alone. Elsewhere
+it is the peak of the whole process so far, and only goes up from stage to
+stage.
+
+``stage`` does nothing when the profiler is None, so code can be profiled
+optionally without duplicating it.
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+
+def bytes_read():
+    """ Return bytes this process has read from storage, or None if unknown
+    """
+    try:
+        with open('/proc/self/io', 'rt') as fobj:
+            for line in fobj:
+                if line.startswith('read_bytes:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def peak_rss():
+    """ Return peak resident set size of this process in bytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _status_bytes(field):
+    # Value of memory `field` in /proc/self/status in bytes, or None
+    try:
+        with open('/proc/self/status', 'rt') as fobj:
+            for line in fobj:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """ Reset peak resident set size to the current size, if possible
+
+    Returns
+    -------
+    reset : bool
+        True if the peak was reset (Linux only).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'wt') as fobj:
+            fobj.write('5')
+    except (IOError, OSError):
+        return False
+    return _status_bytes('VmHWM') is not None
+
+
+def current_rss():
+    """ Return resident set size of this process in bytes, or None if unknown
+    """
+    return _status_bytes('VmRSS')
+
+
+class StageProfiler(object):
+    """ Collect a record per stage for processing file `filename`
+
+    Parameters
+    ----------
+    filename : str
+        Name of file being processed, for the records.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = []
+
+    @contextmanager
+    def stage(self, name):
+        """ Context manager recording stage `name`
+        """
+        start_read = bytes_read()
+        stage_peak = reset_peak_rss()
+        start_rss = current_rss()
+        start_cpu = time.process_time()
+        start_time = time.time()
+        start_wall = time.perf_counter()
+        try:
+            yield
+        finally:
+            end_read = bytes_read()
+            # High-water mark since the reset, or for the whole process
+            peak = _status_bytes('VmHWM') if stage_peak else None
+            self.records.append({
+                'file': self.filename,
+                'stage': name,
+                'pid': os.getpid(),
+                'start': start_time,
+                'wall': time.perf_counter() - start_wall,
+                'cpu': time.process_time() - start_cpu,
+                'bytes_read': (None if start_read is None else
+                               end_read - start_read),
+                'start_rss': start_rss,
+                'peak_rss': peak_rss() if peak is None else peak})
+
+
+@contextmanager
+def _no_stage():
+    yield
+
+
+def stage(profiler, name):
+    """ Context manager recording stage `name` with `profiler`, if not None
+    """
+    if profiler is None:
+        return _no_stage()
+    return profiler.stage(name)
+
+
+def write_records(fobj, records):
+    """ Write `records` to file object `fobj` as JSON lines
+    """
+    for record in records:
+        fobj.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def read_records(filename):
+    """ Return list of records from JSON lines file `filename`
+    """
+    with open(filename, 'rt') as fobj:
+        return [json.loads(line) for line in fobj if line.strip()]
+
+
+def summarize(records):
+    """ Totals over files for each stage
+
+    Parameters
+    ----------
+    records : sequence of dict
+        Stage records.
+
+    Returns
+    -------
+    summary : list
+        Tuples of (stage, # records, total wall time, total CPU time, total
+        bytes read, maximum peak RSS, maximum rise of RSS above the start of
+        the stage), in order of first appearance of each stage. Total bytes
+        read and the rise are None if not available.
+    """
+    totals = {}
+    for record in records:
+        if record['stage'] not in totals:
+            totals[record['stage']] = [0, 0., 0., 0, 0, 0]
+        total = totals[record['stage']]
+        total[0] += 1
+        total[1] += record['wall']
+        total[2] += record['cpu']
+        total[3] = (None if total[3] is None or record['bytes_read'] is None
+                    else total[3] + record['bytes_read'])
+        total[4] = max(total[4], record['peak_rss'])
+        start_rss = record.get('start_rss')
+        total[5] = (None if total[5] is None or start_rss is None
+                    else max(total[5], record['peak_rss'] - start_rss))
+    return [(name,) + tuple(total) for name, total in totals.items()]
+
+
+def format_summary(records):
+    """ Return summary of `records` (see ``summarize``) as text table
+    """
+    lines = ['{0:24s} {1:>6s} {2:>10s} {3:>10s} {4:>10s} {5:>10s} '
+             '{6:>10s}'.format('stage', 'count', 'wall s', 'cpu s', 'read MB',
+                               'peak MB', 'rise MB')]
+    for name, count, wall, cpu, n_read, rss, rise in summarize(records):
+        read_mb = ('n/a' if n_read is None else
+                   '{0:.1f}'.format(n_read / 2. ** 20))
+        rise_mb = 'n/a' if rise is None else '{0:.1f}'.format(rise / 2. ** 20)
+        lines.append(
+            '{0:24s} {1:6d} {2:10.3f} {3:10.3f} {4:>10s} {5:10.1f} '
+            '{6:>10s}'.format(name, count, wall, cpu, read_mb, rss / 2. ** 20,
+                              rise_mb))
+    return '\n'.join(lines)
@@ -3,40 +3,223 @@
 Run as:
 
     python3 scripts/validata_data.py data
+
+Hashes of files that have not changed since the last run are taken from a
+cache in the data directory. To re-hash all the files, run as:
+
+    python3 scripts/validata_data.py data --full
+
+To also check the headers of the images (4D, enough volumes, numeric data,
+file as long as the header says), without reading the image data:
+
+    python3 scripts/validata_data.py data --headers
 """
 
 import os
-import sys
+import json
+import time
 import hashlib
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import prescan
+
+# Number of bytes to read from a file at a time when hashing
+BLOCK_SIZE = 2 ** 20
 
-def file_hash(filename):
+# Name of file in data directory caching hashes of unchanged files
+CACHE_FNAME = '.validate_cache.json'
+
+# Files modified more recently than this many seconds are not cached, because
+# a write within the file system timestamp resolution may not change mtime
+MTIME_RESOLUTION = 2
+
+
+def file_hash(filename, block_size=BLOCK_SIZE):
     """ Get byte contents of file `filename`, return SHA1 hash
 
+    The file is read in blocks of `block_size` bytes, so memory use does not
+    depend on the size of the file.
+
     Parameters
     ----------
     filename : str
         Name of file to read
+    block_size : int, optional
+        Number of bytes to read at a time.
 
     Returns
     -------
     hash : str
         SHA1 hexadecimal hash string for contents of `filename`.
     """
-    # Open the file, read contents as bytes.
-    fobj = open(filename, 'rb')
-    contents = fobj.read()
-    fobj.close()
+    sha1 = hashlib.sha1()
+    # Read into the same buffer each time, rather than making new bytes
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(filename, 'rb') as fobj:
+        while True:
+            n_read = fobj.readinto(buffer)
+            if not n_read:
+                break
+            # Calculate SHA1 hash on the bytes from the file.
+            sha1.update(view[:n_read])
+    return sha1.hexdigest()
+
+
+def file_stat(path):
+    """ Return size, modification time (ns) and inode for file `path`
+
+    Parameters
+    ----------
+    path : str
+        File path.
+
+    Returns
+    -------
+    stat : list
+        ``[size, mtime_ns, inode]``.
+    """
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def read_cache(data_directory):
+    """ Read validation cache for `data_directory`
+
+    Parameters
+    ----------
+    data_directory : str
+        Directory containing data and ``data_hashes.txt`` file.
+
+    Returns
+    -------
+    cache : dict
+        Filename -> dict with ``stat`` (see ``file_stat``) and the ``hash``
+        calculated for the file with that stat. Empty dict if there is no
+        cache, or the cache cannot be read.
+    """
+    try:
+        with open(os.path.join(data_directory, CACHE_FNAME), 'rt') as fobj:
+            cache = json.load(fobj)
+    except (IOError, OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def write_cache(data_directory, new_entries):
+    """ Add `new_entries` to validation cache for `data_directory`
+
+    The cache is re-read and written while holding a lock on a lock file
+    next to the cache (where ``fcntl`` is available), so entries written by
+    other processes in the meantime are kept. The new cache is written to a
+    temporary file and then renamed, so readers never see a partial cache.
+    Failure to write the cache (e.g. read-only data directory) is ignored.
+
+    Parameters
+    ----------
+    data_directory : str
+        Directory containing data and ``data_hashes.txt`` file.
+    new_entries : dict
+        Filename -> cache entry, as for ``read_cache``.
+    """
+    if not new_entries:
+        return
+    cache_fname = os.path.join(data_directory, CACHE_FNAME)
+    try:
+        lock_fobj = open(cache_fname + '.lock', 'a')
+    except (IOError, OSError):
+        return
+    with lock_fobj:
+        if fcntl is not None:
+            # Released when the lock file is closed
+            fcntl.flock(lock_fobj.fileno(), fcntl.LOCK_EX)
+        cache = read_cache(data_directory)
+        cache.update(new_entries)
+        try:
+            fd, tmp_fname = tempfile.mkstemp(dir=data_directory,
+                                             prefix=CACHE_FNAME + '.')
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wt') as fobj:
+                json.dump(cache, fobj)
+            os.replace(tmp_fname, cache_fname)
+        except (IOError, OSError):
+            os.unlink(tmp_fname)
+
+
+def check_file(data_directory, expected_hash, filename, cache_entry=None):
+    """ Check hash of `filename`, using cached hash if file is unchanged
+
+    Parameters
+    ----------
+    data_directory : str
+        Directory containing `filename`.
+    expected_hash : str
+        SHA1 hash recorded for `filename`.
+    filename : str
+        Name of file within `data_directory`.
+    cache_entry : None or dict, optional
+        Cached ``stat`` and ``hash`` for this file. If the file still has the
+        same size, modification time and inode, the cached hash is used
+        instead of reading the file.
+
+    Returns
+    -------
+    problem : None or str
+        None if hash of `filename` is `expected_hash`, otherwise message
+        saying what is wrong.
+    new_entry : None or dict
+        New cache entry for this file, or None if there is nothing to cache.
+    """
+    path = os.path.join(data_directory, filename)
+    new_entry = None
+    try:
+        stat = file_stat(path)
+        if cache_entry is not None and cache_entry.get('stat') == stat:
+            fhash = cache_entry['hash']
+        else:
+            fhash = file_hash(path)
+            # Only cache the hash if the file did not change while we were
+            # reading it, and was not modified so recently that a further
+            # write could leave the modification time unchanged.
+            if (file_stat(path) == stat and
+                time.time() - stat[1] / 1e9 > MTIME_RESOLUTION):
+                new_entry = {'stat': stat, 'hash': fhash}
+    except (IOError, OSError):
+        return 'Missing file: ' + path, None
+    if fhash != expected_hash:
+        return 'Hash mismatch in file: ' + path, new_entry
+    return None, new_entry
 
-    # Calculate, return SHA1 has on the bytes from the file.
-    return hashlib.sha1(contents).hexdigest()
 
-def validate_data(data_directory):
+def validate_data(data_directory, n_threads=None, full=False, headers=False):
     """ Read ``data_hashes.txt`` file in `data_directory`, check hashes
 
+    Files are checked in a pool of threads (hashing releases the GIL), and all
+    files are checked before reporting any problems.
+
+    Hashes are cached in a ``.validate_cache.json`` file in `data_directory`,
+    with the size, modification time and inode of each file, so files that
+    have not changed since the last validation are not read again.
+
     Parameters
     ----------
     data_directory : str
         Directory containing data and ``data_hashes.txt`` file.
+    n_threads : None or int, optional
+        Number of threads to use. None uses the ``ThreadPoolExecutor`` default.
+    full : bool, optional
+        If True, ignore the cache and re-hash every file.
+    headers : bool, optional
+        If True, also check the headers of ``.nii`` images (see ``prescan``).
 
     Returns
     -------
@@ -46,24 +229,44 @@ def validate_data(data_directory):
     ------
     ValueError:
         If hash value for any file is different from hash value recorded in
-        ``data_hashes.txt`` file.
+        ``data_hashes.txt`` file, or any file is missing, or (with `headers`)
+        any image has a bad header. The message lists all such files.
     """
     # Read lines from ``data_hashes.txt`` file.
-    fobj = open(data_directory+'/data_hashes.txt', 'rt')
-    lines = fobj.readlines()
-    fobj.close()
+    with open(os.path.join(data_directory, 'data_hashes.txt'), 'rt') as fobj:
+        lines = fobj.readlines()
 
     # Split into SHA1 hash and filename
-    split_lines = [line.split() for line in lines]
+    split_lines = [line.split() for line in lines if line.strip()]
+
+    cache = {} if full else read_cache(data_directory)
+
+    # Calculate actual hash for each filename, compare to recorded hash.
+    def check(line):
+        return check_file(data_directory, line[0], line[1],
+                          cache.get(line[1]))
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        results = list(pool.map(check, split_lines))
 
-    # Calculate actual hash for given filename.
-    for line in split_lines:
-        fhash = file_hash(data_directory+'/'+line[1])
+    write_cache(data_directory,
+                dict((line[1], new_entry) for line, (problem, new_entry)
+                     in zip(split_lines, results) if new_entry is not None))
 
-        # If hash for filename is not the same as the one in the file, raise
-        # ValueError
-        if fhash != line[0]:
-            raise ValueError('Hash mismatch in file: data/'+line[1])
+    # If hash for any filename is not the same as the one in the file, raise
+    # ValueError
+    problems = [problem for problem, new_entry in results
+                if problem is not None]
+    if headers:
+        for line, (problem, new_entry) in zip(split_lines, results):
+            if problem is None and line[1].endswith(('.nii', '.nii.gz')):
+                entry = prescan.scan_header(os.path.join(data_directory,
+                                                         line[1]))
+                if entry.problem is not None:
+                    problems.append('Bad image header in file: {0}: '
+                                    '{1}'.format(entry.path, entry.problem))
+    if problems:
+        raise ValueError('\n'.join(problems))
 
     print('Files validated.')
 
@@ -73,12 +276,17 @@ def main():
     # This function (main) called when this file run as a script.
     #
     # Get the data directory from the command line arguments
-    if len(sys.argv) < 2:
-        raise RuntimeError("Please give data directory on "
-                           "command line")
-    data_directory = sys.argv[1]
+    parser = argparse.ArgumentParser(
+        description='Check data files against data_hashes.txt')
+    parser.add_argument('data_directory',
+                        help='Directory containing data_hashes.txt and data')
+    parser.add_argument('--full', action='store_true',
+                        help='Re-hash all files, ignoring cached hashes')
+    parser.add_argument('--headers', action='store_true',
+                        help='Also check image headers')
+    args = parser.parse_args()
     # Call function to validate data in data directory
-    validate_data(data_directory)
+    validate_data(args.data_directory, full=args.full, headers=args.headers)
 
 
 if __name__ == '__main__':
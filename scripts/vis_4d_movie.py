@@ -14,7 +14,7 @@ issues; should probably be much nicer!!**
 
 import sys
 import numpy as np
-import nibabel as nib
+import image_loader
 import matplotlib.pyplot as plt
 import time
 
@@ -42,7 +42,7 @@ def display_4d(img, filename, nrows, ncols):
 
     """
 
-    data = img.get_data()
+    data = image_loader.image_data(img)
 
     nslices = nrows*ncols
 
@@ -70,7 +70,7 @@ def display_4d(img, filename, nrows, ncols):
 def main():
     # Get the first command line argument
     filename = sys.argv[1]
-    img = nib.load(filename)
+    img = image_loader.load_image(filename)
 
     #decide number of slices to display: nrows*ncols
     nrows = 3
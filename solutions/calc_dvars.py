@@ -35,7 +35,7 @@ import numpy as np
 import nibabel as nib
 
 
-def calc_image_dvars(img):
+def calc_image_dvars(img, dtype=np.float64):
     """ Root mean squared difference between volumes in `img`.
 
     Parameters
@@ -43,6 +43,12 @@ def calc_image_dvars(img):
     img : image object
         nibabel image object containing 4D file, with last dimension length
         ``t``.
+    dtype : numpy dtype, optional
+        Precision for the differences between volumes. With ``np.float32``
+        the squared differences are summed in float64. For integer data, an
+        integer type wider than the data type (e.g. ``np.int32`` for
+        ``np.int16`` data), so it can hold the differences, gives exact sums
+        of squares, in int64.
 
     Returns
     -------
@@ -58,10 +64,25 @@ def calc_image_dvars(img):
     # Return the square root of these values.
     # LAB(begin solution)
     data = img.get_data()
-    diff_2 = np.diff(data, axis=-1) ** 2
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        if data.dtype.kind not in 'iu':
+            raise ValueError('Integer precision needs integer data')
+        if (not np.can_cast(data.dtype, dtype) or
+            dtype.itemsize <= data.dtype.itemsize):
+            raise ValueError('{0} too narrow for differences of {1} '
+                             'data'.format(dtype, data.dtype))
+    # Differences made directly in dtype, without a converted copy of data
+    diff = np.subtract(data[..., 1:], data[..., :-1], dtype=dtype)
     n_voxels = np.prod(data.shape[:-1])
-    voxels_by_t = diff_2.reshape((n_voxels, -1))
-    return np.sqrt(np.sum(voxels_by_t, axis=0) / n_voxels)
+    voxels_by_t = diff.reshape((n_voxels, -1))
+    if dtype.kind in 'iu':
+        sum_sq = np.einsum('it,it->t', voxels_by_t, voxels_by_t,
+                           dtype=np.int64)
+    else:
+        voxels_by_t **= 2
+        sum_sq = np.sum(voxels_by_t, axis=0, dtype=np.float64)
+    return np.sqrt(sum_sq / n_voxels)
     # LAB(replace solution)
     # raise RuntimeError('No code yet')
     # LAB(end solution)
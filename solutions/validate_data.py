@@ -8,34 +8,56 @@ Run as:
 import os
 import sys
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
-def file_hash(filename):
+# Number of bytes to read from a file at a time when hashing
+BLOCK_SIZE = 2 ** 20
+
+
+def file_hash(filename, block_size=BLOCK_SIZE):
     """ Get byte contents of file `filename`, return SHA1 hash
 
     Parameters
     ----------
     filename : str
         Name of file to read
+    block_size : int, optional
+        Number of bytes to read at a time.
 
     Returns
     -------
     hash : str
         SHA1 hexadecimal hash string for contents of `filename`.
     """
-    # Open the file, read contents as bytes.
+    # Open the file, read contents as bytes, one block at a time.
     # Calculate, return SHA1 has on the bytes from the file.
+    sha1 = hashlib.sha1()
     with open(filename, 'rb') as fobj:
-        contents = fobj.read()
-    return hashlib.sha1(contents).hexdigest()
+        for block in iter(lambda: fobj.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def check_file(data_directory, hash, filename):
+    """ Return description of problem with `filename`, or None if it is OK
+    """
+    path = os.path.join(data_directory, filename)
+    if not os.path.isfile(path):
+        return "{} is missing".format(filename)
+    if hash != file_hash(path):
+        return "Hash for {} does not match".format(filename)
+    return None
 
 
-def validate_data(data_directory):
+def validate_data(data_directory, n_threads=None):
     """ Read ``data_hashes.txt`` file in `data_directory`, check hashes
 
     Parameters
     ----------
     data_directory : str
         Directory containing data and ``data_hashes.txt`` file.
+    n_threads : None or int, optional
+        Number of threads to check files with.
 
     Returns
     -------
@@ -45,18 +67,23 @@ def validate_data(data_directory):
     ------
     ValueError:
         If hash value for any file is different from hash value recorded in
-        ``data_hashes.txt`` file.
+        ``data_hashes.txt`` file, or any file is missing. The message lists
+        all such files.
     """
     # Read lines from ``data_hashes.txt`` file.
-    for line in open(os.path.join(data_directory, 'data_hashes.txt'), 'rt'):
-        # Split into SHA1 hash and filename
-        hash, filename = line.strip().split()
-        # Calculate actual hash for given filename.
-        actual_hash = file_hash(os.path.join(data_directory, filename))
-        # If hash for filename is not the same as the one in the file, raise
-        # ValueError
-        if hash != actual_hash:
-            raise ValueError("Hash for {} does not match".format(filename))
+    # Split into SHA1 hash and filename
+    with open(os.path.join(data_directory, 'data_hashes.txt'), 'rt') as fobj:
+        entries = [line.strip().split() for line in fobj if line.strip()]
+    # Calculate actual hash for given filenames, in several threads.
+    with ThreadPoolExecutor(n_threads) as pool:
+        problems = [problem for problem in
+                    pool.map(lambda entry: check_file(data_directory, *entry),
+                             entries)
+                    if problem is not None]
+    # If hash for any filename is not the same as the one in the file, raise
+    # ValueError
+    if problems:
+        raise ValueError('\n'.join(problems))
 
 
 def main():
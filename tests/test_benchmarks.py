@@ -0,0 +1,46 @@
+""" Tests for benchmark synthetic images and runner
+"""
+
+import os
+import sys
+
+import numpy as np
+
+import nibabel as nib
+
+MY_DIRECTORY = os.path.dirname(__file__)
+BENCHMARKS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'benchmarks')
+sys.path.append(BENCHMARKS_DIRECTORY)
+
+import synthetic
+import run_benchmarks
+
+
+def test_synthetic_image(tmpdir):
+    shape = (10, 12, 9, 30)
+    for dtype in (np.int16, np.float32):
+        path = synthetic.synthetic_image(str(tmpdir), shape, dtype)
+        assert os.path.basename(path) == synthetic.image_name(shape, dtype)
+        img = nib.load(path)
+        assert img.shape == shape
+        assert img.get_data_dtype() == dtype
+        expected = np.stack(list(synthetic.iter_synthetic_volumes(shape,
+                                                                  dtype)),
+                            axis=-1)
+        assert np.all(np.asanyarray(img.dataobj) == expected)
+    spikes, motion = synthetic.outlier_volumes(shape[3])
+    assert len(spikes) == synthetic.N_SPIKES
+    assert len(motion) == synthetic.N_MOTION
+    assert set(spikes).isdisjoint(motion)
+
+
+def test_run_one(tmpdir):
+    path = synthetic.synthetic_image(str(tmpdir), (8, 9, 6, 20))
+    for name in run_benchmarks.BENCHMARKS:
+        result = run_benchmarks.run_one(name, path, repeat=2)
+        assert len(result['times']) == 2
+        assert result['best'] == min(result['times'])
+        assert result['peak_memory'] >= result['start_memory'] >= 0
+    # Arrays made by the benchmark are counted, such as the projections
+    result = run_benchmarks.run_one('projection_on_mean', path, repeat=1)
+    assert result['peak_memory'] - result['start_memory'] >= 20 * 6 * 8
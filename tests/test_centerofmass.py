@@ -0,0 +1,42 @@
+""" Tests for center of mass calculation
+"""
+
+import os
+import sys
+
+import numpy as np
+from scipy import ndimage
+
+import nibabel as nib
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SMALL_4D = os.path.join(MY_DIRECTORY, 'small_4d.nii')
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import calc_centerofmass
+
+
+def test_image_com():
+    img = nib.load(SMALL_4D)
+    data = img.get_data()
+    expected = [ndimage.center_of_mass(data[..., v])
+                for v in range(data.shape[-1])]
+    com = calc_centerofmass.calc_image_COM(img)
+    assert com.shape == (data.shape[-1], 3)
+    assert np.allclose(com, expected)
+    # Same result processing a few volumes at a time
+    for chunk_size in (1, 3):
+        assert np.allclose(
+            calc_centerofmass.calc_image_COM(None, data, chunk_size), expected)
+
+
+def test_outlier_coords():
+    rng = np.random.RandomState(0)
+    com = 10 + rng.normal(scale=0.01, size=(50, 3))
+    com[20] += 1
+    as_tuples = [tuple(c) for c in com]
+    outliers = calc_centerofmass.get_outlier_coords(com, 1, 'test', 0)
+    assert 20 in outliers
+    assert outliers == calc_centerofmass.get_outlier_coords(as_tuples, 1,
+                                                            'test', 0)
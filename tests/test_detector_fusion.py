@@ -0,0 +1,47 @@
+""" Tests for combining detector outliers
+"""
+
+import os
+import sys
+
+import numpy as np
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import detector_fusion as df
+
+
+def test_dilate_mask():
+    mask = df.outlier_mask([0, 5], 8)
+    assert np.all(df.dilate_mask(mask, 0) == mask)
+    assert np.flatnonzero(df.dilate_mask(mask, 1)).tolist() == [0, 1, 4, 5, 6]
+    assert np.flatnonzero(df.dilate_mask(mask, 2)).tolist() == [0, 1, 2, 3, 4,
+                                                                5, 6, 7]
+
+
+def test_fuse_outliers():
+    mean = [3, 10, 20, 30]
+    com = [4, 21, 40]
+    dvars = [10, 29]
+    # Default: outliers of first detector within 1 of outliers of all others
+    assert df.fuse_outliers([mean, com]) == [3, 20]
+    for i in mean:
+        expected = i in com or i + 1 in com or i - 1 in com
+        assert (i in df.fuse_outliers([mean, com])) == expected
+    assert df.fuse_outliers([mean, com, dvars]) == []
+    assert df.fuse_outliers([mean, com, dvars], votes='any') == [3, 10, 20, 30]
+    assert df.fuse_outliers([mean, com], tolerance=0) == []
+    # Without anchor, k of n detectors agree
+    assert df.fuse_outliers([mean, com, dvars], votes=2, tolerance=0,
+                            anchor=False) == [10]
+    assert df.fuse_outliers([mean], tolerance=0, anchor=False) == mean
+    # Tolerance decides agreement, but only flagged volumes are outliers
+    assert df.fuse_outliers([[12], [13]], 'all', 1, False, 20) == [12, 13]
+    assert df.fuse_outliers([[12], [12]], 'all', 1, False, 20) == [12]
+    assert df.fuse_outliers([mean, com, dvars], votes=2,
+                            anchor=False) == [3, 4, 10, 20, 21, 29, 30]
+    assert df.fuse_outliers([[], []]) == []
+    # Tolerance longer than the run
+    assert df.fuse_outliers([[0], [1]], tolerance=5) == [0]
@@ -5,6 +5,7 @@ import os
 import sys
 
 import numpy as np
+import pytest
 
 import nibabel as nib
 
@@ -23,3 +24,33 @@ def test_dvars():
     img = nib.load(SMALL_4D)
     rms_values = calc_dvars.calc_image_dvars(img)
     assert np.allclose(rms_values, EXPECTED_RMS)
+
+
+def test_dvars_chunks():
+    img = nib.load(SMALL_4D)
+    for chunk_size in (None, 1, 2, 10):
+        rms_values = calc_dvars.calc_image_dvars(img, chunk_size=chunk_size)
+        assert np.allclose(rms_values, EXPECTED_RMS)
+
+
+def test_dvars_precision():
+    img = nib.load(SMALL_4D)
+    # float32 differences, float64 accumulation
+    rms_values = calc_dvars.calc_image_dvars(img, dtype=np.float32)
+    assert np.allclose(rms_values, EXPECTED_RMS)
+    # Integer precision needs integer data
+    with pytest.raises(ValueError):
+        calc_dvars.calc_image_dvars(img, dtype=np.int32)
+    # Exact for integer data, including large differences
+    rng = np.random.RandomState(0)
+    data = rng.randint(-32768, 32768, size=(5, 6, 7, 8)).astype(np.int16)
+    diffs = np.diff(data.astype(np.int64), axis=-1)
+    expected = np.sqrt(np.sum(diffs ** 2, axis=(0, 1, 2)) / 210.)
+    for dtype in (np.int32, np.int64):
+        for chunk_size in (None, 3):
+            assert np.all(calc_dvars.calc_image_dvars(
+                None, data, dtype, chunk_size) == expected)
+    assert np.allclose(calc_dvars.calc_image_dvars(None, data), expected)
+    # Differences of int16 overflow int16
+    with pytest.raises(ValueError):
+        calc_dvars.calc_image_dvars(None, data, np.int16)
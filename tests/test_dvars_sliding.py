@@ -0,0 +1,42 @@
+""" Tests for sliding window dvars calculation
+"""
+
+import os
+import sys
+
+import numpy as np
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import dvars_sliding
+
+
+def slow_sliding_dvars(data, win):
+    # Direct calculation, averaging the window around each volume
+    dvars = []
+    for vol in range(win, data.shape[3]):
+        win_vols = np.concatenate((data[..., vol-win:vol],
+                                   data[..., vol+1:vol+win+1]), axis=3)
+        diff = data[..., vol] - win_vols.mean(axis=3)
+        dvars.append(np.sqrt(np.mean(diff ** 2)))
+    return np.array(dvars)
+
+
+def test_sliding_dvars():
+    rng = np.random.RandomState(42)
+    data = rng.normal(size=(4, 5, 6, 20))
+    for win in (1, 2, 3, 7):
+        dvars = dvars_sliding.calc_sliding_dvars(None, win, data)
+        assert dvars.shape == (20 - win,)
+        assert np.allclose(dvars, slow_sliding_dvars(data, win))
+        # Same values processing blocks of volumes
+        for chunk_size in (1, 4, 50):
+            assert np.allclose(
+                dvars_sliding.calc_sliding_dvars(None, win, data, chunk_size),
+                dvars)
+    # Integer data gives the same answer as float
+    int_data = rng.randint(-1000, 1000, size=(4, 5, 6, 12)).astype(np.int16)
+    assert np.allclose(dvars_sliding.calc_sliding_dvars(None, 2, int_data),
+                       slow_sliding_dvars(int_data.astype(float), 2))
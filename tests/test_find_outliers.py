@@ -0,0 +1,322 @@
+""" Tests for outlier detection over a data directory
+"""
+
+import os
+import sys
+
+import numpy as np
+
+import nibabel as nib
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import calc_centerofmass
+import find_outliers
+import image_loader
+import metric_cache
+import outliers_mean_brain
+import prescan
+import results_store
+import validate_data
+
+
+def make_data_directory(data_directory, n_runs=2):
+    # Write runs with a few displaced volumes, and data_hashes.txt
+    rng = np.random.RandomState(0)
+    i, j, k = np.meshgrid(np.arange(12), np.arange(14), np.arange(8),
+                          indexing='ij')
+    brain = 1000 * np.exp(-((i - 6) / 4.) ** 2 - ((j - 7) / 5.) ** 2 -
+                          ((k - 4) / 3.) ** 2)
+    lines = []
+    for run in range(1, n_runs + 1):
+        data = brain[..., None] + rng.normal(scale=10, size=(12, 14, 8, 40))
+        for t in (10 + run, 30):
+            data[..., t] = np.roll(brain, 2, axis=0) * 0.6
+        filename = 'group00_sub01_run{}.nii'.format(run)
+        path = os.path.join(data_directory, filename)
+        nib.save(nib.Nifti1Image(data.astype(np.int16), np.eye(4)), path)
+        lines.append(validate_data.file_hash(path) + ' ' + filename)
+    with open(os.path.join(data_directory, 'data_hashes.txt'), 'wt') as fobj:
+        fobj.write('\n'.join(lines) + '\n')
+
+
+def test_find_outliers(tmpdir):
+    data_directory = str(tmpdir.mkdir('data'))
+    make_data_directory(data_directory)
+    results = list(find_outliers.iter_run_outliers(data_directory))
+    assert results == [('group00_sub01_run1.nii', [11, 30]),
+                       ('group00_sub01_run2.nii', [12, 30])]
+    # Same results from worker processes
+    assert list(find_outliers.iter_run_outliers(data_directory,
+                                                jobs=2)) == results
+
+
+def test_single_load(tmpdir, monkeypatch):
+    data_directory = str(tmpdir.mkdir('data'))
+    make_data_directory(data_directory)
+    loads = []
+    image_data = image_loader.image_data
+
+    def counting_image_data(img):
+        loads.append(img)
+        return image_data(img)
+
+    for filename in ('group00_sub01_run1.nii', 'group00_sub01_run2.nii'):
+        path = os.path.join(data_directory, filename)
+        # Outliers as from each script loading the image separately
+        data_com = calc_centerofmass.calc_image_COM(nib.load(path))
+        outliers_com = calc_centerofmass.get_outlier_coords(
+            data_com, 1, filename, 0) or []
+        outliers_mean = outliers_mean_brain.mean_brain(path, 'z')
+        expected = [i for i in outliers_mean
+                    if i in outliers_com or i + 1 in outliers_com or
+                    i - 1 in outliers_com]
+        # Same from the registered detectors, with the image loaded once
+        monkeypatch.setattr(image_loader, 'image_data', counting_image_data)
+        del loads[:]
+        report = find_outliers.run_report(path, n_vols=40)
+        assert len(loads) == 1
+        assert report['detector_outliers']['mean'] == outliers_mean
+        assert report['outliers'] == expected
+        # Also when the detectors do not share a fused pass
+        del loads[:]
+        metrics = find_outliers.run_metrics(path, fused=False)
+        assert len(loads) == 1
+        assert np.allclose(metrics['mean']['projections'],
+                           find_outliers.run_metrics(path)['mean'][
+                               'projections'])
+        monkeypatch.undo()
+
+
+def test_fusion(tmpdir):
+    data_directory = str(tmpdir.mkdir('data'))
+    make_data_directory(data_directory)
+    path = os.path.join(data_directory, 'group00_sub01_run1.nii')
+    # Without anchor, only volumes flagged by some detector are reported
+    report = find_outliers.run_report(path, ('mean', 'com', 'dvars'),
+                                      fusion={'votes': 2, 'anchor': False})
+    flagged = set()
+    for outliers in report['detector_outliers'].values():
+        flagged.update(outliers)
+    assert 30 in report['outliers']
+    assert set(report['outliers']) <= flagged
+
+
+def test_jobs(tmpdir):
+    data_directory = str(tmpdir.mkdir('data'))
+    make_data_directory(data_directory, n_runs=4)
+    reports = list(find_outliers.iter_run_reports(data_directory,
+                                                  columns=True))
+    filenames = [f for f, r in reports]
+    assert filenames == sorted(filenames) and len(filenames) == 4
+    # Worker processes give the same reports, in the same order
+    for jobs in (2, 3, 8):
+        job_reports = list(find_outliers.iter_run_reports(
+            data_directory, jobs=jobs, columns=True))
+        assert [f for f, r in job_reports] == filenames
+        for (f, report), (f, job_report) in zip(reports, job_reports):
+            assert job_report['outliers'] == report['outliers']
+            assert (job_report['detector_outliers'] ==
+                    report['detector_outliers'])
+            for name, column in report['columns'].items():
+                assert np.allclose(job_report['columns'][name], column,
+                                   equal_nan=True)
+
+
+def test_metric_cache(tmpdir):
+    data_directory = str(tmpdir.mkdir('data'))
+    make_data_directory(data_directory)
+    cache = metric_cache.MetricCache(str(tmpdir.join('cache')))
+    results = list(find_outliers.iter_run_outliers(data_directory,
+                                                   cache=cache))
+    # Zero the image data; cached metrics mean they are not read again
+    for filename, outliers in results:
+        path = os.path.join(data_directory, filename)
+        entry = prescan.scan_header(path)
+        with open(path, 'r+b') as fobj:
+            fobj.seek(entry.offset)
+            fobj.write(b'\0' * entry.nbytes)
+    assert list(find_outliers.iter_run_outliers(data_directory,
+                                                cache=cache)) == results
+    # Thresholds are applied to cached metrics
+    strict = list(find_outliers.iter_run_outliers(
+        data_directory, thresholds={'slice_fraction': 1}, cache=cache))
+    assert strict == [(filename, []) for filename, outliers in results]
+    # Least recently used entries removed when over size limit
+    cache.max_bytes = 1
+    cache.evict()
+    assert os.listdir(cache.directory) == []
+
+
+def test_results_store(tmpdir):
+    data_directory = str(tmpdir.mkdir('data'))
+    make_data_directory(data_directory)
+    store = str(tmpdir.join('store'))
+    find_outliers.find_outliers(data_directory, store=store)
+    entries = results_store.read_index(store)
+    assert [(e['subject'], e['run'], e['n_vols'], e['outliers'])
+            for e in entries] == [('sub01', '1', 40, [11, 30]),
+                                  ('sub01', '2', 40, [12, 30])]
+    runs = results_store.load_runs(store, subject='sub01', run=2)
+    assert list(runs) == ['group00_sub01_run2.nii']
+    columns = runs['group00_sub01_run2.nii']
+    assert np.all(np.flatnonzero(columns['outlier']) == [12, 30])
+    assert len(columns['com_dvars']) == 40 and np.isnan(columns['com_dvars'][0])
+    assert columns['n_outlier_slices'][30] > 2
+    assert results_store.load_runs(store, subject='sub02') == {}
+
+
+def test_templates(tmpdir):
+    data_directory = str(tmpdir.mkdir('data'))
+    make_data_directory(data_directory)
+    templates = {'directory': str(tmpdir.join('templates'))}
+    results = list(find_outliers.iter_run_outliers(data_directory,
+                                                   templates=templates))
+    assert results == [('group00_sub01_run1.nii', [11, 30]),
+                       ('group00_sub01_run2.nii', [12, 30])]
+    assert sorted(os.listdir(templates['directory'])) == [
+        'group00_sub01_run1_mean.npz', 'group00_sub01_run2_mean.npz']
+    # Same outliers with subject templates
+    templates['subject'] = True
+    assert list(find_outliers.iter_run_outliers(
+        data_directory, templates=templates)) == results
+    # Template settings are part of the cache key
+    assert (find_outliers.metric_params('mean', {'stride': 2}) ==
+            {'ax': 'z', 'template_stride': 2})
+    assert find_outliers.metric_params('mean') == {'ax': 'z'}
+    # Metrics on subject templates are cached under all runs of the subject
+    assert find_outliers.metric_params('mean', templates) is None
+    assert find_outliers.metric_params('mean', templates, ['b', 'a']) == {
+        'ax': 'z', 'template_subject': True, 'template_sources': ['a', 'b']}
+    assert find_outliers.metric_params('com', templates) == {'window': 1}
+    cache = metric_cache.MetricCache(str(tmpdir.join('cache')))
+    checkpoint = str(tmpdir.join('checkpoint.jsonl'))
+    reports = list(find_outliers.iter_run_reports(
+        data_directory, detectors=('mean',), cache=cache, templates=templates,
+        checkpoint=checkpoint))
+    assert len(os.listdir(cache.directory)) == 2
+    # Changing one run changes the subject template, so neither run is
+    # taken from the checkpoint or the cache
+    path = os.path.join(data_directory, 'group00_sub01_run2.nii')
+    img = nib.load(path)
+    nib.save(nib.Nifti1Image(img.get_data() + 1, img.affine), path)
+    with open(os.path.join(data_directory, 'data_hashes.txt'), 'wt') as fobj:
+        for filename in ('group00_sub01_run1.nii', 'group00_sub01_run2.nii'):
+            fobj.write('{0} {1}\n'.format(validate_data.file_hash(
+                os.path.join(data_directory, filename)), filename))
+    reports = list(find_outliers.iter_run_reports(
+        data_directory, detectors=('mean',), cache=cache, columns=True,
+        templates=templates, checkpoint=checkpoint))
+    assert all('columns' in report for filename, report in reports)
+    assert len(os.listdir(cache.directory)) == 4
+
+
+def test_mean_axes(tmpdir):
+    data_directory = str(tmpdir.mkdir('data'))
+    make_data_directory(data_directory)
+    detectors = ('mean_xyz',)
+    results = list(find_outliers.iter_run_outliers(data_directory,
+                                                   detectors))
+    for filename, outliers in results:
+        assert 30 in outliers
+    # Fused pass gives the same metrics as the separate detector
+    path = os.path.join(data_directory, results[0][0])
+    fused = find_outliers.run_metrics(path, detectors)['mean_xyz']
+    separate = find_outliers.run_metrics(path, detectors,
+                                         fused=False)['mean_xyz']
+    assert sorted(fused) == ['projections_x', 'projections_y',
+                             'projections_z']
+    for name in fused:
+        assert np.allclose(fused[name], separate[name])
+    # z projections are those of the mean detector
+    mean = find_outliers.run_metrics(path, ('mean',))['mean']
+    assert np.allclose(fused['projections_z'], mean['projections'])
+    assert find_outliers.metric_params('mean_xyz', {'stride': 2}) == {
+        'axes': 'xyz', 'template_stride': 2}
+
+
+def test_profile(tmpdir):
+    data_directory = str(tmpdir.mkdir('data'))
+    make_data_directory(data_directory)
+    for jobs in (1, 2):
+        reports = list(find_outliers.iter_run_reports(data_directory,
+                                                      jobs=jobs,
+                                                      profile=True))
+        for filename, report in reports:
+            stages = [record['stage'] for record in report['profile']]
+            assert stages[0] == 'load'
+            assert 'fused_metrics' in stages and 'fusion' in stages
+            assert set(record['file'] for record in report['profile']) == {
+                filename}
+
+
+def test_checkpoint(tmpdir):
+    data_directory = str(tmpdir.mkdir('data'))
+    make_data_directory(data_directory, n_runs=3)
+    checkpoint = str(tmpdir.join('checkpoint.jsonl'))
+    results = list(find_outliers.iter_run_outliers(data_directory, jobs=2))
+    reports = list(find_outliers.iter_run_reports(data_directory, jobs=2,
+                                                  checkpoint=checkpoint))
+    assert [(f, r['outliers']) for f, r in reports] == results
+    with open(checkpoint, 'rt') as fobj:
+        first = fobj.readline()
+    for jobs in (1, 2):
+        # Keep first finished run only, as if interrupted
+        with open(checkpoint, 'wt') as fobj:
+            fobj.write(first)
+        reports = list(find_outliers.iter_run_reports(
+            data_directory, jobs=jobs, columns=True, checkpoint=checkpoint))
+        assert [(f, r['outliers']) for f, r in reports] == results
+        # Only the run from the checkpoint has no columns
+        assert sum('columns' not in r for f, r in reports) == 1
+        with open(checkpoint, 'rt') as fobj:
+            assert len(fobj.readlines()) == 3
+    # A report is only checkpointed once the caller has handled it
+    for jobs in (1, 2):
+        os.unlink(checkpoint)
+        reports = find_outliers.iter_run_reports(data_directory, jobs=jobs,
+                                                 checkpoint=checkpoint)
+        next(reports)
+        reports.close()
+        with open(checkpoint, 'rt') as fobj:
+            assert fobj.read() == ''
+        reports = find_outliers.iter_run_reports(data_directory, jobs=jobs,
+                                                 checkpoint=checkpoint)
+        next(reports)
+        next(reports)
+        reports.close()
+        with open(checkpoint, 'rt') as fobj:
+            assert len(fobj.readlines()) == 1
+
+
+def test_bad_headers(tmpdir):
+    data_directory = str(tmpdir.mkdir('data'))
+    make_data_directory(data_directory)
+    results = list(find_outliers.iter_run_outliers(data_directory))
+    # Bad images are reported from their headers, and other images processed
+    nib.save(nib.Nifti1Image(np.zeros((4, 4, 4), np.int16), np.eye(4)),
+             os.path.join(data_directory, 'group00_sub02_run1.nii'))
+    for jobs in (1, 2):
+        reports = list(find_outliers.iter_run_reports(data_directory,
+                                                      jobs=jobs,
+                                                      max_memory=1))
+        assert [(f, r['outliers']) for f, r in reports[:2]] == results
+        assert reports[2][0] == 'group00_sub02_run1.nii'
+        assert '3D' in reports[2][1]['problem']
+        assert list(find_outliers.iter_run_outliers(data_directory,
+                                                    jobs=jobs)) == results
+    # Images with bad headers are rejected even if their metrics are cached
+    cache = metric_cache.MetricCache(str(tmpdir.join('cache')))
+    assert list(find_outliers.iter_run_outliers(data_directory,
+                                                cache=cache)) == results
+    with open(os.path.join(data_directory, 'group00_sub01_run2.nii'),
+              'wb') as fobj:
+        fobj.write(b'not an image')
+    for jobs in (1, 2):
+        reports = list(find_outliers.iter_run_reports(
+            data_directory, jobs=jobs, cache=cache, columns=True))
+        assert [f for f, r in reports if 'problem' in r] == [
+            'group00_sub01_run2.nii', 'group00_sub02_run1.nii']
+        assert reports[0][1]['outliers'] == results[0][1]
@@ -0,0 +1,49 @@
+""" Tests for single pass computation of QC metrics
+"""
+
+import os
+import sys
+
+import numpy as np
+
+import nibabel as nib
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SMALL_4D = os.path.join(MY_DIRECTORY, 'small_4d.nii')
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import fused_metrics
+import calc_dvars
+import calc_centerofmass
+import outliers_mean_brain
+
+
+def test_fused_metrics(monkeypatch):
+    img = nib.load(SMALL_4D)
+    data = img.get_data()
+    templates = dict((ax, outliers_mean_brain.mean_img(data, ax)[0])
+                     for ax in range(3))
+    exp_dvars = calc_dvars.calc_image_dvars(img)
+    exp_com = calc_centerofmass.calc_image_COM(img)
+    # Blocks of 1 volume, blocks not dividing # volumes, one block
+    for chunk_size in (1, 4, data.shape[-1], None):
+        metrics = fused_metrics.fused_metrics(data, templates, chunk_size)
+        assert np.allclose(metrics['dvars'], exp_dvars)
+        assert np.allclose(metrics['com'], exp_com)
+        assert np.allclose(metrics['volume_sum'],
+                           data.sum(axis=(0, 1, 2)))
+        for ax, template in templates.items():
+            assert np.allclose(
+                metrics['projections'][ax],
+                outliers_mean_brain.projection_on_mean(data, template, ax))
+    # Same projections with slices split over threads
+    monkeypatch.setattr(outliers_mean_brain, 'MIN_THREAD_ELEMENTS', 1)
+    threaded = fused_metrics.fused_metrics(data, templates, n_threads=3)
+    for ax in templates:
+        assert np.allclose(threaded['projections'][ax],
+                           metrics['projections'][ax])
+    # No templates, no projections
+    metrics = fused_metrics.fused_metrics(data)
+    assert metrics['projections'] == {}
+    assert np.allclose(metrics['dvars'], exp_dvars)
@@ -0,0 +1,134 @@
+""" Tests for mean brain outlier detection
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import outliers_mean_brain as mb
+
+
+def test_projection_on_mean():
+    rng = np.random.RandomState(0)
+    data = rng.normal(size=(4, 5, 6, 7))
+    mean_brain = rng.normal(size=(4, 5, 6))
+    for ax in range(3):
+        # Direct calculation, slice by slice
+        n_slices = data.shape[ax]
+        expected = np.zeros((data.shape[3], n_slices))
+        for v in range(data.shape[3]):
+            for s in range(n_slices):
+                expected[v, s] = np.sum(np.take(data[..., v], s, axis=ax) *
+                                        np.take(mean_brain, s, axis=ax))
+        for chunk_size in (None, 1, 3):
+            projections = mb.projection_on_mean(data, mean_brain, ax,
+                                                chunk_size)
+            assert np.allclose(projections, expected)
+
+
+def test_otsu_thresholds():
+    filters = pytest.importorskip('skimage.filters')
+    rng = np.random.RandomState(1)
+    slices = np.concatenate([rng.normal(size=(5, 8, 9)),
+                             rng.gamma(2, 100, size=(5, 8, 9))])
+    expected = [filters.threshold_otsu(s) for s in slices]
+    assert np.allclose(mb.otsu_thresholds(slices), expected)
+    # Constant slices do not get thresholded
+    slices[2] = 3
+    assert mb.otsu_thresholds(slices)[2] == 3
+
+
+def test_mean_img():
+    filters = pytest.importorskip('skimage.filters')
+    rng = np.random.RandomState(2)
+    data = rng.gamma(2, 100, size=(6, 7, 8, 5))
+    for ax in range(3):
+        mean, thresh = mb.mean_img(data, ax)
+        assert thresh.shape == (1, data.shape[ax])
+        expected = data.mean(axis=3)
+        for s in range(data.shape[ax]):
+            img = np.take(expected, s, axis=ax)
+            t = filters.threshold_otsu(img)
+            assert np.allclose(thresh[0, s], t)
+            assert np.all(np.take(mean, s, axis=ax) == np.where(img < t, 0, img))
+
+
+def test_find_outlier_volumes():
+    rng = np.random.RandomState(3)
+    projections = rng.normal(size=(30, 8))
+    projections[5, :6] = -10
+    projections[9, 2] = -10
+    outliers, n_outliers = mb.find_outlier_volumes(projections)
+    assert outliers.dtype == bool and outliers.shape == (30, 8)
+    for s in range(8):
+        q75, q25 = np.percentile(projections[:, s], [75, 25])
+        expected = projections[:, s] < q25 - 1.5 * (q75 - q25)
+        assert np.all(outliers[:, s] == expected)
+    assert np.all(n_outliers == outliers.sum(axis=1))
+    assert n_outliers[5] >= 6 and n_outliers[9] >= 1
+
+
+def test_slice_groups():
+    assert mb.slice_groups(10, 3) == [slice(0, 3), slice(3, 6), slice(6, 10)]
+    assert mb.slice_groups(2, 4) == [slice(0, 1), slice(1, 2)]
+    assert mb.slice_groups(5, 1) == [slice(0, 5)]
+
+
+def test_work_threads():
+    assert mb.work_threads(None, 10) == 1
+    assert mb.work_threads(8, 10) == 8
+    assert mb.work_threads(64, 10) == 10
+    # Enough work for each thread
+    assert mb.work_threads(8, 10, 3 * mb.MIN_THREAD_ELEMENTS) == 3
+    assert mb.work_threads(8, 10, 10) == 1
+
+
+def test_threads(monkeypatch):
+    # Same results splitting slices over threads, even for little work
+    monkeypatch.setattr(mb, 'MIN_THREAD_ELEMENTS', 1)
+    rng = np.random.RandomState(2)
+    data = rng.normal(100, 10, size=(6, 7, 5, 20))
+    for ax in range(3):
+        mean_brain, thresh = mb.mean_img(data, ax)
+        projections = mb.projection_on_mean(data, mean_brain, ax)
+        for n_threads in (2, 3, 8):
+            t_mean_brain, t_thresh = mb.mean_img(data, ax,
+                                                 n_threads=n_threads)
+            assert np.allclose(t_mean_brain, mean_brain)
+            assert np.allclose(t_thresh, thresh)
+            t_projections = mb.projection_on_mean(data, mean_brain, ax, 7,
+                                                  n_threads)
+            assert np.allclose(t_projections, projections)
+            outliers, counts = mb.find_outlier_volumes(projections, 1.5)
+            t_outliers, t_counts = mb.find_outlier_volumes(
+                projections, 1.5, n_threads=n_threads)
+            assert np.all(t_outliers == outliers)
+            assert np.all(t_counts == counts)
+
+
+def test_mean_brain_axes(monkeypatch):
+    monkeypatch.setattr(mb, 'MIN_THREAD_ELEMENTS', 1)
+    # One pass for all axes gives the same as each axis on its own
+    rng = np.random.RandomState(4)
+    data = rng.normal(100, 10, size=(6, 7, 5, 20))
+    data[..., 8] *= 0.5
+    n_outliers = mb.mean_brain_axes_data(data, 'xyz', chunk_size=3)
+    assert n_outliers.shape == (3, 20)
+    mean_brains = {}
+    for ax in range(3):
+        mean_brains[ax] = mb.mean_img(data, ax)[0]
+        projections = mb.projection_on_mean(data, mean_brains[ax], ax)
+        outliers, expected = mb.find_outlier_volumes(projections)
+        assert np.all(n_outliers[ax] == expected)
+    projections = mb.projections_on_means(data, mean_brains, 7)
+    for ax in range(3):
+        assert np.allclose(projections[ax], mb.projection_on_mean(
+            data, mean_brains[ax], ax))
+    assert np.all(mb.mean_brain_axes_data(data, 'zx') == n_outliers[[2, 0]])
+    assert np.all(mb.mean_brain_axes_data(data, n_threads=2) == n_outliers)
@@ -0,0 +1,95 @@
+""" Tests for saved mean brain templates
+"""
+
+import os
+import sys
+
+import numpy as np
+
+import nibabel as nib
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import mean_template
+import outliers_mean_brain as mb
+
+
+def make_runs(directory, n_vols=(10, 6)):
+    rng = np.random.RandomState(0)
+    paths = []
+    for run, n in enumerate(n_vols, 1):
+        data = rng.normal(100, 10, size=(5, 6, 4, n)).astype(np.float32)
+        path = os.path.join(directory, 'group01_sub02_run{}.nii'.format(run))
+        nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+        paths.append(path)
+    return paths
+
+
+def test_threshold_mean():
+    rng = np.random.RandomState(1)
+    data = rng.normal(100, 10, size=(5, 6, 4, 8))
+    mean = mb.mean_volume(data)
+    assert np.allclose(mean, data.mean(axis=3))
+    assert np.allclose(mb.mean_volume(data, stride=3),
+                       data[..., [0, 3, 6]].mean(axis=3))
+    for ax in range(3):
+        thresholded, thresh = mb.threshold_mean(mean, ax)
+        exp_thresholded, exp_thresh = mb.mean_img(data, ax)
+        assert np.all(thresholded == exp_thresholded)
+        assert np.all(thresh == exp_thresh)
+    # Template is not changed by thresholding
+    assert np.allclose(mean, data.mean(axis=3))
+
+
+def test_run_template(tmpdir):
+    directory = str(tmpdir)
+    path = make_runs(directory)[0]
+    data = nib.load(path).get_data()
+    template = mean_template.run_template(path)
+    assert np.allclose(template, data.mean(axis=3))
+    template_fname = mean_template.template_filename(path)
+    assert template_fname == os.path.join(directory,
+                                          'group01_sub02_run1_mean.npz')
+    # Saved template is used, instead of reading the data
+    mean_template.save_template(template_fname, template + 1, [path])
+    assert np.allclose(mean_template.run_template(path), template + 1)
+    # Unless image changed since
+    os.utime(path, (0, 0))
+    assert np.allclose(mean_template.run_template(path), template)
+    # Run with the same name in another directory does not use the template
+    other_dir = str(tmpdir.mkdir('other'))
+    other = make_runs(other_dir, n_vols=(7,))[0]
+    other_data = nib.load(other).get_data()
+    assert os.path.basename(other) == os.path.basename(path)
+    assert np.allclose(mean_template.run_template(other, directory=directory),
+                       other_data.mean(axis=3))
+    assert np.allclose(mean_template.run_template(path), template)
+    # Strided template in its own file
+    strided = mean_template.run_template(path, stride=2)
+    assert np.allclose(strided, data[..., ::2].mean(axis=3))
+    assert os.path.isfile(mean_template.template_filename(path, 2))
+
+
+def test_subject_template(tmpdir):
+    directory = str(tmpdir.mkdir('data'))
+    template_dir = str(tmpdir.join('templates'))
+    paths = make_runs(directory)
+    all_data = np.concatenate([nib.load(path).get_data() for path in paths],
+                              axis=3)
+    assert mean_template.subject_runs(paths[1]) == paths
+    template = mean_template.subject_template(paths[1],
+                                              directory=template_dir)
+    assert np.allclose(template, all_data.mean(axis=3))
+    assert sorted(os.listdir(template_dir)) == [
+        'group01_sub02_mean.npz', 'group01_sub02_run1_mean.npz',
+        'group01_sub02_run2_mean.npz']
+    # Runs that cannot be processed are left out of the subject template
+    nib.save(nib.Nifti1Image(np.zeros((5, 6, 4), np.float32), np.eye(4)),
+             os.path.join(directory, 'group01_sub02_run3.nii'))
+    assert mean_template.subject_runs(paths[0]) == paths
+    os.remove(os.path.join(template_dir, 'group01_sub02_mean.npz'))
+    template = mean_template.subject_template(paths[0],
+                                              directory=template_dir)
+    assert np.allclose(template, all_data.mean(axis=3))
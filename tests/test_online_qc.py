@@ -0,0 +1,44 @@
+""" Tests for online (volume by volume) outlier detection
+"""
+
+import os
+import sys
+
+import numpy as np
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import calc_centerofmass
+import calc_dvars
+import dvars_sliding
+import online_qc
+
+
+def make_run(n_vols=40, spike=25):
+    rng = np.random.RandomState(0)
+    i, j, k = np.meshgrid(np.arange(12), np.arange(14), np.arange(8),
+                          indexing='ij')
+    brain = 1000 * np.exp(-((i - 6) / 4.) ** 2 - ((j - 7) / 5.) ** 2 -
+                          ((k - 4) / 3.) ** 2)
+    data = brain[..., None] + rng.normal(scale=10, size=brain.shape + (n_vols,))
+    data[..., spike] = np.roll(brain, 2, axis=0) * 0.6
+    return data
+
+
+def test_online_qc():
+    data = make_run()
+    qc = online_qc.OnlineQC(window=2)
+    for t in range(data.shape[-1]):
+        qc.add_volume(data[..., t])
+    # Series match the offline calculations
+    assert np.allclose(qc.dvars, calc_dvars.calc_image_dvars(None, data))
+    assert np.allclose(qc.com, calc_centerofmass.calc_image_COM(None, data))
+    com = calc_centerofmass.calc_image_COM(None, data).T.reshape((3, 1, 1, -1))
+    offline = dvars_sliding.calc_sliding_dvars(None, 2, com)
+    assert np.allclose(qc.com_dvars, offline[:len(qc.com_dvars)])
+    # The spike is flagged by all detectors
+    flags = set(qc.flags)
+    for detector in ('dvars', 'com', 'mean'):
+        assert (25, detector) in flags
@@ -0,0 +1,59 @@
+""" Tests for header pre-scan
+"""
+
+import os
+import sys
+
+import numpy as np
+
+import nibabel as nib
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SMALL_4D = os.path.join(MY_DIRECTORY, 'small_4d.nii')
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import prescan
+
+
+def test_scan_header():
+    img = nib.load(SMALL_4D)
+    entry = prescan.scan_header(SMALL_4D)
+    assert entry.problem is None
+    assert entry.shape == img.shape
+    assert entry.dtype == img.get_data_dtype()
+    assert entry.zooms == img.header.get_zooms()
+    assert entry.nbytes == np.prod(img.shape) * entry.dtype.itemsize
+    assert entry.offset == img.dataobj.offset
+    assert prescan.working_bytes(entry) > 0
+
+
+def test_scan_directory(tmpdir):
+    directory = str(tmpdir)
+    good = np.zeros((3, 4, 5, 6), dtype=np.int16)
+    nib.save(nib.Nifti1Image(good, np.eye(4)),
+             os.path.join(directory, 'a_good.nii'))
+    nib.save(nib.Nifti1Image(good[..., 0], np.eye(4)),
+             os.path.join(directory, 'b_3d.nii'))
+    nib.save(nib.Nifti1Image(good[..., :2], np.eye(4)),
+             os.path.join(directory, 'c_short.nii'))
+    nib.save(nib.Nifti1Image(good.astype(np.complex64), np.eye(4)),
+             os.path.join(directory, 'd_complex.nii'))
+    with open(os.path.join(directory, 'a_good.nii'), 'rb') as fobj:
+        contents = fobj.read()
+    with open(os.path.join(directory, 'e_truncated.nii'), 'wb') as fobj:
+        fobj.write(contents[:-10])
+    with open(os.path.join(directory, 'f_junk.nii'), 'wb') as fobj:
+        fobj.write(b'not an image')
+    manifest = prescan.scan_directory(directory)
+    assert [os.path.basename(e.path) for e in manifest] == [
+        'a_good.nii', 'b_3d.nii', 'c_short.nii', 'd_complex.nii',
+        'e_truncated.nii', 'f_junk.nii']
+    problems = [e.problem for e in manifest]
+    assert problems[0] is None
+    assert '3D' in problems[1]
+    assert 'volumes' in problems[2]
+    assert 'complex' in problems[3]
+    assert 'truncated' in problems[4]
+    assert 'Cannot read header' in problems[5]
+    assert manifest[5].shape is None
@@ -0,0 +1,56 @@
+""" Tests for streaming quantile estimates
+"""
+
+import os
+import sys
+
+import numpy as np
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import quantile_sketch
+import outliers_mean_brain as mb
+
+
+def test_iqr_sketch():
+    rng = np.random.RandomState(0)
+    values = np.column_stack([rng.normal(size=2000),
+                              rng.gamma(2, size=2000)])
+    sketch = quantile_sketch.IQRSketch()
+    sketch.extend(values)
+    assert sketch.count == 2000
+    assert np.allclose(sketch.q1.value(), np.percentile(values, 25, axis=0),
+                       atol=0.05)
+    assert np.allclose(sketch.q3.value(), np.percentile(values, 75, axis=0),
+                       atol=0.05)
+    # Several series together give the same estimates as one at a time
+    single = quantile_sketch.IQRSketch()
+    for value in values[:, 1]:
+        single.update(value)
+    assert np.allclose(single.q1.value(), sketch.q1.value()[1])
+    # Exact for fewer than five values
+    few = quantile_sketch.IQRSketch()
+    few.extend(values[:3, 0])
+    assert np.allclose(few.q3.value(), np.percentile(values[:3, 0], 75))
+    # Outlier test
+    low, high = sketch.bounds(1.5)
+    test = np.array([[low[0] - 1, high[1] + 1], [0, 1]])
+    assert np.all(sketch.outliers(test, 1.5) == [[True, True],
+                                                 [False, False]])
+    assert np.all(sketch.outliers(test, 1.5, side='low') == [[True, False],
+                                                             [False, False]])
+
+
+def test_sketch_outlier_volumes():
+    rng = np.random.RandomState(1)
+    projections = rng.normal(size=(500, 6))
+    projections[100] = -10
+    exact, n_exact = mb.find_outlier_volumes(projections)
+    sketch = quantile_sketch.IQRSketch()
+    approx, n_approx = mb.find_outlier_volumes(projections, sketch=sketch)
+    assert sketch.count == 500
+    assert n_approx[100] == 6
+    # Nearly the same slices are flagged
+    assert np.mean(exact != approx) < 0.01
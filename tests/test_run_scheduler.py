@@ -0,0 +1,96 @@
+""" Tests for scheduling runs over workers
+"""
+
+import os
+import sys
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import run_scheduler
+
+
+def test_subject_batches():
+    paths = ['data/group00_sub01_run1.nii', 'data/group00_sub01_run2.nii',
+             'data/group00_sub02_run1.nii', 'data/group01_sub01_run1.nii',
+             'data/other.nii']
+    sizes = [10, 20, 25, 5, 40]
+    batches = run_scheduler.subject_batches(paths, sizes)
+    # Largest subject first, largest run first within subject
+    assert batches == [[4], [1, 0], [2], [3]]
+
+
+def test_work_queues():
+    sizes = [10, 20, 25, 5, 40, 1]
+    queues = run_scheduler.WorkQueues(2)
+    queues.assign([[4], [1, 0], [2], [3, 5]], sizes)
+    assert [queues.tasks(w) for w in range(2)] == [[4, 3, 5], [1, 0, 2]]
+    assert queues.pop(0) == 4
+    assert queues.pop(0) == 3
+    assert queues.pop(0) == 5
+    # Worker 0 is out of work, steals last batch of worker 1
+    assert queues.peek(0) == 2
+    assert queues.pop(0) == 2
+    assert queues.pop(1) == 1
+    # Batch of worker 1 was started, so is not split with worker 0
+    assert queues.pop(0) is None
+    assert queues.pop(1) == 0
+    assert queues.pop(0) is None and queues.pop(1) is None
+    # Batches not yet started are stolen whole
+    queues = run_scheduler.WorkQueues(2)
+    queues.assign([[0, 1, 2], [3]], [5, 5, 5, 1])
+    assert queues.pop(1) == 3
+    assert queues.pop(1) == 0
+    assert queues.pop(0) is None
+    queues = run_scheduler.WorkQueues(2)
+    queues.assign([[0, 1], [2], [3, 4]], [5, 5, 6, 1, 1])
+    assert queues.tasks(0) == [0, 1] and queues.tasks(1) == [2, 3, 4]
+    assert queues.pop(0) == 0 and queues.pop(0) == 1
+    assert queues.pop(0) == 3
+    assert queues.tasks(0) == [4] and queues.tasks(1) == [2]
+
+
+def test_checkpoint(tmpdir):
+    paths = []
+    for name in ('a.nii', 'b.nii'):
+        paths.append(str(tmpdir.join(name)))
+        with open(paths[-1], 'wb') as fobj:
+            fobj.write(b'image')
+    checkpoint = str(tmpdir.join('checkpoint.jsonl'))
+    settings = {'detectors': ['mean'], 'thresholds': {'slice_iqr': 1.5}}
+    report = {'outliers': [3], 'detector_outliers': {'mean': [3]},
+              'columns': {}}
+    assert run_scheduler.finished_reports(checkpoint, settings, paths) == {}
+    with open(checkpoint, 'at') as fobj:
+        run_scheduler.append_checkpoint(fobj, paths[1], report, settings)
+        # Interrupted while writing
+        fobj.write('{"path": ')
+    assert run_scheduler.finished_reports(checkpoint, settings, paths) == {
+        1: {'outliers': [3], 'detector_outliers': {'mean': [3]}}}
+    # Resumed sweep drops the partial line before appending
+    with run_scheduler.open_checkpoint(checkpoint) as fobj:
+        run_scheduler.append_checkpoint(fobj, paths[0], report, settings)
+    with open(checkpoint, 'rt') as fobj:
+        assert len(fobj.readlines()) == 2
+    assert sorted(run_scheduler.finished_reports(checkpoint, settings,
+                                                 paths)) == [0, 1]
+    # Other settings
+    other = dict(settings, detectors=['com'])
+    assert run_scheduler.finished_reports(checkpoint, other, paths) == {}
+    # Changed image
+    with open(paths[1], 'ab') as fobj:
+        fobj.write(b' changed')
+    assert list(run_scheduler.finished_reports(checkpoint, settings,
+                                               paths)) == [0]
+    # Report depending on other files, changed since
+    sources = [paths, None]
+    with run_scheduler.open_checkpoint(checkpoint) as fobj:
+        run_scheduler.append_checkpoint(fobj, paths[0], report, settings,
+                                        sources[0])
+    assert list(run_scheduler.finished_reports(checkpoint, settings, paths,
+                                               sources)) == [0]
+    with open(paths[1], 'ab') as fobj:
+        fobj.write(b' again')
+    assert run_scheduler.finished_reports(checkpoint, settings, paths,
+                                          sources) == {}
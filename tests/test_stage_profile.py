@@ -0,0 +1,48 @@
+""" Tests for per-stage profiling
+"""
+
+import os
+import sys
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import stage_profile
+from stage_profile import stage
+
+
+def test_stage_profiler(tmpdir):
+    profiler = stage_profile.StageProfiler('run1.nii')
+    with stage(profiler, 'first'):
+        sum(range(10000))
+    for i in range(2):
+        with stage(profiler, 'second'):
+            pass
+    # Peak memory is for each stage, not the process so far
+    big = [0] * 10 ** 7
+    process_peak = stage_profile.peak_rss()
+    del big
+    with stage(profiler, 'after'):
+        pass
+    # No profiler, no records
+    with stage(None, 'third'):
+        pass
+    records = profiler.records
+    assert [r['stage'] for r in records] == ['first', 'second', 'second',
+                                             'after']
+    for record in records:
+        assert record['file'] == 'run1.nii'
+        assert record['wall'] >= 0 and record['cpu'] >= 0
+        assert record['peak_rss'] > 0
+    trace = str(tmpdir.join('trace.jsonl'))
+    with open(trace, 'wt') as fobj:
+        stage_profile.write_records(fobj, records)
+    assert stage_profile.read_records(trace) == records
+    if records[-1]['start_rss'] is not None:
+        assert records[-1]['peak_rss'] < process_peak
+    summary = stage_profile.summarize(records)
+    assert [row[:2] for row in summary] == [('first', 1), ('second', 2),
+                                             ('after', 1)]
+    table = stage_profile.format_summary(records)
+    assert len(table.splitlines()) == 4
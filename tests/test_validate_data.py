@@ -0,0 +1,104 @@
+""" Tests for data validation
+"""
+
+import os
+import sys
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+MY_DIRECTORY = os.path.dirname(__file__)
+SMALL_4D = os.path.join(MY_DIRECTORY, 'small_4d.nii')
+SCRIPTS_DIRECTORY = os.path.join(MY_DIRECTORY, '..', 'scripts')
+sys.path.append(SCRIPTS_DIRECTORY)
+
+import validate_data
+
+
+def test_file_hash():
+    with open(SMALL_4D, 'rb') as fobj:
+        expected = hashlib.sha1(fobj.read()).hexdigest()
+    assert validate_data.file_hash(SMALL_4D) == expected
+    # Block size smaller than the file
+    assert validate_data.file_hash(SMALL_4D, 100) == expected
+
+
+def test_validate_data(tmpdir):
+    data_directory = str(tmpdir)
+    hashes = []
+    for i in range(4):
+        filename = 'file{}.txt'.format(i)
+        contents = 'contents {}'.format(i).encode('latin1')
+        with open(os.path.join(data_directory, filename), 'wb') as fobj:
+            fobj.write(contents)
+        hashes.append((hashlib.sha1(contents).hexdigest(), filename))
+    hash_fname = os.path.join(data_directory, 'data_hashes.txt')
+    with open(hash_fname, 'wt') as fobj:
+        fobj.write('\n'.join(' '.join(entry) for entry in hashes))
+    validate_data.validate_data(data_directory)
+    # All bad files are reported
+    with open(os.path.join(data_directory, 'file1.txt'), 'wb') as fobj:
+        fobj.write(b'changed')
+    os.unlink(os.path.join(data_directory, 'file3.txt'))
+    with pytest.raises(ValueError) as excinfo:
+        validate_data.validate_data(data_directory, n_threads=2)
+    message = str(excinfo.value)
+    assert 'Hash mismatch' in message and 'file1.txt' in message
+    assert 'Missing file' in message and 'file3.txt' in message
+    assert 'file0.txt' not in message and 'file2.txt' not in message
+
+
+def test_validate_cache(tmpdir):
+    data_directory = str(tmpdir)
+    fname = os.path.join(data_directory, 'file.txt')
+    with open(fname, 'wb') as fobj:
+        fobj.write(b'contents')
+    with open(os.path.join(data_directory, 'data_hashes.txt'), 'wt') as fobj:
+        fobj.write(hashlib.sha1(b'contents').hexdigest() + ' file.txt\n')
+    # Pretend file was last written a while ago, so hash can be cached
+    os.utime(fname, (1e9, 1e9))
+    validate_data.validate_data(data_directory)
+    cache = validate_data.read_cache(data_directory)
+    assert cache['file.txt']['stat'] == validate_data.file_stat(fname)
+    # Unchanged file uses cached hash, so a wrong cached hash is reported
+    cache['file.txt']['hash'] = 'bad'
+    validate_data.write_cache(data_directory, cache)
+    with pytest.raises(ValueError):
+        validate_data.validate_data(data_directory)
+    # Full validation ignores the cache, and fixes it
+    validate_data.validate_data(data_directory, full=True)
+    validate_data.validate_data(data_directory)
+    # Changing the file changes its stat, so it is hashed again
+    with open(fname, 'wb') as fobj:
+        fobj.write(b'new contents')
+    os.utime(fname, (1e9, 1e9))
+    with pytest.raises(ValueError):
+        validate_data.validate_data(data_directory)
+
+
+def test_write_cache_concurrent(tmpdir):
+    # Writers at the same time keep each other's entries
+    data_directory = str(tmpdir)
+    names = ['file{0}.txt'.format(i) for i in range(16)]
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda name: validate_data.write_cache(
+            data_directory, {name: {'stat': [0, 0, 0], 'hash': name}}),
+                      names))
+    assert sorted(validate_data.read_cache(data_directory)) == sorted(names)
+
+
+def test_validate_headers(tmpdir):
+    data_directory = str(tmpdir)
+    fname = os.path.join(data_directory, 'image.nii')
+    with open(SMALL_4D, 'rb') as fobj:
+        contents = fobj.read()
+    with open(fname, 'wb') as fobj:
+        fobj.write(contents[:-10])
+    with open(os.path.join(data_directory, 'data_hashes.txt'), 'wt') as fobj:
+        fobj.write(hashlib.sha1(contents[:-10]).hexdigest() + ' image.nii\n')
+    # Hash matches; header check finds the truncated image
+    validate_data.validate_data(data_directory)
+    with pytest.raises(ValueError) as excinfo:
+        validate_data.validate_data(data_directory, headers=True)
+    assert 'truncated' in str(excinfo.value)